@@ -0,0 +1,129 @@
+##############################################################
+#
+# Python script that summarises a call from the segments of its masked
+# document, so that reports do not have to read every segment of every
+# call again:
+#
+#   talk time, number of segments and talk ratio per speaker
+#   mean sentiment, weighted by segment duration, for the call and per speaker
+#   lowest and mean confidence
+#   silence between the segments (total, number of gaps, longest gap)
+#   time the speakers talk over each other
+#   sentiment trend, the slope of Positive - Negative per minute of the call
+#
+# The values of every segment are appended to flat arrays as the segments
+# are masked (a few numbers per segment, also when the document is
+# streamed) and the summary is computed over them with NumPy in one go.
+#
+##############################################################
+
+import array
+
+
+def rounded(value):
+    return round(float(value), 4)
+
+
+class SegmentArrays:
+
+    def __init__(self):
+        self.speaker_codes = {}
+        self.speakers = array.array('l')
+        self.offsets = array.array('d')
+        self.durations = array.array('d')
+        self.confidences = array.array('d')
+        self.positive = array.array('d')
+        self.negative = array.array('d')
+        self.neutral = array.array('d')
+
+    def add(self, segment):
+        """Add a segment of the masked document"""
+        speaker = str(segment['SpeakerId'])
+        self.speakers.append(self.speaker_codes.setdefault(speaker, len(self.speaker_codes)))
+        self.offsets.append(float(segment['OffsetInSeconds']))
+        self.durations.append(float(segment['DurationInSeconds']))
+        self.confidences.append(float(segment['Confidence']))
+        self.positive.append(float(segment['Sentiment']['Positive']))
+        self.negative.append(float(segment['Sentiment']['Negative']))
+        self.neutral.append(float(segment['Sentiment']['Neutral']))
+
+    def summary(self):
+        import numpy as np
+
+        count = len(self.offsets)
+        if count == 0:
+            return {"Segments": 0}
+
+        speakers = np.frombuffer(self.speakers, dtype=np.dtype('l'))
+        offsets = np.frombuffer(self.offsets)
+        durations = np.frombuffer(self.durations)
+        confidences = np.frombuffer(self.confidences)
+        sentiment = {"Positive": np.frombuffer(self.positive),
+                     "Negative": np.frombuffer(self.negative),
+                     "Neutral": np.frombuffer(self.neutral)}
+
+        talk_time = durations.sum()
+        speaker_count = len(self.speaker_codes)
+        speaker_segments = np.bincount(speakers, minlength=speaker_count)
+        speaker_talk_time = np.bincount(speakers, weights=durations, minlength=speaker_count)
+
+        def weightedMean(values):
+            # segments without a duration count equally
+            if talk_time > 0:
+                return np.average(values, weights=durations)
+            return values.mean()
+
+        def speakerMeans(values):
+            weighted = np.bincount(speakers, weights=values * durations, minlength=speaker_count)
+            plain = np.bincount(speakers, weights=values, minlength=speaker_count) / speaker_segments
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(speaker_talk_time > 0, weighted / speaker_talk_time, plain)
+
+        speaker_sentiment = {name: speakerMeans(values) for name, values in sentiment.items()}
+
+        # Silence and overlap in the order the segments were spoken. A segment
+        # starting before every earlier segment has ended overlaps them.
+        order = np.argsort(offsets, kind='stable')
+        starts = offsets[order]
+        ends = starts + durations[order]
+        spoken_until = np.maximum.accumulate(ends)
+        gaps = starts[1:] - spoken_until[:-1]
+        silences = gaps[gaps > 0]
+        overlaps = np.minimum(np.maximum(-gaps, 0), ends[1:] - starts[1:])
+
+        # Least squares slope of the sentiment over the middle of each segment
+        scores = sentiment["Positive"] - sentiment["Negative"]
+        minutes = (offsets + durations / 2) / 60
+        trend = 0.0
+        if count > 1 and np.ptp(minutes) > 0:
+            centred = minutes - minutes.mean()
+            trend = (centred * (scores - scores.mean())).sum() / (centred * centred).sum()
+
+        return {
+            "Segments": count,
+            "TalkTimeInSeconds": rounded(talk_time),
+            "SilenceInSeconds": rounded(silences.sum()),
+            "SilenceGaps": int(len(silences)),
+            "LongestSilenceInSeconds": rounded(silences.max()) if len(silences) else 0.0,
+            "OverlapInSeconds": rounded(overlaps.sum()),
+            "Confidence": {"Min": rounded(confidences.min()), "Mean": rounded(confidences.mean())},
+            "Sentiment": {name: rounded(weightedMean(values)) for name, values in sentiment.items()},
+            "SentimentTrendPerMinute": rounded(trend),
+            "Speakers": {
+                speaker: {
+                    "Segments": int(speaker_segments[code]),
+                    "TalkTimeInSeconds": rounded(speaker_talk_time[code]),
+                    "TalkRatio": rounded(speaker_talk_time[code] / talk_time) if talk_time > 0 else 0.0,
+                    "Sentiment": {name: rounded(values[code]) for name, values in speaker_sentiment.items()}
+                }
+                for speaker, code in self.speaker_codes.items()
+            }
+        }
+
+
+def callSummary(segments):
+    """Summary of the masked segments of one call"""
+    arrays = SegmentArrays()
+    for segment in segments:
+        arrays.add(segment)
+    return arrays.summary()
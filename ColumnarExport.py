@@ -0,0 +1,304 @@
+##############################################################
+#
+# Python script that exports the masked documents written by
+# EntitySentimentMask.py (Masked_<name>.json) into a columnar Parquet
+# dataset, so that downstream analytics read a few large files instead of
+# one small JSON blob per call:
+#
+#   <path>/calls/date=YYYY-MM-DD/*.parquet      one row per call, with the
+#                                                Summary of the call
+#   <path>/segments/date=YYYY-MM-DD/*.parquet   one row per masked segment
+#
+# The date is the day the masked document was written. Call ids, speakers
+# and entity types are dictionary encoded. Every export run appends new
+# files and only picks up the masked documents that are new or changed
+# since they were last exported (see ProcessingManifest.py), so it can run
+# after every masking run. A document that was masked again is exported
+# again, so keep the rows with the latest exported_at of every call_id.
+# Rows are written batch_rows segments at a time.
+# Files are written under a hidden name and renamed when complete, so a
+# reader never sees half a file.
+#
+# The appended files are small, so compact merges the files smaller than
+# compact_below_bytes of every partition into one. Run it when nothing
+# else is reading the dataset, as the merged file and the files it
+# replaces are both there for a moment.
+#
+# The dataset can be read with e.g. pyarrow.dataset.dataset(path + "/calls",
+# partitioning="hive") or pandas.read_parquet. The settings are read from
+# the columnar_export section of config.json. Needs pyarrow.
+#
+#   python ColumnarExport.py export output/
+#   python ColumnarExport.py compact
+#
+##############################################################
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import uuid
+import StorageBackends
+import ProcessingManifest
+import CallAnalytics
+import Compression
+from Configuration import setting
+
+
+def exportPath():
+    return setting("columnar_export", "path", "export")
+
+
+def segmentSchema():
+    import pyarrow as pa
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("call_id", dictionary),
+        ("segment_index", pa.int32()),
+        ("speaker", dictionary),
+        ("offset_seconds", pa.float64()),
+        ("duration_seconds", pa.float64()),
+        ("confidence", pa.float64()),
+        ("sentiment_positive", pa.float64()),
+        ("sentiment_negative", pa.float64()),
+        ("sentiment_neutral", pa.float64()),
+        ("display", pa.string()),
+        ("entity_types", pa.list_(dictionary)),
+        ("entity_offsets", pa.list_(pa.int32())),
+        ("entity_lengths", pa.list_(pa.int32())),
+        ("exported_at", pa.timestamp("s")),
+    ])
+
+
+def callSchema():
+    import pyarrow as pa
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("call_id", pa.string()),
+        ("audio_file_name", pa.string()),
+        ("audio_length_seconds", pa.float64()),
+        ("segments", pa.int32()),
+        ("talk_time_seconds", pa.float64()),
+        ("silence_seconds", pa.float64()),
+        ("silence_gaps", pa.int32()),
+        ("longest_silence_seconds", pa.float64()),
+        ("overlap_seconds", pa.float64()),
+        ("confidence_min", pa.float64()),
+        ("confidence_mean", pa.float64()),
+        ("sentiment_positive", pa.float64()),
+        ("sentiment_negative", pa.float64()),
+        ("sentiment_neutral", pa.float64()),
+        ("sentiment_trend_per_minute", pa.float64()),
+        ("speakers", pa.list_(dictionary)),
+        ("speaker_talk_ratios", pa.list_(pa.float64())),
+        ("entities", pa.int32()),
+        ("exported_at", pa.timestamp("s")),
+    ])
+
+
+##############################################################
+#
+# The rows of one masked document
+#
+##############################################################
+
+def segmentEntities(segment):
+    # the Entity<n> keys maskSegments adds, as [Type, Offset, Length]
+    return [value for key, value in segment.items() if key.startswith("Entity")]
+
+
+def segmentRow(call_id, index, segment, exported_at):
+    entities = segmentEntities(segment)
+    return {
+        "call_id": call_id,
+        "segment_index": index,
+        "speaker": str(segment["SpeakerId"]),
+        "offset_seconds": float(segment["OffsetInSeconds"]),
+        "duration_seconds": float(segment["DurationInSeconds"]),
+        "confidence": float(segment["Confidence"]),
+        "sentiment_positive": float(segment["Sentiment"]["Positive"]),
+        "sentiment_negative": float(segment["Sentiment"]["Negative"]),
+        "sentiment_neutral": float(segment["Sentiment"]["Neutral"]),
+        "display": segment["Display"],
+        "entity_types": [entity[0] for entity in entities],
+        "entity_offsets": [entity[1] for entity in entities],
+        "entity_lengths": [entity[2] for entity in entities],
+        "exported_at": exported_at,
+    }
+
+
+def callRow(call_id, document, exported_at):
+    # masked documents written before the Summary was added get one here
+    summary = document.get("Summary") or CallAnalytics.callSummary(document["SegmentResults"])
+    speakers = summary.get("Speakers", {})
+    return {
+        "call_id": call_id,
+        "audio_file_name": document["AudioFileName"],
+        "audio_length_seconds": float(document["AudioLengthInSeconds"]),
+        "segments": summary["Segments"],
+        "talk_time_seconds": summary.get("TalkTimeInSeconds", 0.0),
+        "silence_seconds": summary.get("SilenceInSeconds", 0.0),
+        "silence_gaps": summary.get("SilenceGaps", 0),
+        "longest_silence_seconds": summary.get("LongestSilenceInSeconds", 0.0),
+        "overlap_seconds": summary.get("OverlapInSeconds", 0.0),
+        "confidence_min": summary.get("Confidence", {}).get("Min"),
+        "confidence_mean": summary.get("Confidence", {}).get("Mean"),
+        "sentiment_positive": summary.get("Sentiment", {}).get("Positive"),
+        "sentiment_negative": summary.get("Sentiment", {}).get("Negative"),
+        "sentiment_neutral": summary.get("Sentiment", {}).get("Neutral"),
+        "sentiment_trend_per_minute": summary.get("SentimentTrendPerMinute", 0.0),
+        "speakers": list(speakers),
+        "speaker_talk_ratios": [speaker["TalkRatio"] for speaker in speakers.values()],
+        "entities": sum(len(segmentEntities(segment)) for segment in document["SegmentResults"]),
+        "exported_at": exported_at,
+    }
+
+
+##############################################################
+#
+# Collect the rows of many calls per date and write them as new files of
+# the dataset
+#
+##############################################################
+
+def writeTable(table, directory):
+    import pyarrow.parquet as pq
+    os.makedirs(directory, exist_ok=True)
+    name = "part-{}-{}.parquet".format(datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+    # readers skip hidden files, so the file only appears once it is complete
+    temporary = os.path.join(directory, "." + name)
+    pq.write_table(table, temporary, compression=setting("columnar_export", "compression", "zstd"))
+    os.replace(temporary, os.path.join(directory, name))
+    return os.path.join(directory, name)
+
+
+class DatasetWriter:
+
+    def __init__(self, path, batch_rows=None):
+        if batch_rows is None:
+            batch_rows = setting("columnar_export", "batch_rows", 200000)
+        self.path = path
+        self.batch_rows = batch_rows
+        self.segments = collections.defaultdict(list)
+        self.calls = collections.defaultdict(list)
+        self.pending_rows = 0
+        self.exported_at = datetime.datetime.utcnow().replace(microsecond=0)
+
+    def add(self, call_id, date, document):
+        """Add a masked document, returning True when the rows were written"""
+        partition = "date=" + date.strftime("%Y-%m-%d")
+        rows = [segmentRow(call_id, index, segment, self.exported_at)
+                for index, segment in enumerate(document["SegmentResults"])]
+        self.segments[partition].extend(rows)
+        self.calls[partition].append(callRow(call_id, document, self.exported_at))
+        self.pending_rows += len(rows) + 1
+        if self.pending_rows >= self.batch_rows:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        import pyarrow as pa
+        for table_name, partitions, schema in (("segments", self.segments, segmentSchema()), ("calls", self.calls, callSchema())):
+            for partition, rows in partitions.items():
+                writeTable(pa.Table.from_pylist(rows, schema=schema), os.path.join(self.path, table_name, partition))
+        self.segments.clear()
+        self.calls.clear()
+        self.pending_rows = 0
+
+
+##############################################################
+#
+# Export the masked documents in a folder of the transcription container
+# (in the storage backend of StorageBackends.py) that were not exported
+# yet, unchanged. Returns the number of calls exported.
+#
+##############################################################
+
+def maskedDocuments(storage, masked_folder, force=False):
+    manifest = ProcessingManifest.get_manifest()
+    for blob in storage.list(setting("storage", "transcription_container"), masked_folder):
+        if not blob.name.split("/")[-1].startswith("Masked_"):
+            continue
+        etag, content_hash = ProcessingManifest.blobVersion(blob)
+        if not force and not manifest.shouldProcess(ProcessingManifest.EXPORT, blob.name, etag, content_hash)[0]:
+            continue
+        yield blob, etag, content_hash
+
+
+def exportMaskedDocuments(masked_folder, path=None, force=False):
+    storage = StorageBackends.get_storage_backend()
+    manifest = ProcessingManifest.get_manifest()
+    writer = DatasetWriter(path or exportPath())
+    # marked as exported once their rows are written
+    written = []
+    exported = 0
+
+    def markExported():
+        for name, etag, content_hash in written:
+            manifest.markDone(ProcessingManifest.EXPORT, name, writer.path, etag, content_hash)
+        written.clear()
+
+    for blob, etag, content_hash in maskedDocuments(storage, masked_folder, force):
+        print("Exporting: " + blob.name)
+        document = json.loads(Compression.readBlobText(storage, setting("storage", "transcription_container"), blob.name))
+        written.append((blob.name, etag, content_hash))
+        exported += 1
+        if writer.add(blob.name, blob.last_modified, document):
+            markExported()
+    writer.flush()
+    markExported()
+    print("Exported calls: ", exported, " to ", writer.path)
+    return exported
+
+
+##############################################################
+#
+# Merge the files smaller than compact_below_bytes of every partition
+# into one file. Returns the number of files merged.
+#
+##############################################################
+
+def compact(path=None, compact_below_bytes=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if compact_below_bytes is None:
+        compact_below_bytes = setting("columnar_export", "compact_below_bytes", 64 * 1024 * 1024)
+    path = path or exportPath()
+    merged = 0
+    for table_name in ("segments", "calls"):
+        table_path = os.path.join(path, table_name)
+        if not os.path.isdir(table_path):
+            continue
+        for partition in sorted(os.listdir(table_path)):
+            directory = os.path.join(table_path, partition)
+            small_files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                                 if name.endswith(".parquet") and not name.startswith(".")
+                                 and os.path.getsize(os.path.join(directory, name)) < compact_below_bytes)
+            if len(small_files) < 2:
+                continue
+            table = pa.concat_tables([pq.read_table(file_name) for file_name in small_files])
+            writeTable(table, directory)
+            for file_name in small_files:
+                os.remove(file_name)
+            print("Compacted ", len(small_files), " files of ", directory)
+            merged += len(small_files)
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="append the new masked documents of a folder to the dataset")
+    export.add_argument("masked_folder")
+    export.add_argument("--path", default=None, help="dataset directory (default columnar_export.path)")
+    export.add_argument("--force", action="store_true", help="export documents that were already exported")
+    compaction = subparsers.add_parser("compact", help="merge the small files of every partition")
+    compaction.add_argument("--path", default=None, help="dataset directory (default columnar_export.path)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        exportMaskedDocuments(args.masked_folder, args.path, args.force)
+    else:
+        print("Merged files: ", compact(args.path))
@@ -0,0 +1,150 @@
+##############################################################
+#
+# Python script that optionally compresses the JSON transcriptions and
+# masked documents written to storage, and transparently decompresses
+# whatever is read back.
+#
+# storage.compression in config.json selects the format of new blobs:
+# "" (none, the default), "gzip" or "zstd" (needs pip install zstandard),
+# at storage.compression_level. Compressed blobs keep their .json names
+# and are stored with Content-Encoding gzip or zstd and Content-Type
+# application/json, so HTTP clients that understand the encoding decode
+# them on download. The local backend of StorageBackends.py keeps no
+# metadata, so there only the content tells the format.
+#
+# Reads never trust the name or the metadata: the format is detected from
+# the first bytes of the blob (the gzip and zstd magic numbers), so a
+# container holding both compressed and uncompressed blobs can be read.
+# The storage session hands back blobs as they are stored (see
+# ServiceClients.py) for the same reason.
+#
+##############################################################
+
+import itertools
+import zlib
+from Configuration import setting
+
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+MAGIC_LENGTH = 4
+
+
+def storageEncoding():
+    encoding = setting("storage", "compression", "") or None
+    if encoding not in (None, GZIP, ZSTD):
+        raise ValueError("storage.compression must be empty, gzip or zstd, not " + str(encoding))
+    return encoding
+
+
+def compressionLevel(encoding):
+    level = setting("storage", "compression_level", None)
+    if level is not None:
+        return level
+    return 6 if encoding == GZIP else 3
+
+
+def detectEncoding(data):
+    if data[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return GZIP
+    if data[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+        return ZSTD
+    return None
+
+
+##############################################################
+#
+# Incremental compressors and decompressors with compress/decompress and
+# flush, for both formats
+#
+##############################################################
+
+def compressor(encoding):
+    if encoding == GZIP:
+        return zlib.compressobj(compressionLevel(encoding), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    import zstandard
+    return zstandard.ZstdCompressor(level=compressionLevel(encoding)).compressobj()
+
+
+def decompressor(encoding):
+    if encoding == GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def compress(data, encoding):
+    if encoding is None:
+        return data
+    stream = compressor(encoding)
+    return stream.compress(data) + stream.flush()
+
+
+def decompress(data):
+    """The content of a blob, decompressed when it is gzip or zstd"""
+    encoding = detectEncoding(data)
+    if encoding is None:
+        return data
+    return b"".join(decompressChunks([data]))
+
+
+def compressChunks(chunks, encoding):
+    if encoding is None:
+        yield from chunks
+        return
+    stream = compressor(encoding)
+    for chunk in chunks:
+        data = stream.compress(chunk)
+        if data:
+            yield data
+    yield stream.flush()
+
+
+def decompressChunks(chunks):
+    """The chunks of a blob, decompressed as they arrive when the blob is gzip or zstd"""
+    chunks = iter(chunks)
+    head = b""
+    # enough bytes to tell the format
+    while len(head) < MAGIC_LENGTH:
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        head += chunk
+    encoding = detectEncoding(head)
+    if encoding is None:
+        if head:
+            yield head
+        yield from chunks
+        return
+    stream = decompressor(encoding)
+    for chunk in itertools.chain([head], chunks):
+        data = stream.decompress(chunk)
+        if data:
+            yield data
+    data = stream.flush()
+    if data:
+        yield data
+
+
+##############################################################
+#
+# Write to and read from the storage backend (see StorageBackends.py)
+#
+##############################################################
+
+def createBlobFromBytes(storage, container_name, blob_name, data):
+    encoding = storageEncoding()
+    return storage.put(container_name, blob_name, compress(data, encoding), encoding)
+
+
+def createBlobFromChunks(storage, container_name, blob_name, chunks):
+    encoding = storageEncoding()
+    return storage.putChunks(container_name, blob_name, compressChunks(chunks, encoding), encoding)
+
+
+def readBlobText(storage, container_name, blob_name):
+    """The text of a blob, whether it is stored compressed or not"""
+    return decompress(storage.get(container_name, blob_name)).decode("utf-8")
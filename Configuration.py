@@ -0,0 +1,69 @@
+##############################################################
+#
+# Python script that reads the config.json file once per process
+# and hands the same configuration to every module that needs it.
+# Nothing is read until a module first asks for a setting, so every
+# module can be imported without a config.json.
+#
+# Any setting can be overridden with an environment variable named
+# CONFIG_<SECTION>__<KEY>, e.g.
+#
+#   CONFIG_STORAGE__ACCOUNT_KEY=...
+#   CONFIG_BATCH_CONFIG__FILES_TO_PROCESS=100
+#
+# Section and key names are matched without regard to case. Values are
+# read as JSON when they parse (numbers, true/false, lists, objects) and
+# as plain strings otherwise. The file itself can be moved with
+# CONFIG_FILE=/path/to/config.json.
+#
+##############################################################
+
+import json
+import os
+import threading
+
+
+config_file_name = "config.json"
+
+ENVIRONMENT_PREFIX = "CONFIG_"
+
+configuration = None
+configuration_lock = threading.Lock()
+
+
+def parseValue(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def matchingKey(mapping, name):
+    for key in mapping:
+        if key.lower() == name.lower():
+            return key
+    return name.lower()
+
+
+def applyEnvironmentOverrides(configuration, environ):
+    for variable, value in environ.items():
+        if not variable.startswith(ENVIRONMENT_PREFIX) or "__" not in variable or variable == "CONFIG_FILE":
+            continue
+        section_name, key_name = variable[len(ENVIRONMENT_PREFIX):].split("__", 1)
+        section = configuration.setdefault(matchingKey(configuration, section_name), {})
+        section[matchingKey(section, key_name)] = parseValue(value)
+    return configuration
+
+
+def get_configuration():
+    global configuration
+    with configuration_lock:
+        if configuration is None:
+            with open(os.environ.get("CONFIG_FILE", config_file_name), 'r') as f:
+                configuration = applyEnvironmentOverrides(json.load(f), os.environ)
+    return configuration
+
+
+def setting(section, key, default=None):
+    """A single setting, or default when it is not in the configuration"""
+    return get_configuration().get(section, {}).get(key, default)
@@ -0,0 +1,212 @@
+##############################################################
+#
+# Python script that caches the entities returned by the Text Analytics
+# entities API for a segment text, so that the greetings, hold messages
+# and other sentences repeated across calls are only sent to the service
+# once.
+#
+# Entries are keyed by a SHA-256 of the language and the segment text and
+# hold every entity match returned for that text (name, type, subtype,
+# offset, length and score, in the order the service returned them). There
+# are two tiers: an in-memory LRU and an on-disk SQLite file that is kept
+# across runs and evicts its least recently used entries once it grows
+# beyond max_disk_bytes. Hits and misses are counted per tier.
+#
+# Several processes share the SQLite file (see MaskBlobTranscriptions.py),
+# so no write transaction is held open between calls: new entries and the
+# last use of the entries read from disk are kept in memory and written in
+# one short transaction by flush(), or once commit_every of them are
+# waiting. That transaction also reads the size of the whole file, so the
+# entries of every process count towards max_disk_bytes. Refreshing the
+# last use is best effort and is dropped when the file stays locked for
+# longer than busy_timeout seconds.
+#
+##############################################################
+
+import atexit
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from Configuration import get_configuration
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    key         TEXT PRIMARY KEY,
+    value       TEXT,
+    size        INTEGER,
+    last_used   REAL
+);
+CREATE INDEX IF NOT EXISTS entities_last_used ON entities (last_used);
+"""
+
+
+def cacheKey(language, text):
+    return hashlib.sha256((language + "\0" + text).encode("utf-8")).hexdigest()
+
+
+class EntityCache:
+
+    def __init__(self, path=None, memory_entries=10000, max_disk_bytes=100 * 1024 * 1024, commit_every=100, busy_timeout=30):
+        self.memory = collections.OrderedDict()
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.commit_every = commit_every
+        # entries not written yet, and the last use of entries read from disk
+        self.unwritten = {}
+        self.used = {}
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.connection = None
+        self.disk_bytes = 0
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA busy_timeout = {}".format(int(busy_timeout * 1000)))
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+            self.disk_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entities").fetchone()[0]
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    ##############################################################
+    #
+    # Returns the list of entity matches cached for the text, or None
+    #
+    ##############################################################
+
+    def get(self, language, text):
+        key = cacheKey(language, text)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+
+            if key in self.unwritten:
+                value = [tuple(match) for match in json.loads(self.unwritten[key][0])]
+                self._remember(key, value)
+                self.memory_hits += 1
+                return value
+
+            if self.connection is not None:
+                row = self.connection.execute("SELECT value FROM entities WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value = [tuple(match) for match in json.loads(row[0])]
+                    self.used[key] = time.time()
+                    self._remember(key, value)
+                    self.disk_hits += 1
+                    if len(self.used) >= self.commit_every:
+                        self._write()
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, language, text, matches):
+        key = cacheKey(language, text)
+        value = [tuple(match) for match in matches]
+        with self.lock:
+            self._remember(key, value)
+            if self.connection is None:
+                return
+            self.unwritten[key] = (json.dumps(value), time.time())
+            if len(self.unwritten) >= self.commit_every:
+                self._write()
+
+    def _write(self):
+        # One short write transaction with the new entries and the last uses.
+        # The other processes write to the same file, so the size of the file
+        # is read again once the transaction holds the write lock.
+        if not self.unwritten and not self.used:
+            return
+        unwritten, self.unwritten = self.unwritten, {}
+        used, self.used = self.used, {}
+        disk_bytes = self.disk_bytes
+        try:
+            with self.connection:
+                self.connection.execute("BEGIN IMMEDIATE")
+                self.connection.executemany("INSERT OR REPLACE INTO entities (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                                            [(key, encoded, len(encoded), last_used)
+                                             for key, (encoded, last_used) in unwritten.items()])
+                self.connection.executemany("UPDATE entities SET last_used = ? WHERE key = ?",
+                                            [(last_used, key) for key, last_used in used.items()])
+                self.disk_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entities").fetchone()[0]
+                if self.disk_bytes > self.max_disk_bytes:
+                    self._evict()
+        except sqlite3.OperationalError as err:
+            # the entries are still in memory, and the service is asked again next run
+            self.disk_bytes = disk_bytes
+            print("Could not write " + str(len(unwritten)) + " entries to the entity cache: {}".format(err))
+
+    def _evict(self, batch_size=500):
+        # Drop the least recently used entries until the file is back under 90% of its limit,
+        # reading at most batch_size of them at a time
+        target = self.max_disk_bytes * 0.9
+        while self.disk_bytes > target:
+            rows = self.connection.execute("SELECT key, size FROM entities ORDER BY last_used LIMIT ?", (batch_size,)).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if self.disk_bytes <= target:
+                    break
+                evicted.append((key,))
+                self.disk_bytes -= size
+            self.connection.executemany("DELETE FROM entities WHERE key = ?", evicted)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "disk_bytes": self.disk_bytes
+            }
+
+    def flush(self):
+        with self.lock:
+            if self.connection is not None:
+                self._write()
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self._write()
+                self.connection.close()
+                self.connection = None
+
+
+##############################################################
+#
+# The cache configured in config.json, shared by the whole process and
+# committed when the process exits
+#
+##############################################################
+
+entity_cache = None
+entity_cache_lock = threading.Lock()
+
+def get_entity_cache():
+    global entity_cache
+    with entity_cache_lock:
+        if entity_cache is None:
+            cache_config = get_configuration().get("entity_cache", {})
+            path = cache_config.get("path", "EntityCache.db") if cache_config.get("enabled", True) else None
+            entity_cache = EntityCache(path, cache_config.get("memory_entries", 10000),
+                                       cache_config.get("max_disk_bytes", 100 * 1024 * 1024))
+            if not cache_config.get("enabled", True):
+                entity_cache.memory_entries = 0
+            atexit.register(entity_cache.close)
+    return entity_cache
@@ -0,0 +1,200 @@
+##############################################################
+#
+# Python script with the backends that find Person entities in the speaker
+# sentences, for masking by EntitySentimentMask.py:
+#
+#   text_analytics  the Text Analytics entities API (the original backend)
+#   local           an in-process gazetteer and rule based name detector
+#                   that needs no network
+#
+# The "entity_detection" section of config.json picks the primary backend
+# and an optional fallback that processes every document the primary one
+# could not (an outage, throttling or a per-document error). A document
+# that no backend could process raises EntityDetectionError rather than
+# being left unmasked.
+#
+# Every backend returns, for each document id it processed, the list of
+# (Name, Type, Subtype, Offset, Length, Score) matches the masking reads.
+#
+##############################################################
+
+import re
+import threading
+import RateLimiter
+import ServiceClients
+from Configuration import get_configuration
+
+
+class EntityDetectionError(Exception):
+    pass
+
+
+class EntityDetector:
+
+    name = None
+    # whether the results are worth keeping in the entity cache
+    cacheable = False
+
+    def detect(self, docs):
+        """Returns {document id: [(Name, Type, Subtype, Offset, Length, Score), ...]}
+        for the documents processed. Documents missing from the result failed.
+        """
+        raise NotImplementedError
+
+
+##############################################################
+#
+# Text Analytics entities API
+#
+##############################################################
+
+class TextAnalyticsDetector(EntityDetector):
+
+    name = "text_analytics"
+    cacheable = True
+
+    def __init__(self, subscription_key=None):
+        self.subscription_key = subscription_key
+
+    def detect(self, docs):
+        text_analytics = ServiceClients.get_text_analytics_client(self.subscription_key)
+        results = {}
+        try:
+            response = RateLimiter.get_scheduler().call(
+                "text_analytics", self.subscription_key, "POST entities",
+                lambda: text_analytics.entities(documents=docs), "POST")
+        except Exception as err:
+            print("Text Analytics entities request failed. {}".format(err))
+            return results
+
+        for document in response.documents:
+            results[document.id] = [
+                (entity.name, entity.type, entity.sub_type, match.offset, match.length, "{:.2f}".format(match.entity_type_score))
+                for entity in document.entities for match in entity.matches]
+        for error in response.errors or []:
+            print("Text Analytics could not process document {}. {}".format(error.id, error.message))
+        return results
+
+
+##############################################################
+#
+# Local gazetteer and rule based Person detector.
+#
+# A capitalised word is a name when it is in the gazetteer of first names,
+# or when it follows a cue such as "my name is", "this is" or "Mr". The
+# capitalised words directly after a name are taken as its surname.
+#
+##############################################################
+
+# Common first names that are not also common English words
+FIRST_NAMES = """
+aaron adam adrian aidan alan albert alex alexander alice alison amanda amber amy andrea andrew
+angela anna anne anthony antonio ashley barbara ben benjamin beth betty brandon brenda brian
+caroline catherine charles charlie charlotte chloe chris christina christine christopher claire
+craig daniel danielle david deborah debra denise dennis diana diane donald donna dorothy douglas
+edward elizabeth ellie emily emma eric esther ethan fatima gary george gillian graham gregory
+hannah harry heather helen henry ian isabella jack jacob james jamie janet jason jeffrey
+jennifer jessica joan joanne john jonathan joseph joshua julie justin karen katherine kathleen
+kelly kenneth kevin kimberly laura lauren linda lisa louise lucy luke margaret maria marie
+martin mary matthew megan melissa michael michelle mohammed muhammad nancy natalie nathan
+nicholas nicola nicole oliver olivia pamela patricia paul peter philip rachel raymond rebecca
+richard robert ryan samantha samuel sandra sarah scott sharon shirley simon sophie stephanie
+stephen steven susan thomas timothy tyler victoria william zoe
+"""
+
+TITLES = {"mr", "mrs", "ms", "miss", "dr"}
+CUES = re.compile(r"\b(?:my name is|my name's|name is|this is|speaking to|speak to|talking to|talk to|ask for|"
+                  r"mr|mrs|ms|miss|dr)\.?\s+$", re.IGNORECASE)
+CAPITALISED_WORD = re.compile(r"[A-Z](?:[a-z]+|'[A-Z][a-z]+)(?:-[A-Z][a-z]+)*")
+MAX_SURNAME_WORDS = 2
+# characters before a word searched for a cue
+CUE_WINDOW = 20
+
+
+class LocalNameDetector(EntityDetector):
+
+    name = "local"
+
+    def __init__(self, gazetteer_path=None):
+        self.first_names = set(FIRST_NAMES.split())
+        if gazetteer_path:
+            with open(gazetteer_path, 'r') as f:
+                self.first_names.update(line.strip().lower() for line in f if line.strip())
+
+    def findNames(self, text):
+        words = list(CAPITALISED_WORD.finditer(text))
+        names = []
+        i = 0
+        while i < len(words):
+            word = words[i]
+            if word.group(0).lower() in TITLES:
+                i += 1
+            elif word.group(0).lower() in self.first_names or CUES.search(text[max(0, word.start() - CUE_WINDOW):word.start()]):
+                start, end = word.start(), word.end()
+                # Following capitalised words separated by a single space are the surname
+                j = i + 1
+                while j < len(words) and j - i <= MAX_SURNAME_WORDS and text[end:words[j].start()] == " " \
+                        and words[j].group(0).lower() not in TITLES:
+                    end = words[j].end()
+                    j += 1
+                names.append((text[start:end], "Person", None, start, end - start, "{:.2f}".format(0.5)))
+                i = j
+            else:
+                i += 1
+        return names
+
+    def detect(self, docs):
+        return {doc["id"]: self.findNames(doc["text"]) for doc in docs}
+
+
+##############################################################
+#
+# Primary backend with an optional fallback for the documents it could not
+# process. Returns {document id: (matches, backend)}.
+#
+##############################################################
+
+class FallbackDetector:
+
+    def __init__(self, primary, fallback=None):
+        self.primary = primary
+        self.fallback = fallback
+
+    def detect(self, docs):
+        results = {document_id: (matches, self.primary) for document_id, matches in self.primary.detect(docs).items()}
+
+        missing = [doc for doc in docs if doc["id"] not in results]
+        if missing and self.fallback is not None:
+            print("Using the " + self.fallback.name + " entity detector for " + str(len(missing)) + " documents")
+            for document_id, matches in self.fallback.detect(missing).items():
+                results[document_id] = (matches, self.fallback)
+            missing = [doc for doc in missing if doc["id"] not in results]
+
+        if missing:
+            raise EntityDetectionError("No entity detector could process documents " + ", ".join(doc["id"] for doc in missing))
+        return results
+
+
+def createDetector(name, subscription_key=None):
+    configuration = get_configuration().get("entity_detection", {})
+    if name == TextAnalyticsDetector.name:
+        return TextAnalyticsDetector(subscription_key)
+    if name == LocalNameDetector.name:
+        return LocalNameDetector(configuration.get("gazetteer_path"))
+    raise ValueError("Unknown entity detection backend: " + str(name))
+
+
+entity_detectors = {}
+entity_detectors_lock = threading.Lock()
+
+def get_entity_detector(subscription_key=None):
+    with entity_detectors_lock:
+        if subscription_key not in entity_detectors:
+            configuration = get_configuration().get("entity_detection", {})
+            primary = createDetector(configuration.get("backend", TextAnalyticsDetector.name), subscription_key)
+            fallback_name = configuration.get("fallback", LocalNameDetector.name)
+            fallback = None
+            if fallback_name and fallback_name != "none" and fallback_name != primary.name:
+                fallback = createDetector(fallback_name, subscription_key)
+            entity_detectors[subscription_key] = FallbackDetector(primary, fallback)
+        return entity_detectors[subscription_key]
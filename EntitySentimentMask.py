@@ -1,33 +1,36 @@
-import os
 import json
 import argparse
-import pandas as pd
-from azure.cognitiveservices.language.textanalytics import TextAnalyticsClient
-from msrest.authentication import CognitiveServicesCredentials
-import datetime
+import StorageBackends
+import RedactionEngine
+import EntityCache
+import EntityDetectors
+import tempfile
+import TranscriptionStream
+import Compression
+import Metrics
+import CallAnalytics
+from Configuration import setting
 
-config_file_name = "config.json"
 
+def transcriptionContainer():
+    return setting("storage", "transcription_container")
 
-parser = argparse.ArgumentParser()
-parser.add_argument("blobname")
-parser.add_argument("masked_target_folder")
-args = parser.parse_args()
 
-with open(config_file_name, 'r') as f:
-    configuration = json.load(f)
+def textAnalyticsKey():
+    return setting("text_api", "subscription_key")
 
-# Blob storage info 
-account_name = configuration["storage"]["account_name"] 
-account_key = configuration["storage"]["account_key"] 
-transcription_container = configuration["storage"]["transcription_container"] 
-region = configuration["text_api"]["region"]
 
+# The Text Analytics v2.1 entities API accepts at most 1000 documents
+# and 1MB of text per request
+def documentsPerRequest():
+    return setting("text_api", "documents_per_request", 1000)
 
+def charactersPerRequest():
+    return setting("text_api", "characters_per_request", 500000)
 
-SUBSCRIPTION_KEY_ENV_NAME = configuration["text_api"]["subscription_key"]
-TEXTANALYTICS_LOCATION = os.environ.get(
-    "TEXTANALYTICS_LOCATION", region)
+# Add the CallAnalytics summary of the call to the masked document
+def addSummary():
+    return setting("masking", "summary", True)
 
 ##############################################################
 # 
@@ -49,176 +52,423 @@ def maskEntities(sentence, startIndex, endIndex):
 
 
 def maskMultipleEntities(sentence, offsets):
-    speakertext = sentence
-    if len(offsets) > 1:
-        for i in range(0,len(offsets)):
-            #print(offsets[i])
-            s = maskEntities(speakertext, offsets[i][0], offsets[i][1])
-            speakertext = s
-
-    elif len(offsets) == 1:
-        speakertext = maskEntities(speakertext, offsets[0][0], offsets[0][1])
-    else:
-        return speakertext
-            
-    
-    return speakertext
+    return RedactionEngine.maskEntitySpans(sentence, offsets)
 
 
 
 ##############################################################
-# 
+#
+# One entity match returned by an entity detection backend
+#
+##############################################################
+
+class EntityMatch:
+    __slots__ = ("DocumentId", "Name", "Type", "Subtype", "Offset", "Length", "Score")
+
+    def __init__(self, DocumentId, Name, Type, Subtype, Offset, Length, Score):
+        self.DocumentId = DocumentId
+        self.Name = Name
+        self.Type = Type
+        self.Subtype = Subtype
+        self.Offset = Offset
+        self.Length = Length
+        self.Score = Score
+
+    def asdict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+##############################################################
+#
 # Extract entities from each segment (i.e. speaker sentence)
 #
 ##############################################################
 
 
+def extract_entities(subscription_key, docs, succeeded_ids=None):
+    """Extracts the entities from sentences with the configured entity detection
+    backends (see EntityDetectors.py) and returns them as EntityMatch records.
+    The ids of the documents answered by a cacheable backend are added to succeeded_ids.
+    Raises EntityDetectionError when a document could not be processed by any backend.
+    """
+    detector = EntityDetectors.get_entity_detector(subscription_key)
+
+    matches = []
+
+    with Metrics.get_metrics().stage("entities"):
+        results = detector.detect(docs)
+    Metrics.get_metrics().increment("entity_documents_total", len(docs))
+    for doc in docs:
+        document_matches, backend = results[doc["id"]]
+        if succeeded_ids is not None and backend.cacheable:
+            succeeded_ids.add(doc["id"])
+        for match in document_matches:
+            matches.append(EntityMatch(doc["id"], *match))
+
+    return matches
+
+
 def entity_extraction(subscription_key, docs):
     """EntityExtraction.
-    Extracts the entities from sentences and prints out their properties.
+    Extracts the entities from sentences and returns them as a DataFrame.
     """
-    datetimeFormat = '%Y-%m-%d %H:%M:%S.%f'
-    t1 = datetime.datetime.now().strftime(datetimeFormat)
-
-   
-    credentials = CognitiveServicesCredentials(subscription_key)
-    text_analytics_url = "https://{}.api.cognitive.microsoft.com".format(
-        TEXTANALYTICS_LOCATION)
-    text_analytics = TextAnalyticsClient(
-        endpoint=text_analytics_url, credentials=credentials)
-    
-   
-    df = pd.DataFrame(columns=["DocumentId","Name","Type", "Subtype","Offset","Length","Score"])
-    
-    try:
-        documents = docs
-        response = text_analytics.entities(documents=documents)  
-        for document in response.documents:           
-            for entity in document.entities:     
-                for match in entity.matches:
-                    df = df.append({"DocumentId" : document.id, "Name" : entity.name, "Type" : entity.type, "Subtype" : entity.sub_type,"Offset" : match.offset, "Length" : match.length, "Score" : "{:.2f}".format(match.entity_type_score)}, ignore_index=True)
+    import pandas as pd
+    return pd.DataFrame([match.asdict() for match in extract_entities(subscription_key, docs)],
+                        columns=list(EntityMatch.__slots__))
 
-    except Exception as err:
-        print("Encountered exception. {}".format(err))
 
-    t2 = datetime.datetime.now().strftime(datetimeFormat)
-    diff = datetime.datetime.strptime(t2, datetimeFormat)\
-     - datetime.datetime.strptime(t1, datetimeFormat)
-    return df
+##############################################################
+#
+# Send the segments of a transcription to the entity detection backends in
+# as few requests as the Text Analytics limits allow and group the returned entities
+# by document id, in the order the service returned them.
+#
+# Segments whose text was already seen (in this call, in an earlier call or
+# in an earlier run, see EntityCache.py) are not sent again.
+#
+##############################################################
+
+def batch_entity_extraction(subscription_key, docs):
+    entities_by_document = {}
+    entity_cache = EntityCache.get_entity_cache()
+    documents_per_request = documentsPerRequest()
+    characters_per_request = charactersPerRequest()
+    # document ids waiting for the entities of each (language, text)
+    waiting = {}
+    batch = []
+    batch_characters = 0
+
+    def extract(batch):
+        succeeded_ids = set()
+        matches_by_document = {}
+        for match in extract_entities(subscription_key, batch, succeeded_ids):
+            matches_by_document.setdefault(match.DocumentId, []).append(match)
+        for doc in batch:
+            matches = matches_by_document.get(doc["id"], [])
+            language_text = (doc["language"], doc["text"])
+            for document_id in waiting.pop(language_text):
+                if matches:
+                    entities_by_document[document_id] = [
+                        EntityMatch(document_id, m.Name, m.Type, m.Subtype, m.Offset, m.Length, m.Score) for m in matches]
+            # Only cache what the service actually answered, not the fallback results
+            if doc["id"] in succeeded_ids:
+                entity_cache.put(doc["language"], doc["text"],
+                                 [(m.Name, m.Type, m.Subtype, m.Offset, m.Length, m.Score) for m in matches])
+
+    for doc in docs:
+        language_text = (doc["language"], doc["text"])
+        if language_text in waiting:
+            waiting[language_text].append(doc["id"])
+            continue
+
+        cached = entity_cache.get(doc["language"], doc["text"])
+        if cached is not None:
+            if cached:
+                entities_by_document[doc["id"]] = [EntityMatch(doc["id"], *match) for match in cached]
+            continue
+
+        if batch and (len(batch) == documents_per_request or batch_characters + len(doc["text"]) > characters_per_request):
+            extract(batch)
+            batch = []
+            batch_characters = 0
+        waiting[language_text] = [doc["id"]]
+        batch.append(doc)
+        batch_characters += len(doc["text"])
+
+    if batch:
+        extract(batch)
+
+    return entities_by_document
+
+
+##############################################################
+# 
+# Mask a window of SegmentResults: build the output segment containing the
+# Display field with masked entities and also containing entities and
+# sentiment for each segment. first_index is the index of the first segment
+# of the window in the transcription. Returns (segment, display text) pairs.
+#
+##############################################################
+
+def maskSegments(segment_results, first_index=0):
+    segments = []
+    segment = {}
 
+    # Mask the numbers of all the segments in one go
+    speaker_displays = RedactionEngine.maskNumbersInSegments(
+        segment_result['NBest'][0]['Display'] for segment_result in segment_results)
 
+    speaker_texts = []
+    entities = []
 
-from azure.storage.blob import BlockBlobService
-block_blob_service = BlockBlobService(account_name=account_name, account_key=account_key)
+    for i, segment_result in enumerate(segment_results):
+        segment['SpeakerId'] = segment_result['ChannelNumber']
+        segment['Confidence'] = segment_result['NBest'][0]['Confidence']
+        speaker_display = speaker_displays[i]
 
-blob = block_blob_service.get_blob_to_text(transcription_container, args.blobname)
+        segment['OffsetInSeconds'] = segment_result['OffsetInSeconds']
+        segment['DurationInSeconds'] = segment_result['DurationInSeconds']
+        segment['Display'] = speaker_display
+
+        speaker_text = speaker_display.strip()
+        
+        # The segment index is the document id used to map the entities back
+        entities.append({"id": str(first_index + i), "language":"en","text": speaker_text})
+        speaker_texts.append(speaker_text)
+        
+        # Get sentiment from each segment or speaker sentence
+        segment['Sentiment'] = {}
+        segment['Sentiment']['Negative'] = segment_result['NBest'][0]['Sentiment']['Negative']
+        segment['Sentiment']['Positive'] = segment_result['NBest'][0]['Sentiment']['Positive']
+        segment['Sentiment']['Neutral'] = segment_result['NBest'][0]['Sentiment']['Neutral']
+
+        segments.append(segment)
+        segment = {}
+
+    # Extract entities (Person only) from sentences that contain entities
+    entities_by_document = batch_entity_extraction(textAnalyticsKey(), entities)
+
+    masked = []
+    for i, segment in enumerate(segments):
+        speaker_text = speaker_texts[i]
+
+        for index, match in enumerate(entities_by_document.get(str(first_index + i), [])):
+            if(match.Type.lower() == 'person'):
+                
+                segment["Entity" + str(index)] = [match.Type, match.Offset, match.Length]
+        
+        offsets = []
+        for key, value in segment.items():
+           
+            if 'Entity' in key:    
+                startIndex = value[1]
+                endIndex = startIndex + value[2]
+                offsets.append([startIndex,endIndex])
+            
+            
+        if len(offsets) > 0:
+            masked_speaker_text = maskMultipleEntities(speaker_text, offsets)
+            segment['Display'] = masked_speaker_text
+            masked.append((segment, masked_speaker_text))
+        else:
+            masked.append((segment, speaker_text))
 
+    return masked
 
 
 ##############################################################
 # 
-# Go through each relevant JSON nodes in blob.content input file
-# and construct the new output file containing the Display field
+# Go through each relevant JSON nodes in a parsed transcription
+# and construct the new output document containing the Display field
 # with masked entities and also containing entities and sentiment 
 # for each segment under the SegmentResults node 
+# The last segment is left out of the output.
+# The Summary of the call (see CallAnalytics.py) is added after the Display.
 #
 ##############################################################
 
-datastore = json.loads(blob.content)
+def maskDocument(datastore):
+    document = {}
+    segment_results = datastore['AudioFileResults'][0]['SegmentResults']
 
-document = {}
-display_text = []
-number_of_segments = len(datastore['AudioFileResults'][0]['SegmentResults'])
+    document['AudioFileName'] = datastore['AudioFileResults'][0]['AudioFileName']
+    document['AudioLengthInSeconds'] = datastore['AudioFileResults'][0]['AudioLengthInSeconds']
 
-document['AudioFileName'] = datastore['AudioFileResults'][0]['AudioFileName']
-document['AudioLengthInSeconds'] = datastore['AudioFileResults'][0]['AudioLengthInSeconds']
-document['SegmentResults'] = []
-segment = {}
+    masked = maskSegments(segment_results[:len(segment_results)-1])
 
-total_confidence_score = 0 
-total_sentiment_score = 0
+    document['SegmentResults'] = [segment for segment, display in masked]
+    document['Display'] = ' '.join(display for segment, display in masked)
+    if addSummary():
+        document['Summary'] = CallAnalytics.callSummary(document['SegmentResults'])
 
-replacements = {' one':'#','two':'#','three':'#','four':'#','five':'#','six':'#','seven':'#','eight':'#','nine':'#','zero':'#','1':'#','2':'#','3':'#','4':'#','5':'#','6':'#','7':'#','8':'#','9':'#','0':'#'}
+    return document
 
 
-for i in range(0,number_of_segments-1):
-    segment['SpeakerId'] = datastore['AudioFileResults'][0]['SegmentResults'][i]['ChannelNumber']
-    segment['Confidence'] = datastore['AudioFileResults'][0]['SegmentResults'][i]['NBest'][0]['Confidence']
-    speaker_display = datastore['AudioFileResults'][0]['SegmentResults'][i]['NBest'][0]['Display']
+##############################################################
+# 
+# Streaming version of maskDocument. Takes the header values and an
+# iterator over the SegmentResults of a transcription, masks the segments
+# `window` at a time and yields the masked document as pieces of JSON
+# text, the same text json.dumps gives for the document maskDocument
+# returns. The Display text of the whole call is spooled to a temporary
+# file (kept in memory up to spool_max_size characters) until the segments
+# have been written. The values the Summary needs are collected from every
+# segment on the way.
+#
+##############################################################
 
-    segment['OffsetInSeconds'] = datastore['AudioFileResults'][0]['SegmentResults'][i]['OffsetInSeconds']
-    segment['DurationInSeconds'] = datastore['AudioFileResults'][0]['SegmentResults'][i]['DurationInSeconds']
-    for src, target in replacements.items():
-        speaker_display = speaker_display.replace(src, target)
-    segment['Display'] = speaker_display
+STREAM_HEADER_KEYS = ("AudioFileName", "AudioLengthInSeconds")
+
+def segmentWindows(segment_results, window):
+    # The last segment is left out, as in maskDocument
+    batch = []
+    previous = None
+    for index, segment_result in enumerate(segment_results):
+        if index > 0:
+            batch.append(previous)
+            if len(batch) == window:
+                yield batch
+                batch = []
+        previous = segment_result
+    if batch:
+        yield batch
+
+
+def maskDocumentStream(header, segment_results, window=None, spool_max_size=None):
+    if window is None:
+        window = setting("masking", "segment_window", 1000)
+    if spool_max_size is None:
+        spool_max_size = setting("masking", "spool_max_size", 1024 * 1024)
+
+    yield '{"AudioFileName": ' + json.dumps(header['AudioFileName']) + \
+          ', "AudioLengthInSeconds": ' + json.dumps(header['AudioLengthInSeconds']) + ', "SegmentResults": ['
+
+    summary = CallAnalytics.SegmentArrays() if addSummary() else None
+    with tempfile.SpooledTemporaryFile(max_size=spool_max_size, mode='w+') as display_text:
+        first_index = 0
+        for batch in segmentWindows(segment_results, window):
+            for segment, display in maskSegments(batch, first_index):
+                if summary is not None:
+                    summary.add(segment)
+                # json.dumps escapes every character on its own, so the escaped
+                # pieces joined by spaces are the escaped joined Display
+                if first_index:
+                    display_text.write(' ')
+                    yield ', '
+                display_text.write(json.dumps(display)[1:-1])
+                yield json.dumps(segment)
+                first_index += 1
+
+        yield '], "Display": "'
+        display_text.seek(0)
+        while True:
+            text = display_text.read(64 * 1024)
+            if not text:
+                break
+            yield text
+        if summary is not None:
+            yield '", "Summary": ' + json.dumps(summary.summary()) + '}'
+        else:
+            yield '"}'
 
-    speaker_text = speaker_display.strip()
-    
-    entities = [{"id":"1", "language":"en","text": speaker_text}]
-    
-    # Get sentiment from each segment or speaker sentence
-    segment['Sentiment'] = {}
-    segment['Sentiment']['Negative'] = datastore['AudioFileResults'][0]['SegmentResults'][i]['NBest'][0]['Sentiment']['Negative']
-    segment['Sentiment']['Positive'] = datastore['AudioFileResults'][0]['SegmentResults'][i]['NBest'][0]['Sentiment']['Positive']
-    segment['Sentiment']['Neutral'] = datastore['AudioFileResults'][0]['SegmentResults'][i]['NBest'][0]['Sentiment']['Neutral']
 
-    
-    # Extract entities (Person only) from sentences that contain entities
-    entities_tables = entity_extraction(SUBSCRIPTION_KEY_ENV_NAME, entities)
-    #print(len(entities_tables.index))
-    for index, row in entities_tables.iterrows():
-        if(row['Type'].lower() == 'person'):
-            
-            segment["Entity" + str(index)] = [row['Type'], row['Offset'], row['Length']]
-            
-    document['SegmentResults'].append(segment)
-    
-    offsets = []
-    for key, value in segment.items():
-       
-        if 'Entity' in key:    
-            startIndex = value[1]
-            endIndex = startIndex + value[2]
-            offsets.append([startIndex,endIndex])
-        
-        
-    if len(offsets) > 0:
-        masked_speaker_text = maskMultipleEntities(speaker_text, offsets)
-        segment['Display'] = masked_speaker_text
-        display_text.append(masked_speaker_text)
-    else:
-        display_text.append(speaker_text)
-    segment = {}
-    
+##############################################################
+# 
+# Write the masked document next to the transcription it came from,
+# prefixed with Masked_ (or Error_ if it could not be written)
+#
+##############################################################
 
-document['Display'] = ' '.join(display_text)
+def saveMaskedDocument(storage, document, blobname, masked_target_folder):
+    blobname = blobname.split("/")[-1]
 
+    try:
 
-try:
+        document_bytes = json.dumps(document).encode("utf-8")
 
-    document_bytes = json.dumps(document).encode("utf-8")
+        masked_file_name = masked_target_folder + 'Masked_' + blobname
 
-    blobname = args.blobname.split("/")[-1]
 
-    masked_file_name = args.masked_target_folder + 'Masked_' + blobname
+        #Write JSON document containing masked transcriptions with entities and sentiment scores to storage
 
+        Compression.createBlobFromBytes(storage, transcriptionContainer(), masked_file_name, document_bytes)
 
-    #Write JSON document containing masked transcriptions with entities and sentiment scores to Blob Storage
+    except:
+        print("Could not obtain sentiment from transcription: ", blobname)
+        document_bytes = json.dumps(document).encode("utf-8")
+        masked_file_name = masked_target_folder + 'Error_' + blobname
+        Compression.createBlobFromBytes(storage, transcriptionContainer(), masked_file_name, document_bytes)
 
-    block_blob_service.create_blob_from_bytes(transcription_container, masked_file_name, document_bytes)
+    return masked_file_name
 
-except:
-    print("Could not obtain sentiment from transcription: ", args.blobname)
-    document_bytes = json.dumps(document).encode("utf-8")
-    blobname = args.blobname.split("/")[-1]
-    masked_file_name = args.masked_target_folder + 'Error_' + blobname
-    block_blob_service.create_blob_from_bytes(transcription_container, masked_file_name, document_bytes)
-    pass
 
+##############################################################
+# 
+# True for the Masked_ and Error_ files written by this script
+#
+##############################################################
+
+def isMaskingOutput(blobname):
+    return blobname.split("/")[-1].startswith(("Masked_", "Error_"))
 
 
+##############################################################
+# 
+# Mask one JSON transcription blob and write the result to Blob Storage.
+# Timed as the mask stage of Metrics.py.
+#
+##############################################################
+
+def maskTranscription(storage, blobname, masked_target_folder, streaming=None):
+    with Metrics.get_metrics().stage("mask"):
+        masked_file_name = maskTranscriptionBlob(storage, blobname, masked_target_folder, streaming)
+    Metrics.get_metrics().increment("transcripts_total", stage="mask")
+    return masked_file_name
+
+
+def maskTranscriptionBlob(storage, blobname, masked_target_folder, streaming=None):
+    if streaming is None:
+        streaming = setting("masking", "streaming", False)
+    if streaming:
+        try:
+            return maskTranscriptionStream(storage, blobname, masked_target_folder)
+        except TranscriptionStream.UnsupportedLayout as err:
+            print("Could not stream transcription " + blobname + ", reading it whole: {}".format(err))
+
+    datastore = json.loads(Compression.readBlobText(storage, transcriptionContainer(), blobname))
+
+    document = maskDocument(datastore)
+
+    return saveMaskedDocument(storage, document, blobname, masked_target_folder)
+
+
+##############################################################
+# 
+# Mask one JSON transcription blob without holding it in memory: the blob
+# is read read_chunk_size bytes at a time (and decompressed as it is read
+# when it is stored compressed) and the masked document is uploaded as it
+# is produced. Nothing is written if masking fails part
+# way, as the upload is only committed once the whole document is written.
+#
+##############################################################
+
+def maskTranscriptionStream(storage, blobname, masked_target_folder):
+    chunks = storage.stream(transcriptionContainer(), blobname, setting("masking", "read_chunk_size", 4 * 1024 * 1024))
+    header, segment_results = TranscriptionStream.openTranscription(Compression.decompressChunks(chunks), STREAM_HEADER_KEYS)
+
+    masked_file_name = masked_target_folder + 'Masked_' + blobname.split("/")[-1]
+    Compression.createBlobFromChunks(storage, transcriptionContainer(), masked_file_name,
+                                     (piece.encode("utf-8") for piece in maskDocumentStream(header, segment_results)))
+    return masked_file_name
+
+
+##############################################################
+# 
+# Mask a chunk of JSON transcription blobs. This is the unit of work handed
+# to the worker processes of MaskBlobTranscriptions.py, so it only returns
+# plain (blobname, masked file name, error) tuples and commits the entity
+# cache before returning, as worker processes do not run atexit handlers.
+#
+##############################################################
 
+def maskTranscriptions(blobnames, masked_target_folder):
+    storage = StorageBackends.get_storage_backend()
+    outcomes = []
+    for blobname in blobnames:
+        try:
+            outcomes.append((blobname, maskTranscription(storage, blobname, masked_target_folder), None))
+        except Exception as err:
+            outcomes.append((blobname, None, "{}".format(err)))
+    EntityCache.get_entity_cache().flush()
+    return outcomes
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("blobname")
+    parser.add_argument("masked_target_folder")
+    args = parser.parse_args()
 
+    storage = StorageBackends.get_storage_backend()
 
+    maskTranscription(storage, args.blobname, args.masked_target_folder)
@@ -1,192 +1,321 @@
 
-import requests
+import ServiceClients
+import TranscribeAudioFiles
+import RunLedger
+import ProcessingManifest
+import StorageBackends
+import Compression
+import Metrics
 import json
-import pandas as pd
 import time
+import random
+import asyncio
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from Configuration import setting
 
 
-config_file_name = "config.json"
-
-with open(config_file_name, 'r') as f:
-    configuration = json.load(f)
-
-account_name = configuration["storage"]["account_name"] 
-account_key = configuration["storage"]["account_key"] 
-transcription_container = configuration["storage"]["transcription_container"] 
-region = configuration["speech_api"]["region"]
+# Bytes read from a result Url at a time when it is copied to Blob Storage
+COPY_CHUNK_SIZE = 1024 * 1024
 
-BaseURL ="https://" + region + ".cris.ai/api/speechtotext/v2.1/transcriptions/"
 
-SUBSCRIPTION_KEY = configuration["speech_api"]["subscription_key"] 
+def transcriptionContainer():
+    return setting("storage", "transcription_container")
 
-container_name = configuration["storage"]["audio_container"]
-STORAGE_PATH="https://" + account_name + ".blob.core.windows.net/" + container_name + "/"
 
 ##############################################################
 # 
 # List all transcriptions currently in process of transcribing or that 
-# have either succeeded or failed transcribing.
+# have either succeeded or failed transcribing, get their result files and
+# delete them. These are shared with TranscribeAudioFiles.
 #
 ##############################################################
 
-
-def listAllTranscriptions() :
-    import datetime
-    df = pd.DataFrame(columns=["id","name", "status","createdDateTime","lastActionDateTime","CallDuration"])
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-    r = requests.get(BaseURL, headers=headers)
-    js = json.loads(r.text)
-    #print(js)
-    for TR in js:
-        if TR["status"] != "Succeeded" :
-            Dur="-"
-        else :
-            Dur = TR["properties"]["Duration"]
-        df = df.append({
-         "id":                  TR["id"],
-         "name":                TR["name"],
-         "status":              TR["status"],
-         "createdDateTime":     datetime.datetime.strptime(TR["createdDateTime"],"%Y-%m-%dT%H:%M:%SZ"),            
-         "lastActionDateTime":  datetime.datetime.strptime(TR["lastActionDateTime"],"%Y-%m-%dT%H:%M:%SZ"),
-         "CallDuration":            Dur      
-          }, ignore_index=True)
-        df["ProcTime"] = df["lastActionDateTime"] - df["createdDateTime"]
-        
-    return(df)
-
-def deleteAllTranscriptions() :
-   trs=listAllTranscriptions()
-   for x in trs["id"] :
-      print(x)
-      headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-      r = requests.delete(BaseURL+x, headers=headers)
-      print(r)
-
-def getTranscriptionFiles(TID) :
-    import datetime    
-    df = pd.DataFrame(columns=["TID","fileName", "resultUrl"])
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-    r = requests.get(BaseURL+TID, headers=headers)
-    js = json.loads(r.text)
-    #print(js)
-    for r in js["results"] :
-      for rurls in r["resultUrls"] :
-#        print(rurls["fileName"] +"," +rurls["resultUrl"])
-        df = df.append({
-         "TID":                      TID,
-         "fileName":                 rurls["fileName"],
-         "resultUrl":                rurls["resultUrl"]
-          }, ignore_index=True)
-    return(df)
-
-def getTranscription(df):
-    row=df.iloc[0,]
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-    r = requests.get(row["resultUrl"], headers=headers)
-    js = json.loads(r.text)
-    return(js)
+listTranscriptionRecords = TranscribeAudioFiles.listTranscriptionRecords
+listAllTranscriptions = TranscribeAudioFiles.listAllTranscriptions
+listTranscriptionFiles = TranscribeAudioFiles.listTranscriptionFiles
+getTranscriptionFiles = TranscribeAudioFiles.getTranscriptionFiles
+getTranscription = TranscribeAudioFiles.getTranscription
+getTranscriptionFromUrl = TranscribeAudioFiles.getTranscriptionFromUrl
+deleteAllTranscriptions = TranscribeAudioFiles.deleteAllTranscriptions
 
 def deleteTranscription(TID):
-      headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-      r = requests.delete(BaseURL+TID, headers=headers)
+      r = ServiceClients.get_speech_session().delete(TranscribeAudioFiles.speechURL("transcriptions")+TID)
       print(r)
       print(r.text)
 
-from azure.storage.blob import BlockBlobService
-block_blob_service = BlockBlobService(account_name=account_name, account_key=account_key)
+##############################################################
+# 
+# Logs a transcription in the run ledger (see RunLedger.py), which can
+# export the same CSV format with: python RunLedger.py export <file>
+#
+##############################################################
+
+def logTranscriptionRecord(record):
+    RunLedger.get_ledger().logTranscription(record.id, record.name, record.status, record.createdDateTime, record.lastActionDateTime, record.CallDuration, record.ProcTime)
+
 
 ##############################################################
 # 
-# Logs all transcriptions in a CSV file. Similar code can be build to
-# to log transcriptions in an Azure SQL db instance or any other datastore
+# Mark the recordings of a failed transcription as failed in the
+# processing manifest, so that they and their duplicates are submitted
+# again on the next run
 #
 ##############################################################
 
+def markRecordingsFailed(record):
+    for recording_url in record.recordingsUrls:
+        ProcessingManifest.get_manifest().markFailed(ProcessingManifest.TRANSCRIBE, audioBlobNameFromUrl(recording_url))
+
 
-def logTranscriptionToCSV(id, name, status, createdDateTime, lastActionDateTime, CallDuration, ProcTime):
-    df = pd.DataFrame(columns=["id","name", "status","createdDateTime","lastActionDateTime","CallDuration", "ProcTime"])
-    df = df.append({
-         "id":                  id,
-         "name":                name,
-         "status":              status,
-         "createdDateTime":     createdDateTime,            
-         "lastActionDateTime":  lastActionDateTime,
-         "CallDuration":        CallDuration,
-         "ProcTime":            ProcTime     
-          }, ignore_index=True)
-    
-    with open('TranscriptionsLog.csv', 'a') as f:
-        df.to_csv(f, header=False)
+##############################################################
+# 
+# Track a set of pending transcription ids and hand each one back as soon
+# as it has Succeeded or Failed. The polling interval starts at
+# min_interval, doubles (up to max_interval) after every poll in which
+# nothing completed and goes back to min_interval when something did.
+# A random jitter is added to every wait so that several runs do not
+# poll the service in lockstep. A poll that fails, after the retries of
+# RateLimiter.py, counts as a poll in which nothing completed. The
+# intervals default to poll_min_interval and poll_max_interval in the
+# batch_config section of config.json.
+#
+##############################################################
+
+class TranscriptionPoller:
+
+    def __init__(self, transcription_ids=(), min_interval=None, max_interval=None, backoff=2, jitter=0.1):
+        if min_interval is None:
+            min_interval = setting("batch_config", "poll_min_interval", 5)
+        if max_interval is None:
+            max_interval = setting("batch_config", "poll_max_interval", 60)
+        self.pending = set()
+        self.add(transcription_ids)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.interval = min_interval
+        self.completed_count = 0
+
+    def add(self, transcription_ids):
+        # a submission that returned no id can never complete
+        self.pending.update(transcription_id for transcription_id in transcription_ids if transcription_id is not None)
+
+    def poll(self):
+        completed_rows = [record for record in listTranscriptionRecords()
+                          if record.id in self.pending and record.status in ("Succeeded", "Failed")]
+        for row in completed_rows:
+            self.pending.discard(row.id)
+        self.completed_count += len(completed_rows)
+        Metrics.get_metrics().increment("poll_iterations_total")
+        Metrics.get_metrics().gauge("transcriptions_pending", len(self.pending))
+        return completed_rows
+
+    def wait(self, completed_rows):
+        if completed_rows:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        time.sleep(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def completed(self):
+        while self.pending:
+            try:
+                completed_rows = self.poll()
+            except requests.RequestException as err:
+                # the jobs are still running, so they are polled again at the next interval
+                print("Could not list transcriptions: {}".format(err))
+                completed_rows = []
+            print("Completed transcriptions: ", self.completed_count, " pending: ", len(self.pending))
+            for row in completed_rows:
+                yield row
+            if self.pending:
+                self.wait(completed_rows)
+
+
+def pollTranscriptions(transcription_ids, on_complete=None):
+    for row in TranscriptionPoller(transcription_ids).completed():
+        if on_complete is not None:
+            on_complete(row)
+        yield row
 
 
 ##############################################################
 # 
-# Iterate through the transcription process list to check if a transcription has Succeeded or Failed.
-# For those that have succeeded transcribing obtain the JSON content and save it
-# to the destination container / folder in Azure storage
+# Wait for the given transcriptions to Succeed or Fail. As soon as one has
+# succeeded transcribing obtain the JSON content and save it to the
+# destination container / folder in storage, while the others are
+# still being polled.
 #
 ##############################################################
 
 def getTranscriptionsContent(transcription_ids, json_target_folder):
 
-    list_of_transcription_ids = transcription_ids
+    saved_files, saved_count = asyncio.run(retrieveTranscriptions(pollTranscriptions(transcription_ids), json_target_folder))
+    file_counter = len(saved_files)
+    RunLedger.get_ledger().flush()
+    # every API call of the run so far, see Metrics.py
+    print("Saved transcriptions: ", file_counter, " API calls per transcript: ",
+          Metrics.get_metrics().asdict()["api_requests_per_transcript"])
+    return saved_files
+
+
+##############################################################
+# 
+# Get the JSON content of every recording in one succeeded transcription,
+# together with the name of the JSON file it is saved as in the destination
+# folder
+#
+##############################################################
 
-    completed = False
-    number_of_api_calls = 0
-    # while not completed:
+def audioBlobNameFromUrl(recording_url):
+    return StorageBackends.recordingName(StorageBackends.get_storage_backend(), setting("storage", "audio_container"), recording_url)
 
-    counter = 0
+def audioBlobName(json_data):
+    return audioBlobNameFromUrl(json_data['AudioFileResults'][0]['AudioFileUrl'])
 
-    transcriptions_df = listAllTranscriptions()
-    
-    number_of_rows = len(list_of_transcription_ids)
+def jsonFileName(audio_blob_name, json_target_folder):
+    file_name = audio_blob_name.split('/')[-1]
+    return json_target_folder + file_name.split('.')[0] + ".json"
+
+def transcriptionFileName(json_data, json_target_folder):
+    return jsonFileName(audioBlobName(json_data), json_target_folder)
+
+def fetchTranscriptions(transcription_id, json_target_folder):
+    # get the link to the actual files of the transcription
+    for transcription_file in listTranscriptionFiles(transcription_id):
+        # get the actual JSON contents from the transcription
+        transcription_json = getTranscriptionFromUrl(transcription_file.resultUrl)
+        yield transcriptionFileName(transcription_json, json_target_folder), transcription_json
 
-    while counter != number_of_rows:
-        counter = 0
-        for index, row in transcriptions_df.iterrows():
-            if counter == number_of_rows:
-                break
-            for transcription_id in list_of_transcription_ids:
-
-                if row["id"] == transcription_id and row["status"] in ("Succeeded","Failed"):
-                    counter += 1
-                    
-        time.sleep(15)
-        print("Completed transcriptions: ", counter)
-        transcriptions_df = listAllTranscriptions()
-    
-
-
-    file_counter = 0
-    for index, row in transcriptions_df.iterrows():
-
-        if row["id"] in (list_of_transcription_ids) and row["status"] == 'Succeeded':
-
-
-            logTranscriptionToCSV(row["id"], row["name"], row["status"], row["createdDateTime"], row["lastActionDateTime"], row["CallDuration"], row["ProcTime"])
-            # if transcription has succeeded get the id 
-            transcription_id = row["id"]
-            # get the link to the actual files of the transcription
-            number_of_api_calls += 1
-            trans_files_df = getTranscriptionFiles(transcription_id)
-            # get the actual JSON contents from the transcription
-            number_of_api_calls += 1
-            transcription_json = getTranscription(trans_files_df)
-            transcription_json_dump = json.dumps(transcription_json)
-            json_data = json.loads(transcription_json_dump)
-            file_name = json_data['AudioFileResults'][0]['AudioFileUrl']
-            file_name = file_name.split("?")[0]
-            file_name = file_name[len(STORAGE_PATH):]
-            file_name = file_name.split('/')[-1]
-            file_name = json_target_folder + file_name.split('.')[0] + ".json"
-            print("Saving file: " + file_name + " to blob storage container: " + transcription_container)
-            # convert the JSON contents to a byte array
-            json_to_bytes = transcription_json_dump.encode("utf-8")
-         
-
-            block_blob_service.create_blob_from_bytes(transcription_container, file_name, json_to_bytes)
-            deleteTranscription(transcription_id)
-            file_counter += 1
-        elif row["id"] in (list_of_transcription_ids) and row["status"] == 'Failed':
-            logTranscriptionToCSV(row["id"], row["name"], row["status"], row["createdDateTime"], row["lastActionDateTime"], row["CallDuration"], row["ProcTime"])
 
+##############################################################
+# 
+# Save the JSON content of every recording in one succeeded transcription
+# to the destination container / folder in storage and delete the
+# transcription from the Speech service. Timed as the retrieve stage of
+# Metrics.py.
+#
+##############################################################
+
+def saveTranscription(transcription_id, json_target_folder, passthrough=None):
+    with Metrics.get_metrics().stage("retrieve"):
+        saved_files = retrieveTranscription(transcription_id, json_target_folder, passthrough)
+    Metrics.get_metrics().increment("transcripts_total", len(saved_files), stage="retrieve")
+    return saved_files
+
+
+def retrieveTranscription(transcription_id, json_target_folder, passthrough=None):
+    if passthrough is None:
+        passthrough = setting("batch_config", "passthrough", False)
+    if passthrough:
+        return copyTranscription(transcription_id, json_target_folder)
+
+    saved_files = []
+    for file_name, transcription_json in fetchTranscriptions(transcription_id, json_target_folder):
+        print("Saving file: " + file_name + " to blob storage container: " + transcriptionContainer())
+        # convert the JSON contents to a byte array
+        json_to_bytes = json.dumps(transcription_json).encode("utf-8")
+
+        Compression.createBlobFromBytes(StorageBackends.get_storage_backend(), transcriptionContainer(), file_name, json_to_bytes)
+        ProcessingManifest.get_manifest().markDone(ProcessingManifest.TRANSCRIBE, audioBlobName(transcription_json), file_name)
+        saved_files.append(file_name)
+    deleteTranscription(transcription_id)
+    return saved_files
+
+
+##############################################################
+# 
+# Same as saveTranscription without parsing the results: the body of each
+# result Url is streamed to storage as it is downloaded, and saved under
+# the same name, taken from the Url of the recording the service
+# transcribed. Only when the service does not tell which recording a
+# result is for is it saved under the transcription id followed by the
+# fileName of the result (names such as channel_0.json repeat in every
+# transcription), and the recording is not marked as transcribed.
+#
+##############################################################
+
+def passthroughFileName(transcription_file, json_target_folder):
+    if transcription_file.recordingUrl is None:
+        return jsonFileName(transcription_file.TID + "_" + transcription_file.fileName.split('/')[-1], json_target_folder)
+    return jsonFileName(audioBlobNameFromUrl(transcription_file.recordingUrl), json_target_folder)
+
+def copyTranscription(transcription_id, json_target_folder):
+    saved_files = []
+    for transcription_file in listTranscriptionFiles(transcription_id):
+        file_name = passthroughFileName(transcription_file, json_target_folder)
+        print("Saving file: " + file_name + " to blob storage container: " + transcriptionContainer())
+
+        with ServiceClients.get_speech_session().get(transcription_file.resultUrl, stream=True) as r:
+            r.raise_for_status()
+            Compression.createBlobFromChunks(StorageBackends.get_storage_backend(), transcriptionContainer(), file_name,
+                                             r.iter_content(COPY_CHUNK_SIZE))
+
+        if transcription_file.recordingUrl is not None:
+            ProcessingManifest.get_manifest().markDone(
+                ProcessingManifest.TRANSCRIBE, audioBlobNameFromUrl(transcription_file.recordingUrl), file_name)
+        saved_files.append(file_name)
+    deleteTranscription(transcription_id)
+    return saved_files
+
+
+##############################################################
+# 
+# Run saveTranscription for many succeeded transcriptions at once, at most
+# `concurrency` (by default batch_config.retrieval_concurrency) at a time.
+# `rows` can be a list or a blocking iterator such
+# as pollTranscriptions, in which case each transcription is retrieved as
+# soon as the iterator hands it over. Failed transcriptions are logged and their
+# recordings marked as failed (see markRecordingsFailed).
+# A transcription that cannot be retrieved is reported and skipped so that
+# the rest of the batch is still saved. Returns the names of the files that
+# were saved and the number of files saved. With
+# keep_files=False the names are not kept (an empty list is returned), so
+# that a long running ingestion does not hold on to every name.
+#
+##############################################################
+
+async def retrieveTranscriptions(rows, json_target_folder, concurrency=None, keep_files=True):
+    if concurrency is None:
+        concurrency = setting("batch_config", "retrieval_concurrency", 8)
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    rows = iter(rows)
+    saved_files = []
+    saved_count = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, ThreadPoolExecutor(max_workers=1) as poll_executor:
+
+        async def retrieve(row):
+            nonlocal saved_count
+            async with semaphore:
+                logTranscriptionRecord(row)
+                try:
+                    file_names = await loop.run_in_executor(executor, saveTranscription, row.id, json_target_folder)
+                except Exception as err:
+                    print("Could not retrieve transcription " + row.id + ": {}".format(err))
+                    return
+                saved_count += len(file_names)
+                if keep_files:
+                    saved_files.extend(file_names)
+
+        # only the retrievals still running are kept
+        tasks = set()
+        while True:
+            row = await loop.run_in_executor(poll_executor, next, rows, None)
+            if row is None:
+                break
+            if row.status == 'Succeeded':
+                task = asyncio.ensure_future(retrieve(row))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                Metrics.get_metrics().gauge("queue_depth", len(tasks), queue="retrieve")
+            else:
+                logTranscriptionRecord(row)
+                markRecordingsFailed(row)
+
+        await asyncio.gather(*tasks)
+
+    return saved_files, saved_count
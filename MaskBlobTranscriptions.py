@@ -4,57 +4,200 @@
 # Date: 30/03/2020
 # 
 # Python script that traverses through the JSON transcriptions
-# and passes each to EntitiySentimentMask.py for extracting
-# entities and sentiment and masking those entities which can be
-# PII data
+# and passes each to EntitiySentimentMask.maskTranscription for
+# extracting entities and sentiment and masking those entities
+# which can be PII data. The blobs are masked in this process, or in
+# chunks of chunk_size blobs by a pool of worker processes when more than
+# one worker is configured. With --shard i/N only the blobs in shard i of
+# N (see Sharding.py) are masked, so that several machines can work
+# through one container.
 #
 ##############################################################
 
-from azure.storage.blob import BlockBlobService
-import subprocess
+import StorageBackends
 import argparse
-import json
+import itertools
+import EntitySentimentMask
+import RunLedger
+import ProcessingManifest
+import EntityCache
+import Sharding
+import Metrics
+import RateLimiter
+import multiprocessing
+from Configuration import setting
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 
-config_file_name = "config.json"
+##############################################################
+# 
+# List the transcriptions to mask in the storage backend (see
+# StorageBackends.py) as (blob name, etag, content hash),
+# leaving out the files this script wrote, the blobs of other shards and,
+# unless forced, the unchanged transcriptions it already masked (which
+# are added to `skipped`)
+#
+##############################################################
+
+def transcriptionsToMask(storage, nonmasked_source_folder, force=False, shard=None, skipped=None):
+    manifest = ProcessingManifest.get_manifest()
+    for blob in storage.list(setting("storage", "transcription_container"), nonmasked_source_folder):
+        file_name = blob.name
+        if EntitySentimentMask.isMaskingOutput(file_name) or not Sharding.inShard(file_name, shard):
+            continue
+        etag, content_hash = ProcessingManifest.blobVersion(blob)
+        if not force:
+            process, reason = manifest.shouldProcess(ProcessingManifest.MASK, file_name, etag, content_hash)
+            if not process:
+                if skipped is not None:
+                    skipped.append(file_name)
+                continue
+        yield file_name, etag, content_hash
+
 
+def chunked(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+##############################################################
+# 
+# Mask the chunks of blob names in this process, or spread them over a pool
+# of worker processes with at most two chunks per worker waiting, so that
+# listing a large container does not queue up every blob name at once.
+# The workers are spawned rather than forked so that they do not share the
+# connections of this process. The workers share the same keys, so each
+# one takes 1/workers of the rate limits of RateLimiter.py. Each worker
+# hands its metrics back with every chunk, so that they are exported
+# together with those of this process.
+# Both yield (blob name, masked file name, error) as the blobs are done.
+#
+##############################################################
 
-parser = argparse.ArgumentParser()
-parser.add_argument("nonmasked_source_folder")
-parser.add_argument("masked_target_folder")
-args = parser.parse_args()
+def maskInProcess(chunks, masked_target_folder):
+    for chunk in chunks:
+        for outcome in EntitySentimentMask.maskTranscriptions(chunk, masked_target_folder):
+            yield outcome
 
-with open(config_file_name, 'r') as f:
-	configuration = json.load(f)
 
- 
-account_name = configuration["storage"]["account_name"] 
-account_key = configuration["storage"]["account_key"] 
-transcription_container = configuration["storage"]["transcription_container"] 
-SAS = configuration["storage"]["SAS"] 
+def maskChunk(blobnames, masked_target_folder):
+    outcomes = EntitySentimentMask.maskTranscriptions(blobnames, masked_target_folder)
+    # the profiles of a worker are written by the worker
+    Metrics.get_metrics().writeProfiles(Metrics.metrics_configuration()["profile_dir"])
+    return outcomes, Metrics.get_metrics().drain()
 
 
+def maskInPool(chunks, masked_target_folder, workers):
 
+    def outcomes(future):
+        chunk_outcomes, metrics = future.result()
+        Metrics.get_metrics().merge(metrics)
+        return chunk_outcomes
 
-blob_service = BlockBlobService(account_name, account_key)
-generator = blob_service.list_blobs(transcription_container,prefix=args.nonmasked_source_folder) 
-print(18*"#" + "Extract Entities" + 18*"#")
-print(16*"#" + "Sentiment Analysis" + 16*"#")
-print(19*"#" + "Mask Entities" + 18*"#")
+    # the workers share the rate limits of the keys
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=RateLimiter.shareLimits, initargs=(workers,)) as executor:
+        futures = set()
+        for chunk in chunks:
+            futures.add(executor.submit(maskChunk, chunk, masked_target_folder))
+            Metrics.get_metrics().gauge("queue_depth", len(futures), queue="mask_chunks")
+            if len(futures) >= 2 * workers:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for outcome in outcomes(future):
+                        yield outcome
+        for future in futures:
+            for outcome in outcomes(future):
+                yield outcome
 
 
 ##############################################################
 # 
-# Initialize the variables for our storage account by reading the values
-# provided in the config.json file
+# Mask every transcription in the source folder that was not masked yet
+# (or every one with force) to the target folder, log each outcome in the
+# run ledger and mark the masked ones done in the processing manifest.
+# workers and chunk_size default to those of the masking section of
+# config.json. Returns the names of the blobs that were masked, skipped
+# and that failed.
 #
 ##############################################################
 
-for blob in generator:
-    file_name = blob.name
-    print("## Processing blob: ", file_name)
-    print("## Extracting Entities, Sentiment and Masking Entities...")
+def maskBlobs(nonmasked_source_folder, masked_target_folder, force=False, workers=None, chunk_size=None, shard=None):
+    # Number of worker processes masking transcriptions and number of blobs handed to a worker at a time
+    if workers is None:
+        workers = setting("masking", "workers", 1)
+    if chunk_size is None:
+        chunk_size = setting("masking", "chunk_size", 8)
+
+    storage = StorageBackends.get_storage_backend()
+    manifest = ProcessingManifest.get_manifest()
+    succeeded = []
+    failed = []
+    skipped = []
+    versions = {}
+
+    def dispatched(transcriptions):
+        for file_name, etag, content_hash in transcriptions:
+            versions[file_name] = (etag, content_hash)
+            print("## Processing blob: ", file_name)
+            print("## Extracting Entities, Sentiment and Masking Entities...")
+            yield file_name
+
+    chunks = chunked(dispatched(transcriptionsToMask(storage, nonmasked_source_folder, force, shard, skipped)), chunk_size)
+    if workers > 1:
+        outcomes = maskInPool(chunks, masked_target_folder, workers)
+    else:
+        outcomes = maskInProcess(chunks, masked_target_folder)
+
+    for file_name, masked_file_name, error in outcomes:
+        etag, content_hash = versions.pop(file_name)
+
+        if error is not None:
+            print("## " + file_name + " failed: " + error)
+            RunLedger.get_ledger().logMasking(file_name, None, "Failed", error)
+            failed.append(file_name)
+            continue
+
+        if masked_file_name.split("/")[-1].startswith("Error_"):
+            print("## " + file_name + " failed, partial output written to " + masked_file_name)
+            RunLedger.get_ledger().logMasking(file_name, masked_file_name, "Error")
+            failed.append(file_name)
+            continue
+
+        print("## " + file_name + " processsed successfully to " + masked_file_name)
+        RunLedger.get_ledger().logMasking(file_name, masked_file_name, "Masked")
+        manifest.markDone(ProcessingManifest.MASK, file_name, masked_file_name, etag, content_hash)
+        succeeded.append(file_name)
+
+    RunLedger.get_ledger().flush()
+
+    print("## Masked transcriptions: ", len(succeeded))
+    print("## Skipped, already masked: ", len(skipped))
+    if workers <= 1:
+        print("## Entity cache: ", EntityCache.get_entity_cache().stats())
+    print("## Failed transcriptions: ", len(failed))
+    for file_name in failed:
+        print("##   ", file_name)
+    return succeeded, skipped, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nonmasked_source_folder")
+    parser.add_argument("masked_target_folder")
+    parser.add_argument("--force", action="store_true", help="mask transcriptions that were already masked")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--chunk_size", type=int, default=None, help="number of blobs handed to a worker at a time")
+    parser.add_argument("--shard", type=Sharding.parseShard, default=None, help="only mask shard i of N, e.g. 0/4")
+    args = parser.parse_args()
+
+    print(18*"#" + "Extract Entities" + 18*"#")
+    print(16*"#" + "Sentiment Analysis" + 16*"#")
+    print(19*"#" + "Mask Entities" + 18*"#")
 
-    subprocess.call("python EntitySentimentMask.py " + file_name + " " + args.masked_target_folder, shell=True)
-    print("## " + file_name + " processsed successfully!")
-	    
+    maskBlobs(args.nonmasked_source_folder, args.masked_target_folder, args.force, args.workers, args.chunk_size, args.shard)
+    Metrics.get_metrics().export()
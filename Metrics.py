@@ -0,0 +1,298 @@
+##############################################################
+#
+# Python script with the metrics every stage of the pipeline records
+# while it runs, shared by the whole process:
+#
+#   counters    e.g. api_requests_total{api, endpoint, status},
+#               transcripts_total{stage}, poll_iterations_total,
+#               bytes_sent_total{api}, bytes_received_total{api}
+#   gauges      e.g. queue_depth{queue}, transcriptions_pending, with the
+#               highest value seen kept as <name>_max
+#   histograms  e.g. api_request_seconds{api, endpoint},
+#               stage_seconds{stage}, with the latency buckets of BUCKETS
+#
+# They are written when a script finishes to metrics.path of config.json,
+# as Prometheus text when the file ends in .prom or .txt and as JSON
+# otherwise. Nothing is written when the path is empty.
+#
+# Profiling is opt-in: the stages listed in metrics.profile_stages are run
+# under cProfile or tracemalloc (metrics.profiler) and their profiles are
+# written to metrics.profile_dir as <stage>-<pid>.prof (read them with
+# python -m pstats) or <stage>-<pid>.tracemalloc.txt. tracemalloc traces
+# the whole process, so the allocations of threads running other stages
+# at the same time are included.
+#
+##############################################################
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+from Configuration import get_configuration
+
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+DEFAULT_METRICS_CONFIGURATION = {
+    "path": "",
+    "profile_stages": [],
+    "profiler": "cprofile",
+    "profile_dir": "profiles"
+}
+
+
+def metrics_configuration():
+    metrics = dict(DEFAULT_METRICS_CONFIGURATION)
+    metrics.update(get_configuration().get("metrics", {}))
+    return metrics
+
+
+def labelKey(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, total, count):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.profiles = {}
+        self.local = threading.local()
+        self.tracing = set()
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, labelKey(labels))] += value
+
+    def gauge(self, name, value, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            self.gauges[(name, key)] = value
+            self.gauges[(name + "_max", key)] = max(value, self.gauges.get((name + "_max", key), value))
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            key = (name, labelKey(labels))
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    ##############################################################
+    #
+    # Time one run of a stage, counting it in stage_seconds{stage}, and
+    # profile it when the stage is in metrics.profile_stages
+    #
+    ##############################################################
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        with self.timer("stage_seconds", stage=stage), self.profiled(stage):
+            yield
+
+    @contextlib.contextmanager
+    def profiled(self, stage):
+        configuration = metrics_configuration()
+        active = getattr(self.local, "active", None)
+        if stage not in configuration["profile_stages"] or active is not None:
+            # only one profiler can run in a thread, and a stage run inside
+            # another profiled stage is already in its profile
+            yield
+            return
+        self.local.active = stage
+        try:
+            if configuration["profiler"] == "tracemalloc":
+                import tracemalloc
+                with self.lock:
+                    self.tracing.add(stage)
+                    if not tracemalloc.is_tracing():
+                        tracemalloc.start(25)
+                yield
+            else:
+                import cProfile
+                # cProfile only sees the thread it is enabled in, so every thread has its own
+                with self.lock:
+                    profile = self.profiles.setdefault((stage, threading.get_ident()), cProfile.Profile())
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+        finally:
+            self.local.active = None
+
+    def writeProfiles(self, profile_dir):
+        # the profiles so far, written again in full every time
+        with self.lock:
+            profiles = collections.defaultdict(list)
+            for (stage, thread), profile in self.profiles.items():
+                profiles[stage].append(profile)
+            tracing = set(self.tracing)
+        if not profiles and not tracing:
+            return
+        os.makedirs(profile_dir, exist_ok=True)
+        for stage, stage_profiles in profiles.items():
+            import pstats
+            stats = pstats.Stats(*stage_profiles)
+            stats.dump_stats(os.path.join(profile_dir, "{}-{}.prof".format(stage, os.getpid())))
+        if tracing:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            for stage in tracing:
+                with open(os.path.join(profile_dir, "{}-{}.tracemalloc.txt".format(stage, os.getpid())), "w") as f:
+                    f.write("current {} bytes, peak {} bytes\n".format(current, peak))
+                    for statistic in snapshot.statistics("lineno")[:50]:
+                        f.write(str(statistic) + "\n")
+                self.gauge("traced_memory_peak_bytes", peak, stage=stage)
+
+    ##############################################################
+    #
+    # Hand the metrics of a worker process to the main process: drain()
+    # returns them and starts again from zero, merge() adds them in
+    #
+    ##############################################################
+
+    def drain(self):
+        with self.lock:
+            snapshot = {
+                "counters": [[name, list(key), value] for (name, key), value in self.counters.items()],
+                "gauges": [[name, list(key), value] for (name, key), value in self.gauges.items()],
+                "histograms": [[name, list(key), histogram.counts, histogram.sum, histogram.count]
+                               for (name, key), histogram in self.histograms.items()]
+            }
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, key, value in snapshot["counters"]:
+                self.counters[(name, tuple(map(tuple, key)))] += value
+            for name, key, value in snapshot["gauges"]:
+                key = (name, tuple(map(tuple, key)))
+                self.gauges[key] = max(value, self.gauges[key]) if name.endswith("_max") and key in self.gauges else value
+            for name, key, counts, total, count in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, key)))
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram()
+                self.histograms[key].merge(counts, total, count)
+
+    ##############################################################
+    #
+    # Export as JSON or as the Prometheus text format
+    #
+    ##############################################################
+
+    def asdict(self):
+        with self.lock:
+            counters = [{"name": name, "labels": dict(key), "value": value} for (name, key), value in sorted(self.counters.items())]
+            gauges = [{"name": name, "labels": dict(key), "value": value} for (name, key), value in sorted(self.gauges.items())]
+            histograms = [{"name": name, "labels": dict(key), "count": histogram.count, "sum": histogram.sum,
+                           "mean": histogram.sum / histogram.count if histogram.count else None,
+                           "buckets": dict(zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts))}
+                          for (name, key), histogram in sorted(self.histograms.items())]
+        requests = sum(counter["value"] for counter in counters if counter["name"] == "api_requests_total")
+        transcripts = sum(counter["value"] for counter in counters if counter["name"] == "transcripts_total")
+        return {
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+            "api_requests_per_transcript": requests / transcripts if transcripts else None
+        }
+
+    def json(self):
+        return json.dumps(self.asdict(), indent=2)
+
+    def prometheus(self):
+        def labelText(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                declared = set()
+                for (name, key), value in sorted(values.items()):
+                    if name not in declared:
+                        lines.append("# TYPE {} {}".format(name, kind))
+                        declared.add(name)
+                    lines.append("{}{} {}".format(name, labelText(key), value))
+            declared = set()
+            for (name, key), histogram in sorted(self.histograms.items()):
+                if name not in declared:
+                    lines.append("# TYPE {} histogram".format(name))
+                    declared.add(name)
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(name, labelText(key, [("le", bound)]), cumulative))
+                lines.append("{}_sum{} {}".format(name, labelText(key), histogram.sum))
+                lines.append("{}_count{} {}".format(name, labelText(key), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=None):
+        """Write the metrics and profiles as configured, returning the metrics file name or None"""
+        configuration = metrics_configuration()
+        self.writeProfiles(configuration["profile_dir"])
+        path = path or configuration["path"]
+        if not path:
+            return None
+        with open(path, "w") as f:
+            f.write(self.prometheus() if path.endswith((".prom", ".txt")) else self.json())
+        print("Metrics written to " + path)
+        return path
+
+
+##############################################################
+#
+# The metrics of this process
+#
+##############################################################
+
+metrics = None
+metrics_lock = threading.Lock()
+
+def get_metrics():
+    global metrics
+    with metrics_lock:
+        if metrics is None:
+            metrics = Metrics()
+    return metrics
@@ -0,0 +1,463 @@
+##############################################################
+#
+# Python script with local stand-ins for the services the scripts call,
+# used by benchmark.py to measure the pipeline offline:
+#
+#   /speech/...  Speech batch transcription v2.1 (transcriptions, endpoints
+#                and the result files of succeeded jobs)
+#   /text/...    Text Analytics v2.1 entities
+#   /blob/...    Blob Storage (list, get with ranges, properties, put,
+#                put block and put block list)
+#
+# All three are served by one threaded HTTP server on 127.0.0.1. The
+# scripts are pointed at it with the speech_api.endpoint,
+# text_api.endpoint and storage.blob_endpoint settings (see endpoints()).
+#
+# Every request waits `latency` seconds (give or take `jitter`) and is
+# answered with a 429 or an error_status error with probability
+# throttle_rate and error_rate. Transcription jobs run for job_seconds
+# (give or take `jitter`) and fail with probability failed_rate. The
+# transcription of each recording is generated by syntheticTranscription,
+# with between min_segments and max_segments segments.
+#
+# Requests, and bytes sent and received, are counted per call type.
+#
+##############################################################
+
+import base64
+import collections
+import email.utils
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+
+FIRST_NAMES = ("John", "Mary", "Ahmed", "Sofia", "Liam", "Olivia", "Chen", "Priya", "Lucas", "Emma")
+SURNAMES = ("Smith", "Jones", "Khan", "Garcia", "Brown", "Patel", "Wilson", "Martin")
+WORDS = ("thank", "you", "for", "calling", "the", "account", "payment", "is", "due", "on", "my", "card",
+         "number", "please", "can", "I", "help", "with", "your", "order", "today", "we", "will", "send",
+         "a", "new", "one", "and", "it", "should", "arrive", "by", "next", "week", "sorry", "about", "that")
+NAME_PATTERN = re.compile(r"\b(?:" + "|".join(FIRST_NAMES) + r")(?: (?:" + "|".join(SURNAMES) + r"))?\b")
+
+
+##############################################################
+#
+# Synthetic transcriptions
+#
+##############################################################
+
+def syntheticSentence(rng):
+    words = [rng.choice(WORDS) for i in range(rng.randint(4, 18))]
+    if rng.random() < 0.3:
+        name = rng.choice(FIRST_NAMES)
+        if rng.random() < 0.5:
+            name += " " + rng.choice(SURNAMES)
+        words.insert(rng.randint(0, len(words)), "this is " + name)
+    if rng.random() < 0.2:
+        words.insert(rng.randint(0, len(words)), str(rng.randint(1000, 99999999)))
+    sentence = " ".join(words)
+    return sentence[0].upper() + sentence[1:] + "."
+
+
+def syntheticSegment(rng, offset, duration, channel):
+    display = syntheticSentence(rng)
+    lexical = display.lower().rstrip(".")
+    negative = round(rng.random() * 0.5, 6)
+    positive = round(rng.random() * (1 - negative), 6)
+    return {
+        "RecognitionStatus": "Success",
+        "ChannelNumber": str(channel),
+        "SpeakerId": None,
+        "Offset": int(offset * 10000000),
+        "Duration": int(duration * 10000000),
+        "OffsetInSeconds": round(offset, 2),
+        "DurationInSeconds": round(duration, 2),
+        "NBest": [{
+            "Confidence": round(rng.uniform(0.6, 0.99), 7),
+            "Lexical": lexical,
+            "ITN": lexical,
+            "MaskedITN": lexical,
+            "Display": display,
+            "Sentiment": {"Negative": negative, "Neutral": round(1 - negative - positive, 6), "Positive": positive},
+            "Words": None
+        }]
+    }
+
+
+def syntheticTranscription(audio_url, seed, min_segments=20, max_segments=400):
+    """The v2.1 result document of one recording, always the same for the same seed"""
+    rng = random.Random(seed)
+    segments = []
+    offset = 0.0
+    channel = 0
+    for i in range(rng.randint(min_segments, max_segments)):
+        offset += rng.uniform(0, 1.5)
+        duration = rng.uniform(1, 12)
+        segments.append(syntheticSegment(rng, offset, duration, channel))
+        offset += duration
+        if rng.random() < 0.7:
+            channel = 1 - channel
+    file_name = urllib.parse.unquote(audio_url.split("?")[0].split("/")[-1])
+    return {
+        "AudioFileResults": [{
+            "AudioFileName": file_name,
+            "AudioFileUrl": audio_url,
+            "AudioLengthInSeconds": round(offset, 2),
+            "CombinedResults": [{"ChannelNumber": None, "Lexical": "", "ITN": "", "MaskedITN": "", "Display": ""}],
+            "SegmentResults": segments
+        }]
+    }
+
+
+##############################################################
+#
+# State of the stand-in services, shared by the request handlers
+#
+##############################################################
+
+class MockState:
+
+    def __init__(self, latency=0.0, jitter=0.2, job_seconds=2.0, throttle_rate=0.0, error_rate=0.0,
+                 error_status=503, failed_rate=0.0, min_segments=20, max_segments=400, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.job_seconds = job_seconds
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.failed_rate = failed_rate
+        self.min_segments = min_segments
+        self.max_segments = max_segments
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        # container -> blob name -> (content, etag, last modified)
+        self.containers = collections.defaultdict(dict)
+        # (container, blob name) -> Content-Encoding the blob was stored with
+        self.encodings = {}
+        self.blocks = {}
+        self.calls = collections.Counter()
+        self.bytes_in = collections.Counter()
+        self.bytes_out = collections.Counter()
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def varied(self, seconds):
+        with self.lock:
+            return seconds * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def count(self, call, bytes_in, bytes_out):
+        with self.lock:
+            self.calls[call] += 1
+            self.bytes_in[call] += bytes_in
+            self.bytes_out[call] += bytes_out
+
+    def counts(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.bytes_in.clear()
+            self.bytes_out.clear()
+
+    def putBlob(self, container_name, blob_name, content, content_encoding=None):
+        with self.lock:
+            self.containers[container_name][blob_name] = (content, '"0x' + uuid.uuid4().hex[:15].upper() + '"',
+                                                          email.utils.formatdate(usegmt=True))
+            self.encodings[(container_name, blob_name)] = content_encoding
+
+    def getBlob(self, container_name, blob_name):
+        with self.lock:
+            return self.containers.get(container_name, {}).get(blob_name)
+
+    def blobNames(self, container_name, prefix=""):
+        with self.lock:
+            return sorted(name for name in self.containers.get(container_name, {}) if name.startswith(prefix))
+
+    ##############################################################
+    #
+    # Transcription jobs complete job_seconds after they were created
+    #
+    ##############################################################
+
+    def createJob(self, body):
+        now = time.time()
+        job = {
+            "id": str(uuid.uuid4()),
+            "name": body.get("name", ""),
+            "recordingsUrls": body.get("recordingsUrls", []),
+            "created": now,
+            "done": now + self.varied(self.job_seconds),
+            "failed": self.draw() < self.failed_rate
+        }
+        with self.lock:
+            self.jobs[job["id"]] = job
+        return job
+
+    def jobStatus(self, job):
+        if time.time() < job["done"]:
+            return "Running" if time.time() - job["created"] > 0.5 else "NotStarted"
+        return "Failed" if job["failed"] else "Succeeded"
+
+    def jobDocument(self, job, base_url):
+        status = self.jobStatus(job)
+        created = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(job["created"]))
+        document = {
+            "id": job["id"],
+            "name": job["name"],
+            "status": status,
+            "createdDateTime": created,
+            "lastActionDateTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(min(time.time(), job["done"]))),
+            "recordingsUrls": job["recordingsUrls"],
+            "locale": "en-US",
+            "properties": {},
+            "results": []
+        }
+        if status == "Succeeded":
+            document["properties"]["Duration"] = "PT{:.0f}S".format(job["done"] - job["created"])
+            for index, recording_url in enumerate(job["recordingsUrls"]):
+                file_name = urllib.parse.unquote(recording_url.split("?")[0].split("/")[-1]).rsplit(".", 1)[0] + ".json"
+                document["results"].append({
+                    "recordingsUrl": recording_url,
+                    "resultUrls": [{"fileName": file_name,
+                                    "resultUrl": base_url + "/speech/results/" + job["id"] + "/" + str(index)}]
+                })
+        return document
+
+
+##############################################################
+#
+# Request handler. The first part of the path selects the service.
+#
+##############################################################
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    @property
+    def base_url(self):
+        return "http://{}:{}".format(*self.server.server_address[:2])
+
+    def body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return data
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def respond(self, call, status, content=b"", headers=None, bytes_in=0):
+        if isinstance(content, (dict, list)):
+            content = json.dumps(content).encode("utf-8")
+            headers = dict(headers or {}, **{"Content-Type": "application/json; charset=utf-8"})
+        self.state.count(call, bytes_in, len(content))
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def handle_request(self):
+        data = self.body()
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(part) for part in url.path.strip("/").split("/")]
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        route = {"speech": self.speech, "text": self.text, "blob": self.blob}.get(parts[0])
+        if route is None:
+            return self.respond("unknown", 404, bytes_in=len(data))
+
+        if self.state.latency:
+            time.sleep(self.state.varied(self.state.latency))
+        draw = self.state.draw()
+        if draw < self.state.throttle_rate:
+            return self.respond(parts[0] + " throttled", 429, {"Retry-After": "1"}, bytes_in=len(data))
+        if draw < self.state.throttle_rate + self.state.error_rate:
+            return self.respond(parts[0] + " error", self.state.error_status, bytes_in=len(data))
+        route(parts[1:], query, data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_request
+
+    ##############################################################
+    # Speech batch transcription v2.1
+    ##############################################################
+
+    def speech(self, parts, query, data):
+        if parts[:1] == ["results"]:
+            job = self.state.jobs.get(parts[1])
+            if job is None or self.state.jobStatus(job) != "Succeeded":
+                return self.respond("speech GET results", 404, bytes_in=len(data))
+            recording_url = job["recordingsUrls"][int(parts[2])]
+            seed = "{}:{}".format(self.state.seed, recording_url.split("?")[0])
+            transcription = syntheticTranscription(recording_url, seed, self.state.min_segments, self.state.max_segments)
+            return self.respond("speech GET results", 200, transcription)
+
+        # api/speechtotext/v2.1/<resource>/<id>
+        resource = parts[3] if len(parts) > 3 else ""
+        resource_id = parts[4] if len(parts) > 4 else ""
+        call = "speech " + self.command + " " + resource + ("/{id}" if resource_id else "")
+        if resource == "endpoints":
+            return self.respond(call, 200, {"models": [{"id": str(uuid.uuid4()), "description": "base model"},
+                                                       {"id": str(uuid.uuid4()), "description": "custom model"}]})
+        if resource != "transcriptions":
+            return self.respond(call, 404, bytes_in=len(data))
+        if self.command == "POST":
+            job = self.state.createJob(json.loads(data.decode("utf-8")))
+            return self.respond(call, 202, headers={"Location": self.base_url + "/speech/api/speechtotext/v2.1/transcriptions/" + job["id"]},
+                                bytes_in=len(data))
+        if not resource_id:
+            with self.state.lock:
+                jobs = list(self.state.jobs.values())
+            return self.respond(call, 200, [self.state.jobDocument(job, self.base_url) for job in jobs])
+        job = self.state.jobs.get(resource_id)
+        if job is None:
+            return self.respond(call, 404)
+        if self.command == "DELETE":
+            with self.state.lock:
+                self.state.jobs.pop(resource_id, None)
+            return self.respond(call, 204)
+        return self.respond(call, 200, self.state.jobDocument(job, self.base_url))
+
+    ##############################################################
+    # Text Analytics v2.1 entities, finding the synthetic names
+    ##############################################################
+
+    def text(self, parts, query, data):
+        if parts[-1:] != ["entities"] or self.command != "POST":
+            return self.respond("text " + self.command, 404, bytes_in=len(data))
+        documents = []
+        for document in json.loads(data.decode("utf-8"))["documents"]:
+            entities = collections.OrderedDict()
+            for match in NAME_PATTERN.finditer(document["text"]):
+                entity = entities.setdefault(match.group(), {"name": match.group(), "type": "Person", "matches": []})
+                entity["matches"].append({"text": match.group(), "offset": match.start(),
+                                          "length": len(match.group()), "entityTypeScore": 0.9})
+            documents.append({"id": document["id"], "entities": list(entities.values())})
+        self.respond("text POST entities", 200, {"documents": documents, "errors": []}, bytes_in=len(data))
+
+    ##############################################################
+    # Blob Storage, path style: /blob/<account>/<container>/<blob name>
+    ##############################################################
+
+    def blob(self, parts, query, data):
+        container_name = parts[1] if len(parts) > 1 else ""
+        blob_name = "/".join(parts[2:])
+        if not blob_name and query.get("comp") == "list":
+            return self.listBlobs(container_name, query)
+        if self.command == "PUT":
+            return self.putBlob(container_name, blob_name, query, data)
+        if self.command in ("GET", "HEAD"):
+            return self.getBlob(container_name, blob_name)
+        self.respond("blob " + self.command, 400, bytes_in=len(data))
+
+    def blobHeaders(self, content, etag, last_modified):
+        return {"ETag": etag, "Last-Modified": last_modified, "x-ms-blob-type": "BlockBlob",
+                "Content-MD5": base64.b64encode(hashlib.md5(content).digest()).decode("ascii")}
+
+    def listBlobs(self, container_name, query):
+        names = self.state.blobNames(container_name, query.get("prefix", ""))
+        start = int(query.get("marker") or 0)
+        end = start + int(query.get("maxresults") or 5000)
+        blobs = []
+        for name in names[start:end]:
+            content, etag, last_modified = self.state.getBlob(container_name, name)
+            properties = self.blobHeaders(content, etag, last_modified)
+            blobs.append("<Blob><Name>{}</Name><Properties><Last-Modified>{}</Last-Modified><Etag>{}</Etag>"
+                         "<Content-Length>{}</Content-Length><Content-Type>application/octet-stream</Content-Type>"
+                         "<Content-MD5>{}</Content-MD5><BlobType>BlockBlob</BlobType></Properties></Blob>".format(
+                             escape(name), last_modified, escape(etag), len(content), properties["Content-MD5"]))
+        next_marker = str(end) if end < len(names) else ""
+        xml = ('<?xml version="1.0" encoding="utf-8"?><EnumerationResults ContainerName="{}"><Prefix>{}</Prefix>'
+               '<MaxResults>{}</MaxResults><Blobs>{}</Blobs><NextMarker>{}</NextMarker></EnumerationResults>').format(
+                   escape(container_name), escape(query.get("prefix", "")), end - start, "".join(blobs), next_marker)
+        self.respond("blob GET list", 200, xml.encode("utf-8"), {"Content-Type": "application/xml"})
+
+    def getBlob(self, container_name, blob_name):
+        call = "blob " + self.command
+        blob = self.state.getBlob(container_name, blob_name)
+        if blob is None:
+            return self.respond(call, 404, headers={"x-ms-error-code": "BlobNotFound"})
+        content, etag, last_modified = blob
+        headers = self.blobHeaders(content, etag, last_modified)
+        if self.state.encodings.get((container_name, blob_name)):
+            headers["Content-Encoding"] = self.state.encodings[(container_name, blob_name)]
+        range_header = self.headers.get("x-ms-range") or self.headers.get("Range")
+        if range_header is None:
+            return self.respond(call, 200, content, headers)
+        start, end = range_header.split("=")[1].split("-")
+        start, end = int(start), min(int(end or len(content) - 1), len(content) - 1)
+        if start >= len(content):
+            return self.respond(call, 416, headers={"Content-Range": "bytes */{}".format(len(content))})
+        headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, len(content))
+        self.respond(call, 206, content[start:end + 1], headers)
+
+    def putBlob(self, container_name, blob_name, query, data):
+        key = (container_name, blob_name)
+        if query.get("comp") == "block":
+            with self.state.lock:
+                self.state.blocks.setdefault(key, {})[query["blockid"]] = data
+            return self.respond("blob PUT block", 201, bytes_in=len(data))
+        if query.get("comp") == "blocklist":
+            with self.state.lock:
+                staged = self.state.blocks.pop(key, {})
+            block_ids = re.findall(r"<(?:Latest|Committed|Uncommitted)>([^<]*)</", data.decode("utf-8"))
+            data = b"".join(staged[block_id] for block_id in block_ids)
+            call = "blob PUT blocklist"
+        else:
+            call = "blob PUT"
+        self.state.putBlob(container_name, blob_name, data, self.headers.get("x-ms-blob-content-encoding"))
+        content, etag, last_modified = self.state.getBlob(container_name, blob_name)
+        self.respond(call, 201, headers={"ETag": etag, "Last-Modified": last_modified}, bytes_in=len(data))
+
+
+class MockServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, state, port=0):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.state = state
+
+    @property
+    def base_url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def endpoints(server, account_name):
+    """CONFIG_ environment overrides pointing the scripts at the stand-in services"""
+    return {
+        "CONFIG_SPEECH_API__ENDPOINT": server.base_url + "/speech",
+        "CONFIG_TEXT_API__ENDPOINT": server.base_url + "/text",
+        "CONFIG_STORAGE__BLOB_ENDPOINT": server.base_url + "/blob/" + account_name,
+        "CONFIG_STORAGE__ACCOUNT_NAME": account_name,
+    }
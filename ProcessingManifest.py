@@ -0,0 +1,145 @@
+##############################################################
+#
+# Python script that remembers which blobs have already been processed,
+# so that transcribe_blobs.py, MaskBlobTranscriptions.py and
+# ColumnarExport.py only pick up new or modified blobs when they are run
+# again.
+#
+# Every blob is keyed by stage ("transcribe", "mask" or "export") and blob name,
+# and stored with its ETag (for local files, their modification time
+# and size) and, when Blob Storage provides one, the MD5 of its content.
+# A blob is skipped when it is already done with the same ETag or
+# content. A recording whose content is identical to one that is already
+# done or pending under another name is skipped as a duplicate, until
+# that recording fails to transcribe. Duplicates are looked up in the
+# manifest itself, so memory does not grow with the number of recordings.
+#
+# The manifest lives in the same SQLite file as the run ledger.
+#
+##############################################################
+
+import datetime
+import sqlite3
+import threading
+from Configuration import get_configuration
+
+
+TRANSCRIBE = "transcribe"
+MASK = "mask"
+EXPORT = "export"
+
+PENDING = "Pending"
+DONE = "Done"
+DUPLICATE = "Duplicate"
+FAILED = "Failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    stage           TEXT,
+    name            TEXT,
+    etag            TEXT,
+    content_hash    TEXT,
+    status          TEXT,
+    output          TEXT,
+    duplicate_of    TEXT,
+    updated_at      TEXT,
+    PRIMARY KEY (stage, name)
+);
+CREATE INDEX IF NOT EXISTS manifest_content_hash ON manifest (stage, content_hash, status);
+"""
+
+UPSERT = """
+INSERT INTO manifest (stage, name, etag, content_hash, status, output, duplicate_of, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(stage, name) DO UPDATE SET
+    etag = COALESCE(excluded.etag, manifest.etag),
+    content_hash = COALESCE(excluded.content_hash, manifest.content_hash),
+    status = excluded.status, output = excluded.output,
+    duplicate_of = excluded.duplicate_of, updated_at = excluded.updated_at
+"""
+
+
+def blobVersion(blob):
+    # ETag and content MD5 of a blob listed by a backend of StorageBackends.py
+    return blob.etag, blob.content_md5
+
+
+class ProcessingManifest:
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def _write(self, stage, name, etag, content_hash, status, output=None, duplicate_of=None):
+        with self.lock, self.connection:
+            self.connection.execute(UPSERT, (stage, name, etag, content_hash, status, output, duplicate_of,
+                                             datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
+
+    ##############################################################
+    #
+    # Decide whether a blob needs processing. Returns (True, None) when it
+    # does, and (False, reason) when it can be skipped.
+    #
+    ##############################################################
+
+    def shouldProcess(self, stage, name, etag, content_hash=None):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, content_hash, status, duplicate_of FROM manifest WHERE stage = ? AND name = ?",
+                (stage, name)).fetchone()
+        # a duplicate is processed after all when its original failed
+        if row is not None and (row[2] == DONE or (row[2] == DUPLICATE and self.isOriginal(stage, row[3]))):
+            # done by the streaming pipeline before the blob was listed
+            if row[0] is None and row[1] is None:
+                return False, "done"
+            if etag is not None and row[0] == etag:
+                return False, "unchanged"
+            if content_hash is not None and row[1] == content_hash:
+                return False, "unchanged"
+
+        if stage == TRANSCRIBE and content_hash is not None:
+            # recordings submitted earlier in this run are already Pending
+            with self.lock:
+                original = self.connection.execute(
+                    "SELECT name FROM manifest WHERE stage = ? AND content_hash = ? AND status IN (?, ?) AND name != ? LIMIT 1",
+                    (stage, content_hash, PENDING, DONE, name)).fetchone()
+            if original is not None:
+                self._write(stage, name, etag, content_hash, DUPLICATE, duplicate_of=original[0])
+                return False, "duplicate of " + original[0]
+
+        return True, None
+
+    def isOriginal(self, stage, name):
+        # True while a blob others are duplicates of is being or has been processed
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM manifest WHERE stage = ? AND name = ?", (stage, name)).fetchone()
+        return row is not None and row[0] in (PENDING, DONE)
+
+    def markPending(self, stage, name, etag, content_hash=None):
+        self._write(stage, name, etag, content_hash, PENDING)
+
+    def markDone(self, stage, name, output=None, etag=None, content_hash=None):
+        self._write(stage, name, etag, content_hash, DONE, output=output)
+
+    def markFailed(self, stage, name):
+        self._write(stage, name, None, None, FAILED)
+
+
+##############################################################
+#
+# The manifest configured in config.json, shared by the whole process
+#
+##############################################################
+
+manifest = None
+manifest_lock = threading.Lock()
+
+def get_manifest():
+    global manifest
+    with manifest_lock:
+        if manifest is None:
+            manifest = ProcessingManifest(get_configuration().get("ledger", {}).get("path", "TranscriptionsLog.db"))
+    return manifest
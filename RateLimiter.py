@@ -0,0 +1,274 @@
+##############################################################
+#
+# Python script with the request scheduler shared by every call to the
+# Speech to Text API, the Text Analytics API and Azure Blob Storage, so
+# that the pipeline can run at the quota of its keys without failing.
+#
+#  - A token bucket per API key, and optionally per endpoint, spaces the
+#    requests out to the configured requests_per_second and burst.
+#  - At most max_in_flight requests are on the wire at the same time.
+#  - Requests answered with 429 or a 5xx are retried up to max_retries
+#    times. The wait is the Retry-After of the response when there is one,
+#    otherwise an exponential backoff from backoff_base seconds capped at
+#    backoff_max seconds. A Retry-After also holds back every other request
+#    on the same key until it has passed.
+#
+# Every attempt is counted in the api_requests_total and
+# api_request_seconds metrics (see Metrics.py), and the time spent waiting
+# for a token in api_wait_seconds.
+#
+# The limits are read from the "rate_limits" section of config.json. The
+# scheduler is per process, so processes that share the keys (the worker
+# processes of MaskBlobTranscriptions.py) each take an equal part of the
+# limits with shareLimits.
+#
+##############################################################
+
+import email.utils
+import random
+import re
+import threading
+import time
+import datetime
+import requests
+import Metrics
+from Configuration import get_configuration
+
+
+DEFAULT_RATE_LIMITS = {
+    "max_in_flight": 32,
+    "max_retries": 5,
+    "backoff_base": 1,
+    "backoff_max": 60,
+    "apis": {}
+}
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# a POST that failed with another status may already have been carried out
+POST_RETRY_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+# transcription ids and other GUIDs in a URL path are replaced so that every
+# transcription shares the endpoint's bucket
+GUID = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+
+def endpointName(method, url):
+    path = url.split("?")[0].split("://")[-1]
+    return method.upper() + " " + GUID.sub("{id}", path)
+
+
+def retryAfter(response):
+    """Seconds to wait given by the Retry-After header of a response, or None"""
+    value = getattr(response, "headers", {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds(), 0)
+
+
+def statusCode(response):
+    # requests responses have status_code, msrest and urllib3 ones have status
+    return getattr(response, "status_code", getattr(response, "status", None))
+
+
+##############################################################
+#
+# Token bucket holding up to `burst` requests and refilled at `rate`
+# requests per second. acquire() reserves a token and sleeps until it is
+# due, so waiting threads are served in the order they arrived.
+#
+##############################################################
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(self.blocked_until - now, -self.tokens / self.rate, 0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def block(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+
+    def __init__(self, max_in_flight=32, max_retries=5, backoff_base=1, backoff_max=60, apis=None):
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.apis = apis or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.throttled = 0
+
+    def _bucket(self, name, limits):
+        if not limits or not limits.get("requests_per_second"):
+            return None
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = TokenBucket(limits["requests_per_second"], limits.get("burst"))
+            return self.buckets[name]
+
+    def buckets_for(self, api, key, endpoint):
+        limits = self.apis.get(api, {})
+        buckets = [self._bucket((api, key), limits),
+                   self._bucket((api, key, endpoint), limits.get("endpoints", {}).get(endpoint))]
+        return [bucket for bucket in buckets if bucket is not None]
+
+    def backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * random.uniform(0.5, 1)
+
+    ##############################################################
+    #
+    # Run send() under the limits of (api, key, endpoint) and retry it while
+    # it is throttled or fails with a 5xx. send() either returns a response
+    # or raises an exception with a .response attribute (as the Azure SDKs
+    # do). The last response is returned, or its exception raised, once the
+    # retries are used up.
+    #
+    ##############################################################
+
+    def call(self, api, key, endpoint, send, method="GET"):
+        buckets = self.buckets_for(api, key, endpoint)
+        retry_statuses = RETRY_STATUSES if method.upper() in IDEMPOTENT_METHODS else POST_RETRY_STATUSES
+        metrics = Metrics.get_metrics()
+        attempt = 0
+        while True:
+            with metrics.timer("api_wait_seconds", api=api):
+                for bucket in buckets:
+                    bucket.acquire()
+            error = None
+            with self.in_flight, metrics.timer("api_request_seconds", api=api, endpoint=endpoint):
+                try:
+                    response = send()
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    metrics.increment("api_requests_total", api=api, endpoint=endpoint, status=type(err).__name__)
+                    if method.upper() not in IDEMPOTENT_METHODS or attempt >= self.max_retries:
+                        raise
+                    response, error = None, err
+                except Exception as err:
+                    response, error = getattr(err, "response", None), err
+                    metrics.increment("api_requests_total", api=api, endpoint=endpoint,
+                                      status=statusCode(response) or type(err).__name__)
+                    if statusCode(response) not in retry_statuses:
+                        raise
+                else:
+                    metrics.increment("api_requests_total", api=api, endpoint=endpoint, status=statusCode(response) or "ok")
+
+            status = statusCode(response)
+            if error is None and status not in retry_statuses:
+                return response
+            if attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = retryAfter(response)
+            if delay is None:
+                delay = self.backoff(attempt)
+            else:
+                for bucket in buckets:
+                    bucket.block(delay)
+            with self.lock:
+                self.retries += 1
+                if status == 429:
+                    self.throttled += 1
+            metrics.increment("api_retries_total", api=api, endpoint=endpoint)
+            if hasattr(response, "close"):
+                # hand the connection back to the pool before trying again
+                response.close()
+            print("Retrying " + endpoint + " in " + "{:.1f}".format(delay) + "s after " +
+                  (str(status) if response is not None else type(error).__name__))
+            time.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self.lock:
+            return {"retries": self.retries, "throttled": self.throttled}
+
+
+##############################################################
+#
+# The scheduler configured in config.json, shared by the whole process
+#
+##############################################################
+
+scheduler = None
+scheduler_lock = threading.Lock()
+
+def rateLimits():
+    limits = dict(DEFAULT_RATE_LIMITS)
+    limits.update(get_configuration().get("rate_limits", {}))
+    limits.pop("description", None)
+    return limits
+
+
+def createScheduler(limits):
+    return RequestScheduler(limits["max_in_flight"], limits["max_retries"],
+                            limits["backoff_base"], limits["backoff_max"], limits["apis"])
+
+
+def get_scheduler():
+    global scheduler
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = createScheduler(rateLimits())
+    return scheduler
+
+
+##############################################################
+#
+# Limit this process to 1/processes of the configured requests_per_second,
+# burst and max_in_flight, for one of `processes` processes that share the
+# same keys. Used as the initializer of worker processes.
+#
+##############################################################
+
+def sharedLimits(limits, processes):
+    def share(bucket):
+        if not bucket:
+            return bucket
+        bucket = dict(bucket)
+        if bucket.get("requests_per_second"):
+            bucket["requests_per_second"] = bucket["requests_per_second"] / processes
+        if bucket.get("burst"):
+            bucket["burst"] = max(1, bucket["burst"] / processes)
+        if "endpoints" in bucket:
+            bucket["endpoints"] = {endpoint: share(limit) for endpoint, limit in bucket["endpoints"].items()}
+        return bucket
+
+    limits = dict(limits)
+    limits["max_in_flight"] = max(1, limits["max_in_flight"] // processes)
+    limits["apis"] = {api: share(api_limits) for api, api_limits in limits["apis"].items()}
+    return limits
+
+
+def shareLimits(processes):
+    global scheduler
+    with scheduler_lock:
+        scheduler = createScheduler(sharedLimits(rateLimits(), processes))
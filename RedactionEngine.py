@@ -0,0 +1,105 @@
+##############################################################
+#
+# Python script that masks numbers and entities in speaker sentences.
+#
+# The number rules run as ordered str.replace passes over all the segments
+# of a call joined together, rather than segment by segment, and the
+# entity masks are applied in one linear rebuild of the sentence. A single
+# regular expression over the rules would change the output for
+# overlapping words such as "eightwo" and measured slower. Both give
+# exactly the same result as the original approach of one str.replace per
+# rule per segment and one string rebuild per entity.
+#
+##############################################################
+
+
+# Number words and digits replaced with '#', in the order the original
+# replacements were applied. Only ' one' includes the leading space.
+NUMBER_RULES = (' one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'zero',
+                '1', '2', '3', '4', '5', '6', '7', '8', '9', '0')
+NUMBER_MASK = '#'
+
+# Joins the segments of a call. It is not part of any rule, so no rule can
+# match across two segments.
+SEGMENT_SEPARATOR = '\n'
+
+ENTITY_MASK_TAG = "Person"
+
+
+##############################################################
+#
+# Replace the number words and digits of a sentence with '#'.
+#
+# The rules have to be applied one after the other: a word only stays
+# masked if no earlier rule already replaced part of it, e.g. in "eightwo"
+# the earlier rule 'two' wins over 'eight'. str.replace is also faster in
+# CPython than a single regular expression pass over the same rules.
+#
+##############################################################
+
+def maskNumbers(sentence):
+    for rule in NUMBER_RULES:
+        sentence = sentence.replace(rule, NUMBER_MASK)
+    return sentence
+
+
+##############################################################
+#
+# Mask the numbers of every segment of a call with one pass of each rule
+# over the joined segments, instead of one pass per rule per segment
+#
+##############################################################
+
+def maskNumbersInSegments(sentences):
+    sentences = list(sentences)
+    if any(SEGMENT_SEPARATOR in sentence for sentence in sentences):
+        return [maskNumbers(sentence) for sentence in sentences]
+    return maskNumbers(SEGMENT_SEPARATOR.join(sentences)).split(SEGMENT_SEPARATOR) if sentences else []
+
+
+##############################################################
+#
+# Replace every [startIndex, endIndex) span of a sentence with the mask
+# tag, padded with '#' up to the length of the span
+#
+##############################################################
+
+def entityMask(mask_length):
+    if mask_length > len(ENTITY_MASK_TAG):
+        return ENTITY_MASK_TAG + ((mask_length - len(ENTITY_MASK_TAG)) * "#")
+    return ENTITY_MASK_TAG
+
+
+def maskEntitySpans(sentence, offsets):
+    spans = sorted((start, end) for start, end in offsets)
+
+    # The original masks were applied one after the other on the already
+    # masked sentence, so a mask longer than its span shifted every span
+    # applied after it to its right. The linear rebuild only matches that
+    # when the spans do not overlap and no such shift happens, otherwise
+    # fall back to applying the masks one by one.
+    for start, end in spans:
+        if start < 0 or end < start or end > len(sentence):
+            return maskEntitySpansSequentially(sentence, offsets)
+    for i in range(len(spans) - 1):
+        if spans[i][1] > spans[i + 1][0]:
+            return maskEntitySpansSequentially(sentence, offsets)
+    for i in range(len(offsets)):
+        start, end = offsets[i]
+        if end - start < len(ENTITY_MASK_TAG) and any(later_start >= end for later_start, later_end in offsets[i + 1:]):
+            return maskEntitySpansSequentially(sentence, offsets)
+
+    parts = []
+    position = 0
+    for start, end in spans:
+        parts.append(sentence[position:start])
+        parts.append(entityMask(end - start))
+        position = max(position, end)
+    parts.append(sentence[position:])
+    return "".join(parts)
+
+
+def maskEntitySpansSequentially(sentence, offsets):
+    for start, end in offsets:
+        sentence = "".join((sentence[:start], entityMask(end - start), sentence[end:]))
+    return sentence
@@ -0,0 +1,223 @@
+##############################################################
+#
+# Python script that keeps a local SQLite ledger of every transcription
+# and masking outcome, replacing the appends to TranscriptionsLog.csv.
+#
+# The ledger runs in WAL mode, buffers rows and writes them in batches,
+# keeps one row per transcription id and per masked blob, and indexes
+# status and name so that questions such as "which calls failed last
+# week" or "which recordings are already done" do not need a full scan.
+# The transcriptions can still be exported in the TranscriptionsLog.csv
+# format.
+#
+#   python RunLedger.py report --status Failed --since 2020-03-23
+#   python RunLedger.py export TranscriptionsLog.csv
+#
+##############################################################
+
+import argparse
+import atexit
+import csv
+import datetime
+import sqlite3
+import threading
+import uuid
+from Configuration import get_configuration
+
+
+CSV_COLUMNS = ["id", "name", "status", "createdDateTime", "lastActionDateTime", "CallDuration", "ProcTime"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transcriptions (
+    id                  TEXT PRIMARY KEY,
+    run_id              TEXT,
+    name                TEXT,
+    status              TEXT,
+    createdDateTime     TEXT,
+    lastActionDateTime  TEXT,
+    CallDuration        TEXT,
+    ProcTime            REAL,
+    logged_at           TEXT
+);
+CREATE INDEX IF NOT EXISTS transcriptions_status ON transcriptions (status, lastActionDateTime);
+CREATE INDEX IF NOT EXISTS transcriptions_name ON transcriptions (name);
+
+CREATE TABLE IF NOT EXISTS maskings (
+    name                TEXT PRIMARY KEY,
+    run_id              TEXT,
+    masked_name         TEXT,
+    outcome             TEXT,
+    error               TEXT,
+    masked_at           TEXT
+);
+CREATE INDEX IF NOT EXISTS maskings_outcome ON maskings (outcome, masked_at);
+"""
+
+UPSERT_TRANSCRIPTION = """
+INSERT INTO transcriptions (id, run_id, name, status, createdDateTime, lastActionDateTime, CallDuration, ProcTime, logged_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    run_id = excluded.run_id, name = excluded.name, status = excluded.status,
+    createdDateTime = excluded.createdDateTime, lastActionDateTime = excluded.lastActionDateTime,
+    CallDuration = excluded.CallDuration, ProcTime = excluded.ProcTime, logged_at = excluded.logged_at
+"""
+
+UPSERT_MASKING = """
+INSERT INTO maskings (name, run_id, masked_name, outcome, error, masked_at)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(name) DO UPDATE SET
+    run_id = excluded.run_id, masked_name = excluded.masked_name, outcome = excluded.outcome,
+    error = excluded.error, masked_at = excluded.masked_at
+"""
+
+
+def formatProcTime(ProcTime):
+    # Same text as pandas writes for a Timedelta, e.g. "0 days 00:05:03"
+    if not isinstance(ProcTime, datetime.timedelta):
+        return ProcTime
+    hours, remainder = divmod(ProcTime.seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    text = "{} days {:02d}:{:02d}:{:02d}".format(ProcTime.days, hours, minutes, seconds)
+    if ProcTime.microseconds:
+        text += ".{:06d}".format(ProcTime.microseconds)
+    return text
+
+
+def formatDateTime(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+class RunLedger:
+
+    def __init__(self, path, batch_size=50, run_id=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.run_id = run_id or datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ") + "-" + uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+        self.transcriptions = []
+        self.maskings = []
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    ##############################################################
+    #
+    # Buffered writes, flushed every batch_size rows
+    #
+    ##############################################################
+
+    def logTranscription(self, id, name, status, createdDateTime, lastActionDateTime, CallDuration, ProcTime):
+        if isinstance(ProcTime, datetime.timedelta):
+            ProcTime = ProcTime.total_seconds()
+        row = (id, self.run_id, name, status, formatDateTime(createdDateTime), formatDateTime(lastActionDateTime),
+               CallDuration, ProcTime, formatDateTime(datetime.datetime.utcnow()))
+        with self.lock:
+            self.transcriptions.append(row)
+            if len(self.transcriptions) + len(self.maskings) >= self.batch_size:
+                self._flush()
+
+    def logMasking(self, name, masked_name, outcome, error=None):
+        row = (name, self.run_id, masked_name, outcome, None if error is None else str(error),
+               formatDateTime(datetime.datetime.utcnow()))
+        with self.lock:
+            self.maskings.append(row)
+            if len(self.transcriptions) + len(self.maskings) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.transcriptions and not self.maskings:
+            return
+        with self.connection:
+            self.connection.executemany(UPSERT_TRANSCRIPTION, self.transcriptions)
+            self.connection.executemany(UPSERT_MASKING, self.maskings)
+        self.transcriptions = []
+        self.maskings = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    ##############################################################
+    #
+    # Reporting and resuming
+    #
+    ##############################################################
+
+    def query(self, sql, parameters=()):
+        self.flush()
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def transcriptionsWithStatus(self, status, since=None):
+        sql = "SELECT " + ", ".join(CSV_COLUMNS) + " FROM transcriptions WHERE status = ?"
+        parameters = [status]
+        if since is not None:
+            sql += " AND lastActionDateTime >= ?"
+            parameters.append(formatDateTime(since))
+        return self.query(sql + " ORDER BY lastActionDateTime", parameters)
+
+    def namesWithStatus(self, status):
+        return {row[0] for row in self.query("SELECT name FROM transcriptions WHERE status = ?", (status,))}
+
+    def maskedNames(self, outcome="Masked"):
+        return {row[0] for row in self.query("SELECT name FROM maskings WHERE outcome = ?", (outcome,))}
+
+    def exportCSV(self, csv_path):
+        rows = self.query("SELECT " + ", ".join(CSV_COLUMNS) + " FROM transcriptions ORDER BY logged_at")
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_COLUMNS)
+            for index, row in enumerate(rows):
+                row = list(row)
+                if row[-1] is not None:
+                    row[-1] = formatProcTime(datetime.timedelta(seconds=row[-1]))
+                writer.writerow([index] + row)
+        return len(rows)
+
+
+##############################################################
+#
+# The ledger configured in config.json, shared by the whole process and
+# flushed when the process exits
+#
+##############################################################
+
+ledger = None
+ledger_lock = threading.Lock()
+
+def get_ledger():
+    global ledger
+    with ledger_lock:
+        if ledger is None:
+            ledger_config = get_configuration().get("ledger", {})
+            ledger = RunLedger(ledger_config.get("path", "TranscriptionsLog.db"), ledger_config.get("batch_size", 50))
+            atexit.register(ledger.close)
+    return ledger
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report = subparsers.add_parser("report", help="list the transcriptions with a given status")
+    report.add_argument("--status", default="Failed")
+    report.add_argument("--since", default=None, help="YYYY-MM-DD")
+    export = subparsers.add_parser("export", help="export the transcriptions in the TranscriptionsLog.csv format")
+    export.add_argument("csv_path")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        since = datetime.datetime.strptime(args.since, "%Y-%m-%d") if args.since else None
+        rows = get_ledger().transcriptionsWithStatus(args.status, since)
+        print(",".join(CSV_COLUMNS))
+        for row in rows:
+            print(",".join("" if value is None else str(value) for value in row))
+        print(len(rows), " transcriptions with status ", args.status)
+    else:
+        print(get_ledger().exportCSV(args.csv_path), " transcriptions exported to ", args.csv_path)
@@ -0,0 +1,192 @@
+##############################################################
+#
+# Python script that owns the connections used to talk to the Speech to
+# Text API, the Text Analytics API and Azure Blob Storage. Every client
+# is built once per process and keeps its connections alive so polling
+# and fetching calls do not pay for a new TCP and TLS handshake.
+#
+# Pool sizes, timeouts and default headers are read from the "http"
+# section of config.json. Every request goes through the shared request
+# scheduler of RateLimiter.py, which applies the rate limits of its API key
+# and retries it when it is throttled.
+#
+##############################################################
+
+import functools
+import os
+import threading
+import requests
+import RateLimiter
+import Metrics
+from requests.adapters import HTTPAdapter
+from Configuration import get_configuration
+
+
+DEFAULT_HTTP_CONFIGURATION = {
+    "pool_connections": 4,
+    "pool_maxsize": 16,
+    "connect_timeout": 10,
+    "read_timeout": 120,
+    "headers": {}
+}
+
+def http_configuration():
+    http = dict(DEFAULT_HTTP_CONFIGURATION)
+    http.update(get_configuration().get("http", {}))
+    return http
+
+
+##############################################################
+#
+# Blobs are read as they are stored: requests would otherwise decode the
+# body of a blob stored with Content-Encoding gzip on its own, which breaks
+# range reads and the length and MD5 checks of the storage SDK.
+# Compression.py detects and decodes compressed blobs instead.
+#
+##############################################################
+
+class StoredContent:
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        return self.raw.stream(amt, decode_content=False)
+
+    def read(self, amt=None, decode_content=None, **kwargs):
+        return self.raw.read(amt, decode_content=False, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class StoredContentAdapter(HTTPAdapter):
+
+    def build_response(self, req, resp):
+        response = super().build_response(req, resp)
+        response.raw = StoredContent(response.raw)
+        return response
+
+
+##############################################################
+#
+# A requests Session that applies the configured timeout to every
+# request that does not pass one explicitly, and sends it through the
+# request scheduler under the limits of `api` and `key`. The bytes sent
+# and, where the response gives a Content-Length, received are counted
+# per api in the bytes_sent_total and bytes_received_total metrics.
+#
+##############################################################
+
+class PooledSession(requests.Session):
+
+    def __init__(self, timeout, pool_connections, pool_maxsize, headers=None, api=None, key=None, decode_content=True):
+        super().__init__()
+        self.timeout = timeout
+        self.api = api
+        self.key = key
+        adapter_class = HTTPAdapter if decode_content else StoredContentAdapter
+        adapter = adapter_class(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        if headers:
+            self.headers.update(headers)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        send = functools.partial(super().request, method, url, **kwargs)
+        response = RateLimiter.get_scheduler().call(self.api, self.key, RateLimiter.endpointName(method, url), send, method)
+        data = kwargs.get("data")
+        if isinstance(data, (bytes, bytearray, str)):
+            Metrics.get_metrics().increment("bytes_sent_total", len(data), api=self.api)
+        received = response.headers.get("Content-Length")
+        if received and received.isdigit():
+            Metrics.get_metrics().increment("bytes_received_total", int(received), api=self.api)
+        return response
+
+
+def create_session(headers=None, api=None, key=None, decode_content=True):
+    http = http_configuration()
+    session_headers = dict(http["headers"])
+    session_headers.update(headers or {})
+    return PooledSession((http["connect_timeout"], http["read_timeout"]),
+                         http["pool_connections"], http["pool_maxsize"], session_headers, api, key, decode_content)
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_speech_session():
+    with sessions_lock:
+        if "speech" not in sessions:
+            subscription_key = get_configuration()["speech_api"]["subscription_key"]
+            sessions["speech"] = create_session({"Ocp-Apim-Subscription-Key": subscription_key}, "speech", subscription_key)
+        return sessions["speech"]
+
+def get_storage_session():
+    with sessions_lock:
+        if "storage" not in sessions:
+            sessions["storage"] = create_session(api="storage", key=get_configuration()["storage"]["account_name"],
+                                                 decode_content=False)
+        return sessions["storage"]
+
+
+##############################################################
+#
+# Text Analytics client shared by every entity extraction call
+#
+##############################################################
+
+text_analytics_clients = {}
+text_analytics_clients_lock = threading.Lock()
+
+def get_text_analytics_client(subscription_key=None):
+    from azure.cognitiveservices.language.textanalytics import TextAnalyticsClient
+    from msrest.authentication import CognitiveServicesCredentials
+
+    configuration = get_configuration()
+    if subscription_key is None:
+        subscription_key = configuration["text_api"]["subscription_key"]
+
+    with text_analytics_clients_lock:
+        if subscription_key not in text_analytics_clients:
+            http = http_configuration()
+            location = os.environ.get("TEXTANALYTICS_LOCATION", configuration["text_api"]["region"])
+            text_analytics_url = configuration["text_api"].get("endpoint") or "https://{}.api.cognitive.microsoft.com".format(location)
+            text_analytics = TextAnalyticsClient(
+                endpoint=text_analytics_url, credentials=CognitiveServicesCredentials(subscription_key))
+            text_analytics.config.keep_alive = True
+            # retries are left to the request scheduler, see RateLimiter.py
+            text_analytics.config.retry_policy.retries = 0
+            text_analytics.config.connection.timeout = (http["connect_timeout"], http["read_timeout"])
+            text_analytics_clients[subscription_key] = text_analytics
+        return text_analytics_clients[subscription_key]
+
+
+##############################################################
+#
+# Blob service shared by every module, backed by the pooled storage session
+#
+##############################################################
+
+block_blob_service = None
+block_blob_service_lock = threading.Lock()
+
+def get_block_blob_service():
+    from azure.storage.blob import BlockBlobService
+    from azure.storage.common.retry import no_retry
+
+    global block_blob_service
+    with block_blob_service_lock:
+        if block_blob_service is None:
+            configuration = get_configuration()
+            http = http_configuration()
+            block_blob_service = BlockBlobService(
+                account_name=configuration["storage"]["account_name"],
+                account_key=configuration["storage"]["account_key"],
+                custom_domain=configuration["storage"].get("blob_endpoint") or None,
+                request_session=get_storage_session(),
+                socket_timeout=(http["connect_timeout"], http["read_timeout"]))
+            # the storage session already retries through the request scheduler
+            block_blob_service.retry = no_retry
+    return block_blob_service
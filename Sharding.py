@@ -0,0 +1,37 @@
+##############################################################
+#
+# Python script that splits the blobs of a container between several
+# machines. Every blob name is hashed, and shard i of N takes the names
+# whose hash is i modulo N, so that N nodes started with --shard 0/N ...
+# --shard N-1/N work through one container with no coordinator and
+# without processing a blob twice. The hash only depends on the blob name,
+# so a blob stays in the same shard across runs and machines.
+#
+##############################################################
+
+import argparse
+import hashlib
+
+
+def parseShard(value):
+    """argparse type for "i/N", returning (i, N)"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be i/N, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must be between 0 and N-1")
+    return index, count
+
+
+def shardOf(name, count):
+    digest = hashlib.sha1(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def inShard(name, shard):
+    # every blob is in the shard when no shard is given
+    if shard is None:
+        return True
+    index, count = shard
+    return shardOf(name, count) == index
@@ -0,0 +1,227 @@
+##############################################################
+#
+# Python script with the storage the pipeline reads recordings and
+# transcriptions from and writes transcriptions and masked documents to.
+# Every backend lists, gets, puts and streams the blobs of a container:
+#
+#   list(container, prefix, page_size)    StoredBlob records, lazily
+#   get(container, name)                  the bytes of a blob
+#   stream(container, name, chunk_size)   the bytes of a blob, a chunk at a time
+#   put(container, name, data)            write a blob
+#   putChunks(container, name, chunks)    write a blob as its chunks are produced
+#   recordingUrl(container, name)         the Url the Speech service reads a recording from
+#
+# storage.backend in config.json selects the backend:
+#
+#   azure_blob  Azure Blob Storage through the shared BlockBlobService of
+#               ServiceClients.py (the default)
+#   local       a local directory, storage.local_root, with a sub directory
+#               per container and the blob names as relative paths.
+#               Blobs are streamed from a memory map of the file, and are
+#               written to a hidden file that is renamed when complete, so
+#               a reader never sees half a blob. The Speech service reads
+#               the recordings from storage.local_recording_url, the Url
+#               local_root is served at.
+#
+##############################################################
+
+import datetime
+import mmap
+import os
+import threading
+import uuid
+import ServiceClients
+import TranscribeAudioFiles
+import TranscriptionStream
+from Configuration import setting
+
+
+AZURE_BLOB = "azure_blob"
+LOCAL = "local"
+
+
+##############################################################
+#
+# One blob as listed by a backend, with what ProcessingManifest.py needs
+# to tell whether it changed
+#
+##############################################################
+
+class StoredBlob:
+    __slots__ = ("name", "etag", "content_md5", "content_length", "last_modified")
+
+    def __init__(self, name, etag, content_md5, content_length, last_modified):
+        self.name = name
+        self.etag = etag
+        self.content_md5 = content_md5
+        self.content_length = content_length
+        self.last_modified = last_modified
+
+
+def recordingName(storage, container, recording_url):
+    """The name of the recording a Url from recordingUrl points to"""
+    return recording_url.split("?")[0][len(storage.recordingPath(container)):]
+
+
+##############################################################
+#
+# Azure Blob Storage
+#
+##############################################################
+
+class BlobBackend:
+
+    def __init__(self, block_blob_service=None):
+        self.block_blob_service = block_blob_service or ServiceClients.get_block_blob_service()
+
+    def list(self, container, prefix=None, page_size=None):
+        # one page of page_size blobs is listed at a time
+        marker = None
+        while True:
+            page = self.block_blob_service.list_blobs(container, prefix=prefix, num_results=page_size, marker=marker)
+            for blob in page:
+                properties = blob.properties
+                yield StoredBlob(blob.name, properties.etag, properties.content_settings.content_md5,
+                                 properties.content_length, properties.last_modified)
+            marker = page.next_marker
+            if not marker:
+                return
+
+    def get(self, container, name):
+        return self.block_blob_service.get_blob_to_bytes(container, name).content
+
+    def stream(self, container, name, chunk_size):
+        # one range request per chunk
+        properties = self.block_blob_service.get_blob_properties(container, name).properties
+        for start in range(0, properties.content_length, chunk_size):
+            end = min(start + chunk_size, properties.content_length) - 1
+            yield self.block_blob_service.get_blob_to_bytes(container, name, start_range=start, end_range=end).content
+
+    def contentSettings(self, content_encoding):
+        from azure.storage.blob import ContentSettings
+        return ContentSettings(content_type="application/json", content_encoding=content_encoding)
+
+    def put(self, container, name, data, content_encoding=None):
+        if content_encoding is None:
+            return self.block_blob_service.create_blob_from_bytes(container, name, data)
+        return self.block_blob_service.create_blob_from_bytes(container, name, data,
+                                                              content_settings=self.contentSettings(content_encoding))
+
+    def putChunks(self, container, name, chunks, content_encoding=None):
+        # the upload is only committed once every chunk is written
+        stream = TranscriptionStream.ChunkStream(chunks)
+        if content_encoding is None:
+            return self.block_blob_service.create_blob_from_stream(container, name, stream, max_connections=1)
+        return self.block_blob_service.create_blob_from_stream(container, name, stream, max_connections=1,
+                                                               content_settings=self.contentSettings(content_encoding))
+
+    def recordingPath(self, container):
+        return TranscribeAudioFiles.storagePath(container)
+
+    def recordingUrl(self, container, name):
+        return self.recordingPath(container) + name + setting("storage", "SAS", "")
+
+
+##############################################################
+#
+# A local directory. Files have no metadata, so the content encoding of
+# a blob is not stored: Compression.py tells it from the content.
+#
+##############################################################
+
+class LocalBackend:
+
+    def __init__(self, root, recording_url=None):
+        self.root = os.path.abspath(root)
+        self.recording_url = recording_url
+
+    def path(self, container, name=""):
+        directory = os.path.join(self.root, container)
+        path = os.path.normpath(os.path.join(directory, *name.split("/")))
+        if path != directory and not path.startswith(directory + os.sep):
+            raise ValueError("Blob name " + name + " is outside of container " + container)
+        return path
+
+    def list(self, container, prefix=None, page_size=None):
+        # the files are listed a directory at a time, so page_size is not needed
+        prefix = prefix or ""
+        top = self.path(container, prefix.rpartition("/")[0])
+        for directory, directory_names, file_names in os.walk(top):
+            directory_names.sort()
+            for file_name in sorted(file_names):
+                # hidden files are being written, see atomicWrite
+                if file_name.startswith("."):
+                    continue
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, self.path(container)).replace(os.sep, "/")
+                if not name.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                yield StoredBlob(name, '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size), None, stat.st_size,
+                                 datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc))
+
+    def get(self, container, name):
+        with open(self.path(container, name), "rb") as f:
+            return f.read()
+
+    def stream(self, container, name, chunk_size):
+        with open(self.path(container, name), "rb") as f:
+            # an empty file cannot be mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(0, len(mapped), chunk_size):
+                    yield mapped[start:start + chunk_size]
+
+    def atomicWrite(self, path, chunks):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + "." + uuid.uuid4().hex[:8])
+        try:
+            with open(temporary, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def put(self, container, name, data, content_encoding=None):
+        self.atomicWrite(self.path(container, name), [data])
+
+    def putChunks(self, container, name, chunks, content_encoding=None):
+        self.atomicWrite(self.path(container, name), chunks)
+
+    def recordingPath(self, container):
+        if not self.recording_url:
+            raise ValueError("storage.local_recording_url must be set to transcribe recordings from a local directory")
+        return self.recording_url.rstrip("/") + "/" + container + "/"
+
+    def recordingUrl(self, container, name):
+        return self.recordingPath(container) + name
+
+
+##############################################################
+#
+# The backend configured in config.json, shared by the whole process
+#
+##############################################################
+
+storage_backend = None
+storage_backend_lock = threading.Lock()
+
+def get_storage_backend():
+    global storage_backend
+    with storage_backend_lock:
+        if storage_backend is None:
+            backend = setting("storage", "backend", AZURE_BLOB) or AZURE_BLOB
+            if backend == AZURE_BLOB:
+                storage_backend = BlobBackend()
+            elif backend == LOCAL:
+                storage_backend = LocalBackend(setting("storage", "local_root", "storage"),
+                                               setting("storage", "local_recording_url", ""))
+            else:
+                raise ValueError("storage.backend must be azure_blob or local, not " + str(backend))
+    return storage_backend
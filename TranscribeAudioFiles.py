@@ -9,31 +9,74 @@
 #
 ##############################################################
 
-import requests
+import ServiceClients
+import Metrics
 import json
-import pandas as pd
-import argparse
-import time
+from Configuration import get_configuration, setting
 
 
-config_file_name = "config.json"
+##############################################################
+# 
+# Speech to Text API and storage locations, built from config.json on
+# first use
+#
+##############################################################
+
+def speechURL(resource):
+    speech_api = get_configuration()["speech_api"]
+    endpoint = speech_api.get("endpoint") or "https://" + speech_api["region"] + ".cris.ai"
+    return endpoint.rstrip("/") + "/api/speechtotext/v2.1/" + resource + "/"
+
+
+def storagePath(container_name=None):
+    storage = get_configuration()["storage"]
+    endpoint = storage.get("blob_endpoint") or "https://" + storage["account_name"] + ".blob.core.windows.net"
+    return endpoint.rstrip("/") + "/" + (container_name or storage["audio_container"]) + "/"
+
+
+class SubmissionError(Exception):
+    pass
+
+
+##############################################################
+# 
+# One transcription as listed by the Speech service, and one result file
+# of a transcription. Plain __slots__ records are used on the polling and
+# fetching paths, which only need to look values up, and a DataFrame is
+# only built from them when a caller asks for one.
+#
+##############################################################
+
+class TranscriptionRecord:
+    __slots__ = ("id", "name", "status", "createdDateTime", "lastActionDateTime", "CallDuration", "ProcTime", "recordingsUrls")
+    # the columns of listAllTranscriptions
+    columns = ("id", "name", "status", "createdDateTime", "lastActionDateTime", "CallDuration", "ProcTime")
+
+    def __init__(self, id, name, status, createdDateTime, lastActionDateTime, CallDuration, recordingsUrls=()):
+        self.id = id
+        self.name = name
+        self.status = status
+        self.createdDateTime = createdDateTime
+        self.lastActionDateTime = lastActionDateTime
+        self.CallDuration = CallDuration
+        self.ProcTime = lastActionDateTime - createdDateTime
+        self.recordingsUrls = recordingsUrls
 
-with open(config_file_name, 'r') as f:
-    configuration = json.load(f)
+    def asdict(self):
+        return {field: getattr(self, field) for field in self.columns}
 
-model_name = configuration["speech_model"]["model_name"]
-endpoint_id = configuration["speech_model"]["endpoint_id"]
-account_name = configuration["storage"]["account_name"] 
-account_key = configuration["storage"]["account_key"] 
-transcription_container = configuration["storage"]["transcription_container"] 
-region = configuration["speech_api"]["region"]
 
-BaseURL ="https://" + region + ".cris.ai/api/speechtotext/v2.1/transcriptions/"
-EndpointURL = "https://" + region + ".cris.ai/api/speechtotext/v2.1/endpoints/"
-SUBSCRIPTION_KEY = configuration["speech_api"]["subscription_key"] 
+class TranscriptionFile:
+    __slots__ = ("TID", "fileName", "resultUrl", "recordingUrl")
 
-container_name = configuration["storage"]["audio_container"]
-STORAGE_PATH="https://" + account_name + ".blob.core.windows.net/" + container_name + "/"
+    def __init__(self, TID, fileName, resultUrl, recordingUrl=None):
+        self.TID = TID
+        self.fileName = fileName
+        self.resultUrl = resultUrl
+        self.recordingUrl = recordingUrl
+
+    def asdict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
 
 
 ##############################################################
@@ -44,11 +87,11 @@ STORAGE_PATH="https://" + account_name + ".blob.core.windows.net/" + container_n
 ##############################################################
 
 
-def listAllTranscriptions() :
+def listTranscriptionRecords() :
     import datetime
-    df = pd.DataFrame(columns=["id","name", "status","createdDateTime","lastActionDateTime","CallDuration"])
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-    r = requests.get(BaseURL, headers=headers)
+    records = []
+    r = ServiceClients.get_speech_session().get(speechURL("transcriptions"))
+    r.raise_for_status()
     js = json.loads(r.text)
     #print(js)
     for TR in js:
@@ -56,17 +99,21 @@ def listAllTranscriptions() :
             Dur="-"
         else :
             Dur = TR["properties"]["Duration"]
-        df = df.append({
-         "id":                  TR["id"],
-         "name":                TR["name"],
-         "status":              TR["status"],
-         "createdDateTime":     datetime.datetime.strptime(TR["createdDateTime"],"%Y-%m-%dT%H:%M:%SZ"),            
-         "lastActionDateTime":  datetime.datetime.strptime(TR["lastActionDateTime"],"%Y-%m-%dT%H:%M:%SZ"),
-         "CallDuration":            Dur      
-          }, ignore_index=True)
-        df["ProcTime"] = df["lastActionDateTime"] - df["createdDateTime"]
-        
-    return(df)
+        records.append(TranscriptionRecord(
+            TR["id"],
+            TR["name"],
+            TR["status"],
+            datetime.datetime.strptime(TR["createdDateTime"],"%Y-%m-%dT%H:%M:%SZ"),
+            datetime.datetime.strptime(TR["lastActionDateTime"],"%Y-%m-%dT%H:%M:%SZ"),
+            Dur,
+            TR.get("recordingsUrls", ())))
+    return records
+
+
+def listAllTranscriptions() :
+    import pandas as pd
+    return pd.DataFrame([record.asdict() for record in listTranscriptionRecords()],
+                        columns=list(TranscriptionRecord.columns))
 
 ##############################################################
 # 
@@ -79,8 +126,12 @@ def listAllTranscriptions() :
 
 def getTranscription(df):
     row=df.iloc[0,]
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-    r = requests.get(row["resultUrl"], headers=headers)
+    return getTranscriptionFromUrl(row["resultUrl"])
+
+
+def getTranscriptionFromUrl(resultUrl):
+    r = ServiceClients.get_speech_session().get(resultUrl)
+    r.raise_for_status()
     js = json.loads(r.text)
     return(js)
 
@@ -88,31 +139,29 @@ def getTranscription(df):
 ##############################################################
 # 
 # Given a transcription id obtain the blob file name (fileName) and the resulting
-# Url to the transcription (resultUrl)
+# Url to the transcription (resultUrl), and the Url of the recording it
+# was transcribed from when the service tells which one it is (recordingUrl)
 #
 ##############################################################
 
-def getTranscriptionFiles(TID) :
-    import datetime    
-    df = pd.DataFrame(columns=["TID","fileName", "resultUrl"])
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-    r = requests.get(BaseURL+TID, headers=headers)
+def listTranscriptionFiles(TID) :
+    files = []
+    r = ServiceClients.get_speech_session().get(speechURL("transcriptions")+TID)
+    r.raise_for_status()
     js = json.loads(r.text)
+    recordings = js.get("recordingsUrls") or []
     for r in js["results"] :
+      recordingUrl = r.get("recordingsUrl") or (recordings[0] if len(recordings) == 1 else None)
       for rurls in r["resultUrls"] :
-        df = df.append({
-         "TID":                      TID,
-         "fileName":                 rurls["fileName"],
-         "resultUrl":                rurls["resultUrl"]
-          }, ignore_index=True)
-    return(df)
-
-
+        files.append(TranscriptionFile(TID, rurls["fileName"], rurls["resultUrl"], recordingUrl))
+    return files
 
 
+def getTranscriptionFiles(TID) :
+    import pandas as pd
+    return pd.DataFrame([transcription_file.asdict() for transcription_file in listTranscriptionFiles(TID)],
+                        columns=list(TranscriptionFile.__slots__))
 
-from azure.storage.blob import BlockBlobService
-block_blob_service = BlockBlobService(account_name=account_name, account_key=account_key)
 
 ##############################################################
 # 
@@ -122,25 +171,30 @@ block_blob_service = BlockBlobService(account_name=account_name, account_key=acc
 ##############################################################
 
 def deleteAllTranscriptions() :
-   trs=listAllTranscriptions()
-   for x in trs["id"] :
+   for x in [record.id for record in listTranscriptionRecords()] :
       print(x)
-      headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-      r = requests.delete(BaseURL+x, headers=headers)
+      r = ServiceClients.get_speech_session().delete(speechURL("transcriptions")+x)
       print(r)
 
 
 ##############################################################
 # 
-# Given an model endpoint id return a custom model's id
+# Given an model endpoint id return a custom model's id. The id is only
+# looked up once per endpoint.
 #
 ##############################################################
 
+model_ids = {}
+
 def get_model_id(endpoint_id):
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY,"Content-Type": "application/json"}
-    r = requests.get(EndpointURL + endpoint_id, headers=headers)
+    if endpoint_id in model_ids:
+        return model_ids[endpoint_id]
+
+    headers = {"Content-Type": "application/json"}
+    r = ServiceClients.get_speech_session().get(speechURL("endpoints") + endpoint_id, headers=headers)
+    r.raise_for_status()
     model_meta = json.loads(r.text)
-    name = model_name
+    name = get_configuration()["speech_model"]["model_name"]
     model_id = ''
  
     for m in model_meta['models']:
@@ -148,76 +202,90 @@ def get_model_id(endpoint_id):
         if name not in m['description']:
             model_id = m['id']
     print("MODEL ID : ", model_id)
+    model_ids[endpoint_id] = model_id
     return model_id
  
 ##############################################################
 # 
-# Send POST request to Speech to Text API to start transcription using 
-# either a baseline model or a custom trained model
+# Send POST request to Speech to Text API to start transcription of one or
+# more recordings using either a baseline model or a custom trained model.
+# The id of the new transcription is read from the Location header of the
+# response. Raises SubmissionError when the service did not accept it.
 #
 ##############################################################
  
 
-def bulkTranscriptions(URL, blobname):
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY,"Content-Type": "application/json"}
-    if model_name.lower() != 'base_model':
-        print("Using custom model: " + model_name)
-        BD = """
-        {
-            "results": [],
-            "recordingsUrls": [ 
-                "__URL__"],
-            "locale": "en-US",
-            "name": "blob_name",
-            "models": [{"id":" """+ str(get_model_id(endpoint_id)) + """"}],
-            "properties": {
-                "PunctuationMode": "Automatic",
-                "ProfanityFilterMode": "Masked",
-                "AddWordLevelTimestamps": "False",
-                "AddSentiment": "False",
-                "AddDiarization" : "True"
-            }
+def submitTranscriptions(URLs, name):
+    headers = {"Content-Type": "application/json"}
+    BD = {
+        "results": [],
+        "recordingsUrls": list(URLs),
+        "locale": "en-US",
+        "name": name
+    }
+    speech_model = get_configuration()["speech_model"]
+    if speech_model["model_name"].lower() != 'base_model':
+        print("Using custom model: " + speech_model["model_name"])
+        BD["models"] = [{"id": str(get_model_id(speech_model["endpoint_id"]))}]
+        BD["properties"] = {
+            "PunctuationMode": "Automatic",
+            "ProfanityFilterMode": "Masked",
+            "AddWordLevelTimestamps": "False",
+            "AddSentiment": "False",
+            "AddDiarization" : "True"
         }
-        """ 
     else:
         print("Using base model.")
-        BD = """
-        {
-            "results": [],
-            "recordingsUrls": [ 
-                "__URL__"],
-            "locale": "en-US",
-            "name": "blob_name",
-            "properties": {
-                "PunctuationMode": "Automatic",
-                "ProfanityFilterMode": "Masked",
-                "AddWordLevelTimestamps": "False",
-                "AddSentiment": "True",
-                "AddDiarization" : "True"
-            }
+        BD["properties"] = {
+            "PunctuationMode": "Automatic",
+            "ProfanityFilterMode": "Masked",
+            "AddWordLevelTimestamps": "False",
+            "AddSentiment": "True",
+            "AddDiarization" : "True"
         }
-        """
     
-    print("Submitted: " + blobname + " for speech to text processing.")
+    print("Submitted: " + name + " for speech to text processing.")
     
-    BD = BD.replace("__URL__", URL)  
-    BD = BD.replace("blob_name", blobname)
-    r = requests.post(BaseURL, headers=headers,data=BD)
-    df = listAllTranscriptions()
-    for index, row in df.iterrows():
-      if row['name'] == blobname:
-        return row['id']
-
-
-
-
-
-
-
+    r = ServiceClients.get_speech_session().post(speechURL("transcriptions"), headers=headers, data=json.dumps(BD))
+    if r.status_code >= 400:
+        raise SubmissionError("Could not submit " + name + " for transcription: " + str(r.status_code) + " " + r.text)
+    location = r.headers.get("Location")
+    if location:
+        return location.rstrip("/").split("/")[-1]
 
+    # Fall back to finding the transcription by name if the service did not return its location
+    for record in listTranscriptionRecords():
+      if record.name == name:
+        return record.id
 
+    raise SubmissionError("Could not find the transcription submitted for " + name)
 
 
+def bulkTranscriptions(URL, blobname):
+    return submitTranscriptions([URL], blobname)
 
 
+##############################################################
+# 
+# Submit a list of (URL, blobname) recordings, grouping up to
+# recordings_per_job recordings into each transcription. Returns the
+# transcription ids. A group that could not be submitted is reported and
+# left out, and stays pending in the processing manifest for the next run.
+#
+##############################################################
 
+def bulkTranscriptionsGrouped(recordings, recordings_per_job=None):
+    if recordings_per_job is None:
+        recordings_per_job = setting("batch_config", "recordings_per_job", 1)
+    transcription_ids = []
+    for start in range(0, len(recordings), recordings_per_job):
+        group = recordings[start:start + recordings_per_job]
+        name = group[0][1]
+        if len(group) > 1:
+            name = name + " (+" + str(len(group) - 1) + " more)"
+        try:
+            with Metrics.get_metrics().stage("submit"):
+                transcription_ids.append(submitTranscriptions([URL for URL, blobname in group], name))
+        except SubmissionError as err:
+            print(err)
+    return transcription_ids
@@ -0,0 +1,224 @@
+##############################################################
+#
+# Python script that reads a JSON transcription from storage one
+# segment at a time, so that masking a long call does not hold the whole
+# transcription, or the whole masked document, in memory.
+#
+# The blob is read in chunks of chunk_size bytes (see the stream method of
+# the backends in StorageBackends.py) and parsed with
+# json.JSONDecoder.raw_decode as the chunks arrive. Only the header
+# values asked for are decoded, everything else before
+# AudioFileResults[0].SegmentResults is skipped without building it, and
+# the segments are then handed out one by one.
+#
+# ChunkStream turns the chunks of a download, or of a document being
+# written, into a readable stream for create_blob_from_stream.
+#
+##############################################################
+
+import codecs
+import io
+import json
+import re
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# characters that matter when skipping a value, outside and inside a string
+STRUCTURE = re.compile(r'["\[\]{}]')
+STRING_END = re.compile(r'["\\]')
+NUMBER_CHARACTERS = "0123456789.eE+-"
+
+
+class UnsupportedLayout(ValueError):
+    pass
+
+
+##############################################################
+#
+# A JSON document read from an iterable of UTF-8 byte chunks, keeping only
+# the text that has not been parsed yet
+#
+##############################################################
+
+class JSONStream:
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        self.eof = chunk is None
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(chunk or b"", final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError("Expected '" + character + "' in JSON document, found '" + self.buffer[self.pos] + "'")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a value at the end of the buffer, or a number followed by what
+                # can only be more of it (e.g. "12" then ".5"), may continue in
+                # the next chunk
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in NUMBER_CHARACTERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def skip(self):
+        if self.peek() not in '[{"':
+            self.value()
+            return
+        depth = 0
+        in_string = False
+        while True:
+            match = (STRING_END if in_string else STRUCTURE).search(self.buffer, self.pos)
+            if match is None or (match.group() == "\\" and match.end() == len(self.buffer)):
+                # keep an escape at the end of the buffer until the escaped character arrives
+                self.pos = len(self.buffer) if match is None else match.start()
+                if not self.fill():
+                    raise ValueError("Unexpected end of JSON document")
+                continue
+            character = match.group()
+            self.pos = match.end()
+            if character == "\\":
+                self.pos += 1
+            elif character == '"':
+                in_string = not in_string
+                if not in_string and depth == 0:
+                    return
+            elif character in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def iterObject(self):
+        # Yields every key; the caller reads or skips its value
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            character = self.peek()
+            self.pos += 1
+            if character == "}":
+                return
+            if character != ",":
+                raise ValueError("Expected ',' or '}' in JSON document, found '" + character + "'")
+
+    def iterArray(self):
+        # Yields before every element; the caller reads or skips it
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            character = self.peek()
+            self.pos += 1
+            if character == "]":
+                return
+            if character != ",":
+                raise ValueError("Expected ',' or ']' in JSON document, found '" + character + "'")
+
+
+##############################################################
+#
+# Read a transcription up to AudioFileResults[0].SegmentResults and return
+# the header_keys values of AudioFileResults[0] together with an iterator
+# over its segments. Raises UnsupportedLayout when a header value comes
+# after the segments, as it can then only be read from the whole document.
+#
+##############################################################
+
+def openTranscription(chunks, header_keys):
+    stream = JSONStream(chunks)
+    header = {}
+
+    def segments():
+        for _ in stream.iterArray():
+            yield stream.value()
+
+    for key in stream.iterObject():
+        if key != "AudioFileResults":
+            stream.skip()
+            continue
+        for _ in stream.iterArray():
+            for key in stream.iterObject():
+                if key == "SegmentResults":
+                    missing = [header_key for header_key in header_keys if header_key not in header]
+                    if missing:
+                        raise UnsupportedLayout(", ".join(missing) + " not found before SegmentResults")
+                    return header, segments()
+                if key in header_keys:
+                    header[key] = stream.value()
+                else:
+                    stream.skip()
+            raise KeyError("SegmentResults")
+        raise IndexError("AudioFileResults is empty")
+    raise KeyError("AudioFileResults")
+
+
+##############################################################
+#
+# Readable, non seekable binary stream over an iterable of byte chunks
+#
+##############################################################
+
+class ChunkStream(io.RawIOBase):
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
@@ -0,0 +1,257 @@
+##############################################################
+#
+# Python entry point that benchmarks the pipeline offline, against the
+# local stand-ins for the Speech, Text Analytics and Blob Storage services
+# in MockAzureServices.py. Synthetic recordings are put in the audio
+# container, and then the stages run end to end as the scripts run them:
+#
+#   transcribe  transcribe_blobs.submitRecordings and
+#               GetJSONTempFiles.getTranscriptionsContent (or
+#               transcribe_blobs.ingestContinuously with --continuous)
+#   mask        MaskBlobTranscriptions over the saved transcriptions, in
+#               this process or with --workers worker processes
+#
+# With --backend local the recordings, transcriptions and masked documents
+# are kept in a local directory (see StorageBackends.py) instead of the
+# stand-in Blob Storage.
+#
+# For every stage the files per minute, the API calls per transcript (by
+# service and by call type), the retries of the request scheduler and the
+# peak RSS of the benchmark and of its worker processes are reported, and
+# the metrics the scripts recorded (see Metrics.py) are saved with them.
+#
+# The settings are taken from config.json (or CONFIG_FILE) and the CONFIG_
+# environment overrides, with the endpoints, storage and local database
+# paths replaced, so the rate limits, concurrency and masking settings
+# being benchmarked are the ones in use. The results can be saved with
+# --output and compared with an earlier run with --baseline, in which case
+# the exit code is 1 when a stage got slower, or made more API calls per
+# transcript, by more than --tolerance.
+#
+# e.g. python benchmark.py --recordings 200 --latency 0.05 --throttle_rate 0.02 --output bench_output.txt
+#
+##############################################################
+
+import argparse
+import base64
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import MockAzureServices
+
+
+ACCOUNT_NAME = "benchaccount"
+AUDIO_CONTAINER = "audio"
+TRANSCRIPTION_CONTAINER = "transcriptions"
+AUDIO_FOLDER = "bench/audio/"
+JSON_FOLDER = "bench/json/"
+MASKED_FOLDER = "bench/masked/"
+
+
+def benchmarkEnvironment(server, work_dir, args):
+    environment = MockAzureServices.endpoints(server, ACCOUNT_NAME)
+    environment.update({
+        "CONFIG_SPEECH_API__REGION": "bench",
+        "CONFIG_SPEECH_API__SUBSCRIPTION_KEY": "bench",
+        "CONFIG_SPEECH_MODEL__MODEL_NAME": "base_model",
+        "CONFIG_TEXT_API__REGION": "bench",
+        "CONFIG_TEXT_API__SUBSCRIPTION_KEY": "bench",
+        "CONFIG_STORAGE__ACCOUNT_KEY": base64.b64encode(b"bench" * 8).decode("ascii"),
+        "CONFIG_STORAGE__AUDIO_CONTAINER": AUDIO_CONTAINER,
+        "CONFIG_STORAGE__TRANSCRIPTION_CONTAINER": TRANSCRIPTION_CONTAINER,
+        "CONFIG_STORAGE__SAS": "?sv=bench",
+        "CONFIG_BATCH_CONFIG__FILES_TO_PROCESS": str(args.recordings),
+        "CONFIG_BATCH_CONFIG__POLL_MIN_INTERVAL": str(args.poll_interval),
+        "CONFIG_BATCH_CONFIG__POLL_MAX_INTERVAL": str(args.poll_interval * 8),
+        "CONFIG_LEDGER__PATH": os.path.join(work_dir, "TranscriptionsLog.db"),
+        "CONFIG_ENTITY_CACHE__PATH": os.path.join(work_dir, "EntityCache.db"),
+    })
+    if args.no_entity_cache:
+        environment["CONFIG_ENTITY_CACHE__ENABLED"] = "false"
+    if args.backend == "local":
+        # the stand-in Speech service never downloads the recordings
+        environment.update({
+            "CONFIG_STORAGE__BACKEND": "local",
+            "CONFIG_STORAGE__LOCAL_ROOT": os.path.join(work_dir, "storage"),
+            "CONFIG_STORAGE__LOCAL_RECORDING_URL": server.base_url + "/recordings/",
+        })
+    return environment
+
+
+def seedRecordings(args, state, work_dir):
+    for index in range(args.recordings):
+        name = AUDIO_FOLDER + "recording_{:06d}.wav".format(index)
+        if args.backend == "local":
+            path = os.path.join(work_dir, "storage", AUDIO_CONTAINER, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(os.urandom(args.recording_bytes))
+        else:
+            state.putBlob(AUDIO_CONTAINER, name, os.urandom(args.recording_bytes))
+
+
+def savedFiles(args, state, container, folder):
+    if args.backend == "local":
+        import StorageBackends
+        return len(list(StorageBackends.get_storage_backend().list(container, folder)))
+    return len(state.blobNames(container, folder))
+
+
+def peakRSS():
+    # ru_maxrss is in kilobytes on Linux
+    return {"self_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+
+##############################################################
+#
+# Run one stage and report its throughput and the API calls it made
+#
+##############################################################
+
+def runStage(name, state, stage):
+    import RateLimiter
+
+    state.reset()
+    scheduler_before = RateLimiter.get_scheduler().stats()
+    start = time.time()
+    files = stage()
+    seconds = time.time() - start
+    calls = state.counts()
+    scheduler_after = RateLimiter.get_scheduler().stats()
+
+    by_service = {}
+    for call, count in calls.items():
+        service = call.split(" ")[0]
+        by_service[service] = by_service.get(service, 0) + count
+    total = sum(calls.values())
+    result = {
+        "files": files,
+        "seconds": round(seconds, 2),
+        "files_per_minute": round(files * 60 / seconds, 2) if seconds else 0,
+        "api_calls": total,
+        "api_calls_per_transcript": round(total / files, 2) if files else None,
+        "api_calls_by_service": by_service,
+        "api_calls_by_type": dict(sorted(calls.items())),
+        "scheduler": {key: scheduler_after[key] - scheduler_before[key] for key in scheduler_after},
+        "peak_rss": peakRSS()
+    }
+    print(18*"#" + " " + name + ": {files} files in {seconds}s, {files_per_minute} files/min, "
+          "{api_calls_per_transcript} API calls per transcript".format(**result))
+    return result
+
+
+def transcribeStage(args, state):
+    import transcribe_blobs
+    import GetJSONTempFiles
+
+    if args.continuous:
+        transcribe_blobs.ingestContinuously(AUDIO_FOLDER, JSON_FOLDER)
+    else:
+        transcription_ids = transcribe_blobs.submitRecordings(AUDIO_FOLDER)
+        GetJSONTempFiles.getTranscriptionsContent(transcription_ids, JSON_FOLDER)
+    return savedFiles(args, state, TRANSCRIPTION_CONTAINER, JSON_FOLDER)
+
+
+def maskStage(args, state):
+    import MaskBlobTranscriptions
+
+    succeeded, skipped, failed = MaskBlobTranscriptions.maskBlobs(JSON_FOLDER, MASKED_FOLDER, force=True, workers=args.workers)
+    return len(succeeded)
+
+
+##############################################################
+#
+# Compare with an earlier run: a stage regressed when its files per
+# minute dropped, or its API calls per transcript grew, by more than
+# `tolerance` (a fraction)
+#
+##############################################################
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for stage, result in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before is None:
+            continue
+        if before["files_per_minute"] and result["files_per_minute"] < before["files_per_minute"] * (1 - tolerance):
+            found.append("{}: {} files/min, was {}".format(stage, result["files_per_minute"], before["files_per_minute"]))
+        if before["api_calls_per_transcript"] and result["api_calls_per_transcript"] is not None \
+                and result["api_calls_per_transcript"] > before["api_calls_per_transcript"] * (1 + tolerance):
+            found.append("{}: {} API calls per transcript, was {}".format(
+                stage, result["api_calls_per_transcript"], before["api_calls_per_transcript"]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recordings", type=int, default=50, help="number of synthetic recordings")
+    parser.add_argument("--recording_bytes", type=int, default=4096, help="size of each synthetic recording")
+    parser.add_argument("--min_segments", type=int, default=20, help="fewest segments in a synthetic transcription")
+    parser.add_argument("--max_segments", type=int, default=400, help="most segments in a synthetic transcription")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds every request to the services takes")
+    parser.add_argument("--jitter", type=float, default=0.2, help="fraction the latency and job times vary by")
+    parser.add_argument("--job_seconds", type=float, default=2.0, help="seconds a transcription job runs")
+    parser.add_argument("--throttle_rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests answered with --error_status")
+    parser.add_argument("--error_status", type=int, default=503)
+    parser.add_argument("--failed_rate", type=float, default=0.0, help="fraction of transcription jobs that fail")
+    parser.add_argument("--poll_interval", type=float, default=0.5, help="shortest wait between status polls")
+    parser.add_argument("--continuous", action="store_true", help="transcribe with transcribe_blobs.py --continuous")
+    parser.add_argument("--workers", type=int, default=None, help="masking worker processes (default masking.workers)")
+    parser.add_argument("--backend", choices=("azure_blob", "local"), default="azure_blob",
+                        help="storage backend, the stand-in Blob Storage or a local directory")
+    parser.add_argument("--no_entity_cache", action="store_true", help="disable the entity cache")
+    parser.add_argument("--stages", default="transcribe,mask", help="comma separated stages to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="save the results as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed regression against the baseline")
+    args = parser.parse_args()
+
+    state = MockAzureServices.MockState(latency=args.latency, jitter=args.jitter, job_seconds=args.job_seconds,
+                                        throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                                        error_status=args.error_status, failed_rate=args.failed_rate,
+                                        min_segments=args.min_segments, max_segments=args.max_segments, seed=args.seed)
+    server = MockAzureServices.MockServer(state)
+    server.start()
+    print(18*"#" + " Stand-in services at " + server.base_url)
+
+    stages = {"transcribe": transcribeStage, "mask": maskStage}
+    results = {"arguments": vars(args), "stages": {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        # set before the scripts first read the configuration, and inherited by the worker processes
+        os.environ.update(benchmarkEnvironment(server, work_dir, args))
+        seedRecordings(args, state, work_dir)
+        for name in args.stages.split(","):
+            results["stages"][name] = runStage(name, state, lambda: stages[name](args, state))
+
+        import Metrics
+        results["metrics"] = Metrics.get_metrics().asdict()
+
+        import RunLedger
+        RunLedger.get_ledger().close()
+
+    server.shutdown()
+    results["peak_rss"] = peakRSS()
+    print(json.dumps(results["stages"], indent=2))
+    print("Peak RSS (MB): ", results["peak_rss"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print("REGRESSION " + regression)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
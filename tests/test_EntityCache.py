@@ -0,0 +1,144 @@
+##############################################################
+#
+# The two tiers of the entity cache: the in-memory LRU, the SQLite file
+# and its eviction, also when several processes share the file.
+#
+##############################################################
+
+import multiprocessing
+import sqlite3
+import pytest
+import EntityCache
+
+
+MATCHES = [("John Smith", "Person", None, 18, 10, "0.99")]
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # every call to time.time() is one second later, so the least recently used entry is known
+    now = [0.0]
+
+    def tick():
+        now[0] += 1
+        return now[0]
+    monkeypatch.setattr(EntityCache.time, "time", tick)
+    return now
+
+
+def diskSize(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("SELECT COALESCE(SUM(size), 0) FROM entities").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def diskKeys(path):
+    connection = sqlite3.connect(path)
+    try:
+        return {row[0] for row in connection.execute("SELECT key FROM entities")}
+    finally:
+        connection.close()
+
+
+def entryMatches(index):
+    return [("Name {:04d}".format(index), "Person", None, index, 9, "0.50")]
+
+
+def entrySize():
+    return len(EntityCache.json.dumps([tuple(match) for match in entryMatches(0)]))
+
+
+def test_miss_then_memory_hit():
+    cache = EntityCache.EntityCache()
+    assert cache.get("en", "Hello John Smith") is None
+    cache.put("en", "Hello John Smith", MATCHES)
+    assert cache.get("en", "Hello John Smith") == MATCHES
+    assert cache.get("fr", "Hello John Smith") is None
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 0, 2)
+
+
+def test_memory_evicts_least_recently_used():
+    cache = EntityCache.EntityCache(memory_entries=2)
+    cache.put("en", "a", MATCHES)
+    cache.put("en", "b", MATCHES)
+    cache.get("en", "a")
+    cache.put("en", "c", MATCHES)
+    assert cache.get("en", "b") is None
+    assert cache.get("en", "a") == MATCHES
+    assert cache.get("en", "c") == MATCHES
+
+
+def test_unwritten_entries_are_hits(tmp_path):
+    cache = EntityCache.EntityCache(str(tmp_path / "cache.db"), memory_entries=0)
+    cache.put("en", "a", MATCHES)
+    assert cache.get("en", "a") == MATCHES
+    assert diskSize(str(tmp_path / "cache.db")) == 0
+
+
+def test_close_writes_the_entries_for_the_next_run(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = EntityCache.EntityCache(path)
+    cache.put("en", "a", MATCHES)
+    cache.close()
+
+    cache = EntityCache.EntityCache(path)
+    assert cache.get("en", "a") == MATCHES
+    assert cache.stats()["disk_hits"] == 1
+    cache.close()
+
+
+def test_entries_are_written_every_commit_every_puts(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = EntityCache.EntityCache(path, commit_every=3)
+    for index in range(5):
+        cache.put("en", str(index), entryMatches(index))
+    assert len(diskKeys(path)) == 3
+    cache.flush()
+    assert len(diskKeys(path)) == 5
+    cache.close()
+
+
+def test_disk_evicts_least_recently_used(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = EntityCache.EntityCache(path, memory_entries=0, max_disk_bytes=10 * entrySize(), commit_every=1)
+    for index in range(10):
+        cache.put("en", str(index), entryMatches(index))
+    # entry 0 is used again, so entry 1 is now the least recently used
+    assert cache.get("en", "0") == entryMatches(0)
+    cache.put("en", "10", entryMatches(10))
+    cache.close()
+
+    keys = diskKeys(path)
+    assert diskSize(path) <= 0.9 * 10 * entrySize()
+    assert EntityCache.cacheKey("en", "0") in keys
+    assert EntityCache.cacheKey("en", "10") in keys
+    assert EntityCache.cacheKey("en", "1") not in keys
+
+
+def fillCache(path, first, count, max_disk_bytes, barrier):
+    cache = EntityCache.EntityCache(path, max_disk_bytes=max_disk_bytes, commit_every=10)
+    # both processes have read the size of the file before either writes
+    barrier.wait()
+    for index in range(first, first + count):
+        cache.put("en", str(index), entryMatches(index))
+    cache.close()
+
+
+def test_processes_sharing_the_file_keep_it_under_the_limit(tmp_path):
+    path = str(tmp_path / "cache.db")
+    EntityCache.EntityCache(path).close()
+    max_disk_bytes = 100 * entrySize()
+    # each process on its own stays under the limit, together they do not
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(2)
+    processes = [context.Process(target=fillCache, args=(path, first, 80, max_disk_bytes, barrier))
+                 for first in (0, 1000)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    assert 0 < diskSize(path) <= max_disk_bytes
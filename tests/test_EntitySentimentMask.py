@@ -0,0 +1,87 @@
+##############################################################
+#
+# maskDocumentStream has to give exactly the text json.dumps gives for the
+# document maskDocument returns, however the transcription is split into
+# chunks when it is read and into windows when it is masked.
+#
+##############################################################
+
+import json
+import pytest
+import Configuration
+import EntityCache
+import EntityDetectors
+import EntitySentimentMask
+import TranscriptionStream
+
+
+DISPLAYS = ["Hello, my name is John Smith.", "Thanks John, I'm calling about order two nine 42.",
+            "Ça va? Zoë said \"hi\" — call me on 0123 456 789 \U0001F600", "Mary and Peter are here.",
+            "\tTabs\\backslashes and\nnew lines"]
+
+
+@pytest.fixture(autouse=True)
+def configuration():
+    saved = Configuration.configuration
+    Configuration.configuration = {
+        "text_api": {"subscription_key": ""},
+        "entity_detection": {"backend": "local", "fallback": "none"},
+        "entity_cache": {"enabled": False},
+        "masking": {"summary": True},
+    }
+    EntityCache.entity_cache = None
+    EntityDetectors.entity_detectors.clear()
+    yield
+    Configuration.configuration = saved
+    EntityCache.entity_cache = None
+    EntityDetectors.entity_detectors.clear()
+
+
+def transcription(segment_count):
+    segments = [{
+        "ChannelNumber": index % 2,
+        "OffsetInSeconds": index * 4.5,
+        "DurationInSeconds": 4.0,
+        "NBest": [{
+            "Confidence": 0.9 - index / 100,
+            "Display": DISPLAYS[index % len(DISPLAYS)],
+            "Sentiment": {"Negative": 0.1, "Positive": 0.7 - index / 50, "Neutral": 0.2},
+        }],
+    } for index in range(segment_count)]
+    return {
+        "AudioFileResults": [{
+            "AudioFileName": "call été.wav",
+            "AudioFileUrl": "https://example/audio/call.wav",
+            "AudioLengthInSeconds": segment_count * 4.5,
+            "CombinedResults": [{"Display": " ".join(DISPLAYS)}],
+            "SegmentResults": segments,
+        }]
+    }
+
+
+def chunked(data, chunk_size):
+    return [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+
+
+@pytest.mark.parametrize("segment_count", [0, 1, 2, 3, 12])
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1024 * 1024])
+@pytest.mark.parametrize("window", [1, 2, 1000])
+def test_stream_matches_masked_document(segment_count, chunk_size, window):
+    data = json.dumps(transcription(segment_count)).encode("utf-8")
+    expected = json.dumps(EntitySentimentMask.maskDocument(json.loads(data)))
+
+    header, segment_results = TranscriptionStream.openTranscription(chunked(data, chunk_size),
+                                                                    EntitySentimentMask.STREAM_HEADER_KEYS)
+    streamed = "".join(EntitySentimentMask.maskDocumentStream(header, segment_results, window, spool_max_size=16))
+
+    assert streamed == expected
+
+
+def test_stream_matches_masked_document_without_summary():
+    Configuration.configuration["masking"]["summary"] = False
+    data = json.dumps(transcription(5)).encode("utf-8")
+    expected = json.dumps(EntitySentimentMask.maskDocument(json.loads(data)))
+
+    header, segment_results = TranscriptionStream.openTranscription(chunked(data, 5), EntitySentimentMask.STREAM_HEADER_KEYS)
+
+    assert "".join(EntitySentimentMask.maskDocumentStream(header, segment_results, 2)) == expected
@@ -0,0 +1,70 @@
+##############################################################
+#
+# The transcription poller keeps polling, backing off, when listing the
+# transcriptions fails, so a long running ingestion is not stopped by it,
+# and the names finished transcriptions are saved under with passthrough.
+#
+##############################################################
+
+import types
+import pytest
+import requests
+import GetJSONTempFiles
+
+
+def record(transcription_id, status):
+    return types.SimpleNamespace(id=transcription_id, status=status)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(GetJSONTempFiles.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def listings(monkeypatch, *outcomes):
+    # listTranscriptionRecords answering with each outcome in turn, raising the exceptions
+    outcomes = iter(outcomes)
+
+    def listTranscriptionRecords():
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    monkeypatch.setattr(GetJSONTempFiles, "listTranscriptionRecords", listTranscriptionRecords)
+
+
+def test_poller_backs_off_when_the_listing_fails(monkeypatch, sleeps):
+    listings(monkeypatch,
+             [record("a", "Running"), record("b", "Running")],
+             requests.HTTPError("503 Server Error"),
+             requests.ConnectionError("connection reset"),
+             [record("a", "Succeeded"), record("b", "Failed")])
+    poller = GetJSONTempFiles.TranscriptionPoller(["a", "b"], min_interval=1, max_interval=8, jitter=0)
+
+    assert [row.id for row in poller.completed()] == ["a", "b"]
+    assert sleeps == [2, 4, 8]
+    assert poller.pending == set()
+
+
+def test_poller_still_raises_other_errors(monkeypatch, sleeps):
+    listings(monkeypatch, ValueError("not JSON"))
+    poller = GetJSONTempFiles.TranscriptionPoller(["a"], min_interval=1, max_interval=8, jitter=0)
+    with pytest.raises(ValueError):
+        list(poller.completed())
+
+
+def test_passthrough_result_is_named_after_its_recording(monkeypatch):
+    monkeypatch.setattr(GetJSONTempFiles, "audioBlobNameFromUrl", lambda url: "calls/2020/call 7.wav")
+    transcription_file = GetJSONTempFiles.TranscribeAudioFiles.TranscriptionFile(
+        "tid-1", "channel_0.json", "https://example/result", "https://example/audio/calls/2020/call 7.wav?sv=1")
+    assert GetJSONTempFiles.passthroughFileName(transcription_file, "json/") == "json/call 7.json"
+
+
+def test_passthrough_result_without_a_recording_is_named_after_its_transcription():
+    # result names repeat in every transcription, so they alone would overwrite each other
+    names = {GetJSONTempFiles.passthroughFileName(
+        GetJSONTempFiles.TranscribeAudioFiles.TranscriptionFile(tid, "results/channel_0.json", "https://example/result"), "json/")
+        for tid in ("tid-1", "tid-2")}
+    assert names == {"json/tid-1_channel_0.json", "json/tid-2_channel_0.json"}
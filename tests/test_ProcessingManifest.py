@@ -0,0 +1,77 @@
+##############################################################
+#
+# The decisions of the processing manifest: which blobs are processed
+# again, which are skipped as unchanged and which as duplicates.
+#
+##############################################################
+
+import pytest
+import ProcessingManifest
+from ProcessingManifest import TRANSCRIBE, MASK
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return ProcessingManifest.ProcessingManifest(str(tmp_path / "manifest.db"))
+
+
+def test_new_blob_is_processed(manifest):
+    assert manifest.shouldProcess(MASK, "a.json", '"1"') == (True, None)
+
+
+def test_done_blob_with_the_same_etag_is_skipped(manifest):
+    manifest.markDone(MASK, "a.json", "masked/a.json", etag='"1"')
+    assert manifest.shouldProcess(MASK, "a.json", '"1"') == (False, "unchanged")
+
+
+def test_done_blob_with_the_same_content_is_skipped(manifest):
+    manifest.markDone(MASK, "a.json", etag='"1"', content_hash="md5")
+    assert manifest.shouldProcess(MASK, "a.json", '"2"', "md5") == (False, "unchanged")
+
+
+def test_changed_blob_is_processed(manifest):
+    manifest.markDone(MASK, "a.json", etag='"1"', content_hash="md5")
+    assert manifest.shouldProcess(MASK, "a.json", '"2"', "other") == (True, None)
+
+
+def test_blob_done_by_the_streaming_pipeline_is_skipped(manifest):
+    # the pipeline marks a recording done before it is ever listed
+    manifest.markDone(TRANSCRIBE, "a.wav", "json/a.json")
+    assert manifest.shouldProcess(TRANSCRIBE, "a.wav", '"1"') == (False, "done")
+
+
+def test_pending_blob_is_processed_again(manifest):
+    manifest.markPending(TRANSCRIBE, "a.wav", '"1"')
+    assert manifest.shouldProcess(TRANSCRIBE, "a.wav", '"1"') == (True, None)
+
+
+def test_failed_blob_is_processed_again(manifest):
+    manifest.markPending(TRANSCRIBE, "a.wav", '"1"')
+    manifest.markFailed(TRANSCRIBE, "a.wav")
+    assert manifest.shouldProcess(TRANSCRIBE, "a.wav", '"1"') == (True, None)
+
+
+def test_recording_with_the_content_of_a_pending_one_is_a_duplicate(manifest):
+    manifest.markPending(TRANSCRIBE, "a.wav", '"1"', "md5")
+    assert manifest.shouldProcess(TRANSCRIBE, "b.wav", '"2"', "md5") == (False, "duplicate of a.wav")
+    # and stays one on the next run while the original is done
+    manifest.markDone(TRANSCRIBE, "a.wav", "json/a.json")
+    assert manifest.shouldProcess(TRANSCRIBE, "b.wav", '"2"', "md5") == (False, "unchanged")
+
+
+def test_duplicate_is_processed_when_its_original_failed(manifest):
+    manifest.markPending(TRANSCRIBE, "a.wav", '"1"', "md5")
+    manifest.shouldProcess(TRANSCRIBE, "b.wav", '"2"', "md5")
+    manifest.markFailed(TRANSCRIBE, "a.wav")
+    assert manifest.shouldProcess(TRANSCRIBE, "b.wav", '"2"', "md5") == (True, None)
+
+
+def test_only_recordings_are_checked_for_duplicates(manifest):
+    manifest.markDone(MASK, "a.json", etag='"1"', content_hash="md5")
+    assert manifest.shouldProcess(MASK, "b.json", '"2"', "md5") == (True, None)
+
+
+def test_decisions_are_kept_across_runs(tmp_path):
+    path = str(tmp_path / "manifest.db")
+    ProcessingManifest.ProcessingManifest(path).markDone(MASK, "a.json", etag='"1"')
+    assert ProcessingManifest.ProcessingManifest(path).shouldProcess(MASK, "a.json", '"1"') == (False, "unchanged")
@@ -0,0 +1,192 @@
+##############################################################
+#
+# Token refill, Retry-After and which requests are retried by the
+# request scheduler, against a fake clock that sleeping moves forward.
+#
+##############################################################
+
+import email.utils
+import pytest
+import requests
+import RateLimiter
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Response:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ServiceError(Exception):
+
+    def __init__(self, response):
+        super().__init__(str(response.status_code))
+        self.response = response
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(RateLimiter.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(RateLimiter.time, "sleep", clock.sleep)
+    # no jitter in the backoff
+    monkeypatch.setattr(RateLimiter.random, "uniform", lambda low, high: high)
+    return clock
+
+
+def sender(*outcomes):
+    # send() that answers with each outcome in turn, raising the exceptions
+    calls = []
+
+    def send():
+        outcome = outcomes[len(calls)]
+        calls.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return send, calls
+
+
+def test_bucket_allows_a_burst_then_waits_for_refill(clock):
+    bucket = RateLimiter.TokenBucket(2, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [0.5]
+    # one second refills two tokens
+    clock.now += 1
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == [0.5]
+
+
+def test_bucket_never_holds_more_than_its_burst(clock):
+    bucket = RateLimiter.TokenBucket(1, burst=2)
+    clock.now += 60
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == [1]
+
+
+def test_blocked_bucket_waits_until_the_block_has_passed(clock):
+    bucket = RateLimiter.TokenBucket(10, burst=10)
+    bucket.block(7)
+    bucket.acquire()
+    assert clock.sleeps == [7]
+
+
+def test_retry_after_in_seconds_and_as_a_date(clock):
+    assert RateLimiter.retryAfter(Response(429, {"Retry-After": "4"})) == 4
+    assert RateLimiter.retryAfter(Response(429)) is None
+    retry_at = email.utils.formatdate(usegmt=True)
+    assert RateLimiter.retryAfter(Response(429, {"Retry-After": retry_at})) == 0
+
+
+def test_throttled_request_waits_for_retry_after_and_blocks_the_key(clock):
+    scheduler = RateLimiter.RequestScheduler(max_retries=3, apis={"speech": {"requests_per_second": 100, "burst": 100}})
+    throttled = Response(429, {"Retry-After": "5"})
+    send, calls = sender(throttled, Response(200))
+    assert scheduler.call("speech", "key", "GET transcriptions", send).status_code == 200
+    assert len(calls) == 2
+    assert clock.sleeps == [5]
+    assert throttled.closed
+    assert scheduler.stats() == {"retries": 1, "throttled": 1}
+    # the other endpoints of the key were held back as well
+    assert scheduler.buckets[("speech", "key")].blocked_until == 1005
+
+
+def test_server_error_is_retried_with_exponential_backoff(clock):
+    scheduler = RateLimiter.RequestScheduler(max_retries=3, backoff_base=1, backoff_max=3)
+    send, calls = sender(Response(500), Response(503), ServiceError(Response(502)), Response(200))
+    assert scheduler.call("speech", "key", "GET transcriptions", send).status_code == 200
+    assert clock.sleeps == [1, 2, 3]
+
+
+def test_last_response_is_returned_once_the_retries_are_used_up(clock):
+    scheduler = RateLimiter.RequestScheduler(max_retries=2)
+    send, calls = sender(Response(503), Response(503), Response(503))
+    assert scheduler.call("speech", "key", "GET transcriptions", send).status_code == 503
+    assert len(calls) == 3
+
+
+def test_last_error_is_raised_once_the_retries_are_used_up(clock):
+    scheduler = RateLimiter.RequestScheduler(max_retries=1)
+    send, calls = sender(ServiceError(Response(503)), ServiceError(Response(503)))
+    with pytest.raises(ServiceError):
+        scheduler.call("speech", "key", "GET transcriptions", send)
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("outcome", [Response(500), Response(502)])
+def test_post_that_may_have_been_carried_out_is_not_retried(clock, outcome):
+    scheduler = RateLimiter.RequestScheduler(max_retries=3)
+    send, calls = sender(outcome, Response(201))
+    assert scheduler.call("speech", "key", "POST transcriptions", send, "POST") is outcome
+    assert len(calls) == 1
+
+
+def test_post_that_failed_with_an_error_status_raises(clock):
+    scheduler = RateLimiter.RequestScheduler(max_retries=3)
+    send, calls = sender(ServiceError(Response(500)), Response(201))
+    with pytest.raises(ServiceError):
+        scheduler.call("text_analytics", "key", "POST entities", send, "POST")
+    assert len(calls) == 1
+
+
+def test_post_is_retried_when_throttled(clock):
+    scheduler = RateLimiter.RequestScheduler(max_retries=3)
+    send, calls = sender(Response(429, {"Retry-After": "2"}), Response(201))
+    assert scheduler.call("speech", "key", "POST transcriptions", send, "POST").status_code == 201
+    assert clock.sleeps == [2]
+
+
+def test_connection_error_is_only_retried_for_idempotent_methods(clock):
+    scheduler = RateLimiter.RequestScheduler(max_retries=3)
+    send, calls = sender(requests.ConnectionError(), Response(200))
+    assert scheduler.call("speech", "key", "GET transcriptions", send).status_code == 200
+
+    send, calls = sender(requests.ConnectionError(), Response(201))
+    with pytest.raises(requests.ConnectionError):
+        scheduler.call("speech", "key", "POST transcriptions", send, "POST")
+    assert len(calls) == 1
+
+
+def test_transcription_ids_share_the_endpoint_bucket():
+    first = RateLimiter.endpointName("get", "https://speech/api/speechtotext/v2.1/transcriptions/"
+                                            "0f8fad5b-d9cb-469f-a165-70867728950e?x=1")
+    second = RateLimiter.endpointName("GET", "https://speech/api/speechtotext/v2.1/transcriptions/"
+                                             "7c9e6679-7425-40de-944b-e07fc1f90ae7")
+    assert first == second == "GET speech/api/speechtotext/v2.1/transcriptions/{id}"
+
+
+def test_shared_limits_divide_the_limits_between_processes():
+    limits = {"max_in_flight": 10, "max_retries": 5, "backoff_base": 1, "backoff_max": 60,
+              "apis": {"speech": {"requests_per_second": 4, "burst": 2,
+                                  "endpoints": {"POST transcriptions": {"requests_per_second": 1}}}}}
+    shared = RateLimiter.sharedLimits(limits, 4)
+    assert shared["max_in_flight"] == 2
+    assert shared["apis"]["speech"]["requests_per_second"] == 1
+    assert shared["apis"]["speech"]["burst"] == 1
+    assert shared["apis"]["speech"]["endpoints"]["POST transcriptions"]["requests_per_second"] == 0.25
+    # the configured limits are left as they are
+    assert limits["apis"]["speech"]["requests_per_second"] == 4
@@ -0,0 +1,97 @@
+##############################################################
+#
+# RedactionEngine.py has to mask exactly like the code it replaced: one
+# str.replace per number rule per segment and one string rebuild per
+# entity. The old code is kept here as the reference and compared with the
+# engine on fixed and on random sentences.
+#
+##############################################################
+
+import random
+import RedactionEngine
+
+
+OLD_REPLACEMENTS = {' one': '#', 'two': '#', 'three': '#', 'four': '#', 'five': '#', 'six': '#', 'seven': '#',
+                    'eight': '#', 'nine': '#', 'zero': '#', '1': '#', '2': '#', '3': '#', '4': '#', '5': '#',
+                    '6': '#', '7': '#', '8': '#', '9': '#', '0': '#'}
+
+WORDS = ["one", " one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "zero", "eightwo",
+         "twone", "sevenine", "John", "Smith", "call", "account", "0", "12", "345", "6789", " ", "  ", ",", "\n"]
+
+
+def oldMaskNumbers(speaker_display):
+    for src, target in OLD_REPLACEMENTS.items():
+        speaker_display = speaker_display.replace(src, target)
+    return speaker_display
+
+
+def oldMaskEntities(sentence, startIndex, endIndex):
+    mask_length = endIndex-startIndex
+    mask_tag = "Person"
+    word_to_replace_with = None
+    if mask_length > len(mask_tag):
+        x = mask_length - len(mask_tag)
+        word_to_replace_with = mask_tag + (x * "#")
+    else:
+        word_to_replace_with = mask_tag
+    sentence="".join((sentence[:startIndex],word_to_replace_with, sentence[endIndex:]))
+    return sentence
+
+
+def oldMaskMultipleEntities(sentence, offsets):
+    speakertext = sentence
+    if len(offsets) > 1:
+        for i in range(0,len(offsets)):
+            s = oldMaskEntities(speakertext, offsets[i][0], offsets[i][1])
+            speakertext = s
+    elif len(offsets) == 1:
+        speakertext = oldMaskEntities(speakertext, offsets[0][0], offsets[0][1])
+    else:
+        return speakertext
+    return speakertext
+
+
+def randomSentence(rng, words=WORDS):
+    return "".join(rng.choice(words) for _ in range(rng.randint(0, 12)))
+
+
+def randomOffsets(rng, sentence):
+    offsets = []
+    for _ in range(rng.randint(0, 4)):
+        start = rng.randint(-2, len(sentence) + 2)
+        offsets.append([start, start + rng.randint(-1, 12)])
+    return offsets
+
+
+def test_number_rules_in_order():
+    for sentence in ["eightwo", "twone", "one two three", "call 0123456789", "zero one", "gone", ""]:
+        assert RedactionEngine.maskNumbers(sentence) == oldMaskNumbers(sentence)
+
+
+def test_numbers_in_segments_match_per_segment_masking():
+    rng = random.Random(8)
+    for _ in range(2000):
+        sentences = [randomSentence(rng) for _ in range(rng.randint(0, 6))]
+        assert RedactionEngine.maskNumbersInSegments(sentences) == [oldMaskNumbers(sentence) for sentence in sentences]
+
+
+def test_entity_spans():
+    cases = [
+        ("", []),
+        ("John called", [[0, 4]]),
+        ("John and Mary Smith", [[0, 4], [9, 19]]),
+        ("Al met Bo", [[0, 2], [7, 9]]),
+        ("Jonathan Smithers", [[9, 17], [0, 8]]),
+        ("Overlapping names", [[0, 11], [5, 17]]),
+        ("Out of range", [[10, 20]]),
+    ]
+    for sentence, offsets in cases:
+        assert RedactionEngine.maskEntitySpans(sentence, offsets) == oldMaskMultipleEntities(sentence, offsets)
+
+
+def test_entity_spans_random():
+    rng = random.Random(8)
+    for _ in range(20000):
+        sentence = randomSentence(rng)
+        offsets = randomOffsets(rng, sentence)
+        assert RedactionEngine.maskEntitySpans(sentence, offsets) == oldMaskMultipleEntities(sentence, offsets)
@@ -0,0 +1,177 @@
+##############################################################
+#
+# Python entry point that runs the transcription and the masking as one
+# streaming pipeline. Recordings are submitted as in transcribe_blobs.py,
+# and as soon as a transcription completes its parsed JSON is handed in
+# memory to the entity extraction, sentiment and masking stage, without
+# writing the unmasked JSON to Blob Storage and reading it back.
+#
+# The stages run in their own threads and are connected by bounded queues:
+#
+#   poll -> fetch_queue -> fetch workers -> mask_queue -> mask workers
+#
+# Writing the raw (unmasked) transcription is optional and only happens
+# when --json_target_folder is given. The depth of both queues is recorded
+# in the queue_depth metric (see Metrics.py).
+#
+##############################################################
+
+import argparse
+import json
+import queue
+import threading
+import StorageBackends
+import GetJSONTempFiles
+import EntitySentimentMask
+import transcribe_blobs
+import RunLedger
+import ProcessingManifest
+import EntityCache
+import Sharding
+import Metrics
+import Compression
+from Configuration import setting
+
+
+# Placed on a queue once per worker to tell it there is no more work
+STOP = None
+
+
+class TranscriptionPipeline:
+
+    def __init__(self, masked_target_folder, json_target_folder=None, fetch_workers=None, mask_workers=None, queue_size=None):
+        # the sizes default to the pipeline section of config.json
+        if fetch_workers is None:
+            fetch_workers = setting("pipeline", "fetch_workers", 4)
+        if mask_workers is None:
+            mask_workers = setting("pipeline", "mask_workers", 4)
+        if queue_size is None:
+            queue_size = setting("pipeline", "queue_size", 16)
+        self.masked_target_folder = masked_target_folder
+        self.json_target_folder = json_target_folder
+        self.fetch_workers = fetch_workers
+        self.mask_workers = mask_workers
+        self.fetch_queue = queue.Queue(maxsize=queue_size)
+        self.mask_queue = queue.Queue(maxsize=queue_size)
+        self.storage = StorageBackends.get_storage_backend()
+        self.transcription_container = setting("storage", "transcription_container")
+        self.lock = threading.Lock()
+        self.masked_files = []
+        self.failed = []
+
+    def fail(self, name, err):
+        print("## " + name + " failed: {}".format(err))
+        with self.lock:
+            self.failed.append(name)
+
+    ##############################################################
+    #
+    # Fetch stage: get the JSON of every recording in a succeeded
+    # transcription, optionally save it, pass it on to the mask stage and
+    # delete the transcription from the Speech service
+    #
+    ##############################################################
+
+    def fetch(self):
+        while True:
+            transcription_id = self.fetch_queue.get()
+            if transcription_id is STOP:
+                break
+            try:
+                for file_name, transcription_json in GetJSONTempFiles.fetchTranscriptions(transcription_id, self.json_target_folder or ""):
+                    if self.json_target_folder is not None:
+                        print("Saving file: " + file_name + " to blob storage container: " + self.transcription_container)
+                        Compression.createBlobFromBytes(self.storage, self.transcription_container, file_name, json.dumps(transcription_json).encode("utf-8"))
+                    self.mask_queue.put((file_name, transcription_json))
+                    Metrics.get_metrics().gauge("queue_depth", self.mask_queue.qsize(), queue="mask")
+                GetJSONTempFiles.deleteTranscription(transcription_id)
+            except Exception as err:
+                self.fail(transcription_id, err)
+
+    ##############################################################
+    #
+    # Mask stage: extract entities and sentiment, mask the entities and
+    # write the Masked_ document
+    #
+    ##############################################################
+
+    def mask(self):
+        while True:
+            item = self.mask_queue.get()
+            if item is STOP:
+                break
+            file_name, transcription_json = item
+            try:
+                with Metrics.get_metrics().stage("mask"):
+                    document = EntitySentimentMask.maskDocument(transcription_json)
+                    masked_file_name = EntitySentimentMask.saveMaskedDocument(self.storage, document, file_name, self.masked_target_folder)
+                Metrics.get_metrics().increment("transcripts_total", stage="mask")
+            except Exception as err:
+                self.fail(file_name, err)
+                RunLedger.get_ledger().logMasking(file_name, None, "Failed", err)
+                continue
+            outcome = "Error" if masked_file_name.split("/")[-1].startswith("Error_") else "Masked"
+            RunLedger.get_ledger().logMasking(file_name, masked_file_name, outcome)
+            if outcome == "Masked":
+                manifest = ProcessingManifest.get_manifest()
+                manifest.markDone(ProcessingManifest.TRANSCRIBE, GetJSONTempFiles.audioBlobName(transcription_json), masked_file_name)
+                if self.json_target_folder is not None:
+                    manifest.markDone(ProcessingManifest.MASK, file_name, masked_file_name)
+            print("## " + file_name + " masked to " + masked_file_name)
+            with self.lock:
+                self.masked_files.append(masked_file_name)
+
+    def run(self, transcription_ids):
+        fetchers = [threading.Thread(target=self.fetch, daemon=True) for i in range(self.fetch_workers)]
+        maskers = [threading.Thread(target=self.mask, daemon=True) for i in range(self.mask_workers)]
+        for worker in fetchers + maskers:
+            worker.start()
+
+        # Poll stage, in this thread
+        for row in GetJSONTempFiles.pollTranscriptions(transcription_ids):
+            GetJSONTempFiles.logTranscriptionRecord(row)
+            if row.status == 'Succeeded':
+                self.fetch_queue.put(row.id)
+                Metrics.get_metrics().gauge("queue_depth", self.fetch_queue.qsize(), queue="fetch")
+            else:
+                GetJSONTempFiles.markRecordingsFailed(row)
+
+        for worker in fetchers:
+            self.fetch_queue.put(STOP)
+        for worker in fetchers:
+            worker.join()
+        for worker in maskers:
+            self.mask_queue.put(STOP)
+        for worker in maskers:
+            worker.join()
+
+        RunLedger.get_ledger().flush()
+        Metrics.get_metrics().export()
+
+        print("## Masked transcriptions: ", len(self.masked_files))
+        print("## Failed: ", len(self.failed))
+        print("## Entity cache: ", EntityCache.get_entity_cache().stats())
+        for name in self.failed:
+            print("##   ", name)
+        return self.masked_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("audio_source_folder")
+    parser.add_argument("masked_target_folder")
+    parser.add_argument("--json_target_folder", default=None, help="also save the unmasked transcriptions to this folder")
+    parser.add_argument("--fetch_workers", type=int, default=None)
+    parser.add_argument("--mask_workers", type=int, default=None)
+    parser.add_argument("--queue_size", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="transcribe recordings that were already transcribed")
+    parser.add_argument("--shard", type=Sharding.parseShard, default=None, help="only process shard i of N, e.g. 0/4")
+    args = parser.parse_args()
+
+    audiofiles_list = transcribe_blobs.submitRecordings(args.audio_source_folder, args.force, args.shard)
+
+    print(18*"#" + "PROCESSING....." + 18*"#")
+
+    pipeline = TranscriptionPipeline(args.masked_target_folder, args.json_target_folder,
+                                     args.fetch_workers, args.mask_workers, args.queue_size)
+    pipeline.run(audiofiles_list)
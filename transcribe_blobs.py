@@ -1,91 +1,163 @@
 ##############################################################
-# 
+#
 # Author: Fatos Ismali
 # Date: 30/03/2020
-# 
-# Main Python entry point to the transcription process. Traverses through a given 
+#
+# Main Python entry point to the transcription process. Traverses through a given
 # Azure storage blob container and folder within it and kicks of the transcription
 # process for every .mp3 or .wav file it finds in there.
 #
 ##############################################################
 
 
-from azure.storage.blob import BlockBlobService
-import subprocess
+import StorageBackends
 import GetJSONTempFiles
 import TranscribeAudioFiles
+import ProcessingManifest
+import Sharding
+import RunLedger
+import Metrics
 import argparse
-import json
-
-
-
-
-config_file_name = "config.json"
+import asyncio
+import itertools
+from Configuration import setting
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("audio_source_folder")
-parser.add_argument("json_target_folder")
-args = parser.parse_args()
-
-print(18*"#" + "SOURCE FOLDER = ", args.audio_source_folder , + 18*"#")
-print(18*"#" + "TARGET FOLDER = ", args.json_target_folder , + 18*"#")
+##############################################################
+#
+# Loop through the given container / folder within it in the configured
+# storage backend (see StorageBackends.py), one page of blobs at a time,
+# and yield each blob (.mp3 or .wav file) as a (URL, blob name)
+# recording for processing
+# Recordings that were already transcribed, unchanged, in an earlier run and
+# recordings with the same content as another one are skipped unless force is set
+# Only the recordings in the given shard (see Sharding.py) are listed
+# The blobs are listed batch_config.page_size at a time by default
+#
+##############################################################
 
-with open(config_file_name, 'r') as f:
-	configuration = json.load(f)
+def iterRecordings(folder_to_read_audio_from, force=False, shard=None, page_size=None):
+    if page_size is None:
+        page_size = setting("batch_config", "page_size", 1000)
+    audio_container = setting("storage", "audio_container")
+    storage = StorageBackends.get_storage_backend()
+    manifest = ProcessingManifest.get_manifest()
+
+    for blob in storage.list(audio_container, folder_to_read_audio_from, page_size):
+        if not Sharding.inShard(blob.name, shard):
+            continue
+        etag, content_hash = ProcessingManifest.blobVersion(blob)
+        if not force:
+            process, reason = manifest.shouldProcess(ProcessingManifest.TRANSCRIBE, blob.name, etag, content_hash)
+            if not process:
+                print("Skipped blob: ", blob.name, " (" + reason + ")")
+                continue
+        manifest.markPending(ProcessingManifest.TRANSCRIBE, blob.name, etag, content_hash)
+        print("Submitted blob for transcription: ", blob.name)
+        RECORDINGS_BLOB_URI = storage.recordingUrl(audio_container, blob.name)
+        #print(RECORDINGS_BLOB_URI)
+        yield RECORDINGS_BLOB_URI, blob.name
 
 
 ##############################################################
-# 
-# Initialize the variables for our storage account by reading the values
-# provided in the config.json file
+#
+# List the recordings to process in one run
+# Only process the number of files specified in batch_config.files_to_process
 #
 ##############################################################
 
- 
-account_name = configuration["storage"]["account_name"] 
-account_key = configuration["storage"]["account_key"] 
-audio_container = configuration["storage"]["audio_container"] 
-SAS = configuration["storage"]["SAS"] 
-files_to_process = configuration["batch_config"]["files_to_process"]
+def listRecordings(folder_to_read_audio_from, force=False, shard=None):
+    return list(itertools.islice(iterRecordings(folder_to_read_audio_from, force, shard), setting("batch_config", "files_to_process")))
 
-folder_to_read_audio_from = args.audio_source_folder 
-
-STORAGE_PATH="https://" + account_name + ".blob.core.windows.net/" + audio_container + "/"
 
+##############################################################
+#
+# Clear the transcriptions left over from earlier runs and submit the
+# recordings found in the source folder. Returns the transcription ids.
+# When running as one shard the transcriptions are not cleared, as they
+# may belong to the other shards.
+#
+##############################################################
 
-blob_service = BlockBlobService(account_name, account_key)
-generator = blob_service.list_blobs(audio_container, prefix=folder_to_read_audio_from)
+def submitRecordings(folder_to_read_audio_from, force=False, shard=None):
+    if shard is None:
+        GetJSONTempFiles.deleteAllTranscriptions()
 
-audiofiles_list = []
+    recordings = listRecordings(folder_to_read_audio_from, force, shard)
 
-GetJSONTempFiles.deleteAllTranscriptions()
+    audiofiles_list = TranscribeAudioFiles.bulkTranscriptionsGrouped(recordings)
 
-current_file = 0
+    print(audiofiles_list)
+    return audiofiles_list
 
 
 ##############################################################
-# 
-# Loop through the given container / folder within it and append each blob (.mp3 or .wav file)
-# to a list for processing
-# Only process the number of files specified in the files_to_process variable
-# 
+#
+# Continuous ingestion: work through every recording in the source folder
+# with at most max_in_flight transcription jobs running. A new job is
+# submitted whenever one finishes, and the finished ones are saved to the
+# target folder while the others are still running. Only one page of the
+# blob listing and the jobs in flight are held in memory, so the size of
+# the container does not matter. Returns the number of transcriptions
+# saved. max_in_flight defaults to batch_config.max_in_flight.
+#
 ##############################################################
 
-
-for blob in generator:
-	
-	if current_file == files_to_process:
-		break
-	else:
-	    print("Submitted blob for transcription: ", blob.name)
-	    RECORDINGS_BLOB_URI = STORAGE_PATH + blob.name + SAS
-	    #print(RECORDINGS_BLOB_URI)
-	    audiofiles_list.append(TranscribeAudioFiles.bulkTranscriptions(RECORDINGS_BLOB_URI, blob.name))
-	current_file += 1
-
-print(audiofiles_list)
-
-print(18*"#" + "PROCESSING....." + 18*"#")
-
-GetJSONTempFiles.getTranscriptionsContent(audiofiles_list, args.json_target_folder)
+def ingestContinuously(folder_to_read_audio_from, json_target_folder, max_in_flight=None, force=False, shard=None,
+                       recordings_per_job=None):
+    if max_in_flight is None:
+        max_in_flight = setting("batch_config", "max_in_flight", 20)
+    if recordings_per_job is None:
+        recordings_per_job = setting("batch_config", "recordings_per_job", 1)
+    if shard is None:
+        GetJSONTempFiles.deleteAllTranscriptions()
+
+    recordings = iterRecordings(folder_to_read_audio_from, force, shard)
+    poller = GetJSONTempFiles.TranscriptionPoller()
+
+    def topUp():
+        while len(poller.pending) < max_in_flight:
+            group = list(itertools.islice(recordings, recordings_per_job))
+            if not group:
+                return
+            poller.add(TranscribeAudioFiles.bulkTranscriptionsGrouped(group, recordings_per_job))
+
+    def completed():
+        topUp()
+        for row in poller.completed():
+            yield row
+            topUp()
+
+    saved_files, saved_count = asyncio.run(
+        GetJSONTempFiles.retrieveTranscriptions(completed(), json_target_folder, keep_files=False))
+    RunLedger.get_ledger().flush()
+    print("Saved transcriptions: ", saved_count, " API calls per transcript: ",
+          Metrics.get_metrics().asdict()["api_requests_per_transcript"])
+    return saved_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("audio_source_folder")
+    parser.add_argument("json_target_folder")
+    parser.add_argument("--force", action="store_true", help="transcribe recordings that were already transcribed")
+    parser.add_argument("--shard", type=Sharding.parseShard, default=None, help="only transcribe shard i of N, e.g. 0/4")
+    parser.add_argument("--continuous", action="store_true", help="transcribe every recording in the folder, keeping max_in_flight jobs running")
+    parser.add_argument("--max_in_flight", type=int, default=None)
+    args = parser.parse_args()
+
+    print(18*"#" + "SOURCE FOLDER = ", args.audio_source_folder, 18*"#")
+    print(18*"#" + "TARGET FOLDER = ", args.json_target_folder, 18*"#")
+
+    if args.continuous:
+        print(18*"#" + "PROCESSING....." + 18*"#")
+
+        ingestContinuously(args.audio_source_folder, args.json_target_folder, args.max_in_flight, args.force, args.shard)
+    else:
+        audiofiles_list = submitRecordings(args.audio_source_folder, args.force, args.shard)
+
+        print(18*"#" + "PROCESSING....." + 18*"#")
+
+        GetJSONTempFiles.getTranscriptionsContent(audiofiles_list, args.json_target_folder)
+
+    Metrics.get_metrics().export()